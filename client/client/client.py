@@ -2,24 +2,26 @@
 The main module for client's application. Includes parser for command line
 arguments and the main loop. The main loop works the following way:
 Launches the app. If there's no nickname provided, prompts the login dialog.
-Otherwise generates the public key (in case it's the first launch), opens a client's
-socket and starts the GUI.
+Otherwise loads the key (generating it in the background in case it's the first
+launch), opens a client's socket and starts the GUI.
 """
 import os
 from argparse import ArgumentParser
+from configparser import ConfigParser
 from logging import getLogger
 
 from sys import argv, exit as sys_exit
 
-from Crypto.PublicKey import RSA
 from PyQt5.QtWidgets import QApplication, QMessageBox
 
 from client.database import ClientDatabase
 from client.main_window import MainWindowClient
 from client.core import ClientSocket
+from client.keys import load_key_async
 from client.start_window import ClientLoginDialog
 from utils.errors import ServerError
 from utils.constants import DEFAULT_IP_ADDR, DEFAULT_CONNECTION_PORT
+from utils.storage import read_storage_settings
 
 CLIENT_LOGGER = getLogger('client')
 
@@ -73,11 +75,22 @@ def get_launch_params() -> tuple:
     return addr, prt, ncknme, pwd
 
 
+def get_storage_params() -> dict:
+    """
+    Reads the settings of the client's DB storage from the
+    client_config.ini file in the current directory (if there is one).
+    """
+    config = ConfigParser()
+    config.read(os.path.join(os.getcwd(), 'client_config.ini'))
+    return read_storage_settings(config)
+
+
 def main_cycle():
     """
     The main loop of the client.
     Launches the app. If there's no nickname provided, prompts the login dialog.
-    Otherwise generates the public key (in case it's the first launch),
+    Otherwise loads the key (it's generated in a separate thread in case
+    it's the first launch, while the socket connects to the server),
     opens a client's socket and starts the GUI.
     """
     address, port, nickname, password = get_launch_params()
@@ -101,15 +114,12 @@ def main_cycle():
 
     cur_dir = os.getcwd()
     key_file = os.path.join(cur_dir, f'{nickname}.key')
-    if not os.path.exists(key_file):
-        keys = RSA.generate(2048, os.urandom)
-        with open(key_file, 'wb') as key:
-            key.write(keys.export_key())
-    else:
-        with open(key_file, 'rb') as key:
-            pub_keys = RSA.import_key(key.read())
+    keys_future = load_key_async(key_file)
+    if not keys_future.done():
+        welcome_dialog.show_progress('Подготовка ключей шифрования...')
+        client_app.processEvents()
 
-    client_db = ClientDatabase(nickname)
+    client_db = ClientDatabase(nickname, get_storage_params())
     try:
         client_socket = ClientSocket(
             address,
@@ -117,7 +127,7 @@ def main_cycle():
             nickname,
             client_db,
             password,
-            pub_keys
+            keys_future
         )
     except ServerError as e:
         msg = QMessageBox()
@@ -132,13 +142,16 @@ def main_cycle():
         sys_exit(1)
     else:
         client_socket.setDaemon(True)
-        client_socket.start()
+    pub_keys = keys_future.result()
 
     del welcome_dialog
 
     client_main_window = MainWindowClient(
         client_db, client_socket, pub_keys)
     client_main_window.establish_connection(client_socket)
+    # прием сообщений запускается после подключения сигналов, иначе
+    # сообщения, ожидавшие клиента на сервере, пришли бы в пустоту
+    client_socket.start()
     client_main_window.setWindowTitle(
         "Takmachat pre-alpha - %s" % nickname)
     client_app.exec_()
@@ -5,10 +5,12 @@ import os
 from datetime import datetime
 
 from sqlalchemy import create_engine, MetaData, Table, Column, \
-    Integer, String, Text, DateTime
+    Integer, String, Text, DateTime, Index, inspect, or_, and_
 from sqlalchemy.orm import mapper, sessionmaker
 from sqlalchemy.sql import default_comparator
 
+from utils.storage import apply_storage_settings
+
 
 class ClientDatabase:
     """
@@ -83,12 +85,38 @@ class ClientDatabase:
             """
             return "<Contact ('%s')>" % self.contact
 
-    def __init__(self, login):
+    class PublicKeys:
+        """
+        Representation class for a table of contacts' public keys.
+        """
+
+        def __init__(self, contact, public_key, fingerprint):
+            """
+            Initialization method for the table.
+
+            :param contact: contact's login
+            :param public_key: contact's public key in PEM format
+            :param fingerprint: fingerprint of the key
+            """
+            self.id = None
+            self.contact = contact
+            self.public_key = public_key
+            self.fingerprint = fingerprint
+
+        def __repr__(self):
+            """
+            Representation for print.
+            """
+            return "<Public key ('%s')>" % self.contact
+
+    def __init__(self, login, storage_settings: dict = None):
         """
         Method for initializing the database, creating the tables,
         and establishing the session.
 
         :param login: client's login
+        :param storage_settings: SQLite tuning (see utils.storage),
+            the defaults are used if None
         """
         cwd = os.getcwd()
         file = f'client_{login}.sqlite3'
@@ -98,6 +126,7 @@ class ClientDatabase:
             pool_recycle=7200,
             connect_args={'check_same_thread': False}
         )
+        apply_storage_settings(self.engine, storage_settings)
         self.metadata = MetaData()
 
         existing_users_table = Table(
@@ -114,7 +143,12 @@ class ClientDatabase:
             Column('client', String(25)),
             Column('direction', String(3)),
             Column('message', Text),
-            Column('datetime', DateTime)
+            Column('datetime', DateTime),
+            Index(
+                'ix_message_history_client_datetime',
+                'client',
+                'datetime'
+            )
         )
 
         contacts_table = Table(
@@ -124,15 +158,43 @@ class ClientDatabase:
             Column('contact', String(25), unique=True)
         )
 
+        public_keys_table = Table(
+            'public_keys',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('contact', String(25), unique=True),
+            Column('public_key', Text),
+            Column('fingerprint', String(64))
+        )
+
         self.metadata.create_all(self.engine)
+        self.create_missing_indexes()
         mapper(self.ExistingUsers, existing_users_table)
         mapper(self.MessageHistory, message_history_table)
         mapper(self.Contacts, contacts_table)
+        mapper(self.PublicKeys, public_keys_table)
         Sesh = sessionmaker(bind=self.engine)
         self.session = Sesh()
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+    def create_missing_indexes(self):
+        """
+        Creates the indexes that are missing in a DB created by an older
+        version of the client (create_all doesn't add indexes to the
+        existing tables).
+        """
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in self.metadata.sorted_tables:
+                existing_indexes = {
+                    index['name'] for index in inspector.get_indexes(
+                        table.name)
+                }
+                for index in table.indexes:
+                    if index.name not in existing_indexes:
+                        index.create(connection)
+
     def add_user_to_contacts(self, login: str):
         """
         Adding user to contacts.
@@ -169,13 +231,68 @@ class ClientDatabase:
             self.session.add(new_user)
         self.session.commit()
 
+    def add_existing_user(self, login: str):
+        """
+        Adds a single user to the list of existing users
+        (if he isn't there yet).
+
+        :param login: user's nickname
+        """
+        if not self.check_for_user(login):
+            self.session.add(self.ExistingUsers(login))
+            self.session.commit()
+
+    def remove_existing_user(self, login: str):
+        """
+        Removes a single user from the lists of existing users
+        and contacts, and forgets his public key.
+
+        :param login: user's nickname
+        """
+        self.session.query(self.ExistingUsers).filter_by(
+            login=login).delete()
+        self.session.query(self.Contacts).filter_by(contact=login).delete()
+        self.session.query(self.PublicKeys).filter_by(contact=login).delete()
+        self.session.commit()
+
+    def get_public_key(self, contact: str):
+        """
+        Returns the cached public key of the contact and its fingerprint
+        as a tuple, or None if the key isn't cached.
+
+        :param contact: contact's login
+        """
+        return self.session.query(
+            self.PublicKeys.public_key,
+            self.PublicKeys.fingerprint
+        ).filter_by(contact=contact).first()
+
+    def save_public_key(self, contact: str, public_key: str, fingerprint: str):
+        """
+        Caches the public key of the contact, replacing the previous one.
+
+        :param contact: contact's login
+        :param public_key: contact's public key in PEM format
+        :param fingerprint: fingerprint of the key
+        """
+        cached = self.session.query(self.PublicKeys).filter_by(
+            contact=contact).first()
+        if cached:
+            cached.public_key = public_key
+            cached.fingerprint = fingerprint
+        else:
+            self.session.add(
+                self.PublicKeys(contact, public_key, fingerprint))
+        self.session.commit()
+
     def save_message_to_history(self,
                                 client: str,
                                 direction: str,
-                                message: str):
+                                message: str) -> tuple:
         """
         Save new message to DB.
         The direction can be either 'in' or 'out', since each client has his own DB.
+        Returns the saved message as a tuple like get_message_history does.
 
         :param client: client
         :param direction: message direction
@@ -184,6 +301,11 @@ class ClientDatabase:
         new_message = self.MessageHistory(client, direction, message)
         self.session.add(new_message)
         self.session.commit()
+        return (client,
+                direction,
+                message,
+                new_message.datetime,
+                new_message.id)
 
     def get_contacts(self) -> list:
         """
@@ -227,19 +349,43 @@ class ClientDatabase:
         else:
             return False
 
-    def get_message_history(self, contact: str) -> list:
+    def get_message_history(self,
+                            contact: str,
+                            limit: int = None,
+                            before: tuple = None) -> list:
         """
         Return the message history with a given contact.
-        Returns a list of tuples.
+        Returns a list of (contact, direction, text, datetime, id) tuples
+        sorted from the oldest message to the newest.
+        With the limit only the last page is selected (using the index
+        on client and datetime), earlier pages are selected with before
+        set to the datetime and id of the oldest message of the current
+        page. The messages are ordered by both, so the ones saved within
+        the same tick as the page boundary are not skipped.
 
         :param contact: sender / recipient
+        :param limit: max number of the messages, all of them if None
+        :param before: (datetime, id) of the message, only the messages
+            older than it are returned
         """
         qry = self.session.query(self.MessageHistory).filter_by(
             client=contact)
+        if before is not None:
+            before_datetime, before_id = before
+            qry = qry.filter(or_(
+                self.MessageHistory.datetime < before_datetime,
+                and_(self.MessageHistory.datetime == before_datetime,
+                     self.MessageHistory.id < before_id)
+            ))
+        qry = qry.order_by(
+            self.MessageHistory.datetime.desc(),
+            self.MessageHistory.id.desc()
+        ).limit(limit)
         return [(row.client,
                  row.direction,
                  row.message,
-                 row.datetime) for row in qry.all()]
+                 row.datetime,
+                 row.id) for row in reversed(qry.all())]
 
     def cleat_contact_list(self):
         """
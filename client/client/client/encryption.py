@@ -0,0 +1,121 @@
+"""
+End-to-end encryption of the messages.
+Every conversation has its own AES session key. The sender wraps it with the
+recipient's public RSA key (OAEP) once and then reuses it for all the messages
+of the conversation, the message bodies themselves are encrypted with AES-GCM.
+The encrypted message is a string of four base64 fields separated by dots:
+wrapped session key, nonce, ciphertext and authentication tag.
+"""
+from base64 import b64encode, b64decode
+from collections import OrderedDict
+
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey.RSA import RsaKey
+from Crypto.Random import get_random_bytes
+
+# длина сеансового ключа AES в байтах
+SESSION_KEY_LENGTH = 32
+# сколько расшифрованных сеансовых ключей собеседников держать в памяти
+SESSION_KEYS_CACHE_SIZE = 256
+FIELDS_SEPARATOR = '.'
+
+
+def to_base64(data: bytes) -> str:
+    """
+    Encodes bytes to a base64 string.
+
+    :param data: bytes to be encoded
+    """
+    return b64encode(data).decode('ascii')
+
+
+class MessageEncryptor:
+    """
+    Encrypts the messages sent to a single contact.
+    """
+
+    def __init__(self, public_key: RsaKey):
+        """
+        Generates the session key of the conversation and wraps it
+        with the contact's public key. That is the only RSA operation,
+        all the messages are then encrypted with AES.
+
+        :param public_key: contact's public RSA key
+        """
+        self.session_key = get_random_bytes(SESSION_KEY_LENGTH)
+        self.wrapped_key = to_base64(
+            PKCS1_OAEP.new(public_key).encrypt(self.session_key))
+
+    def encrypt(self, text: str) -> str:
+        """
+        Encrypts the message text with AES-GCM and returns the
+        string to be sent to the server.
+
+        :param text: message text
+        """
+        cipher = AES.new(self.session_key, AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode('utf-8'))
+        return FIELDS_SEPARATOR.join((
+            self.wrapped_key,
+            to_base64(cipher.nonce),
+            to_base64(ciphertext),
+            to_base64(tag)
+        ))
+
+
+class MessageDecryptor:
+    """
+    Decrypts the messages sent to the user.
+    Unwrapped session keys are cached, so the private RSA key is used only
+    once per conversation and not for every message.
+    """
+
+    def __init__(self, private_key: RsaKey):
+        """
+        Initialization of the decryptor.
+
+        :param private_key: user's private RSA key
+        """
+        self.key_decrypter = PKCS1_OAEP.new(private_key)
+        self.session_keys = OrderedDict()
+
+    def unwrap_session_key(self, wrapped_key: str) -> bytes:
+        """
+        Returns the session key, decrypting it with the private key
+        only if it isn't in the cache yet.
+
+        :param wrapped_key: base64 of the RSA-encrypted session key
+        """
+        session_key = self.session_keys.get(wrapped_key)
+        if session_key is None:
+            session_key = self.key_decrypter.decrypt(b64decode(wrapped_key))
+            self.session_keys[wrapped_key] = session_key
+            if len(self.session_keys) > SESSION_KEYS_CACHE_SIZE:
+                self.session_keys.popitem(last=False)
+        else:
+            self.session_keys.move_to_end(wrapped_key)
+        return session_key
+
+    def decrypt(self, payload: str) -> str:
+        """
+        Decrypts the message and returns its text.
+        Messages encrypted with RSA only (without the session key)
+        by the previous versions of the client are supported as well.
+        Raises ValueError if the message is damaged or forged.
+
+        :param payload: encrypted message as received from the server
+        """
+        fields = payload.split(FIELDS_SEPARATOR)
+        if len(fields) == 1:
+            return self.key_decrypter.decrypt(
+                b64decode(payload)).decode('utf-8')
+        if len(fields) != 4:
+            raise ValueError('Неверный формат зашифрованного сообщения.')
+        wrapped_key, nonce, ciphertext, tag = fields
+        cipher = AES.new(
+            self.unwrap_session_key(wrapped_key),
+            AES.MODE_GCM,
+            nonce=b64decode(nonce)
+        )
+        return cipher.decrypt_and_verify(
+            b64decode(ciphertext), b64decode(tag)).decode('utf-8')
@@ -0,0 +1,141 @@
+"""
+Model of the message history shown in the main window.
+"""
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+from PyQt5.QtGui import QBrush, QColor
+
+# сколько сообщений переписки загружается из БД за один раз
+HISTORY_PAGE_SIZE = 20
+
+
+class MessageHistoryModel(QAbstractListModel):
+    """
+    List model of the conversation with one contact.
+    Only the last page of the history is selected from the DB when the
+    conversation is opened, new messages are appended to it and older
+    pages are prepended on demand (when the view is scrolled to the top).
+    """
+
+    def __init__(self, database, page_size: int = HISTORY_PAGE_SIZE):
+        """
+        Initialization of the model.
+
+        :param database: client's DB
+        :param page_size: number of the messages selected at a time
+        """
+        super().__init__()
+        self.database = database
+        self.page_size = page_size
+        self.contact = None
+        # строки модели: (направление, текст для отображения, время, id)
+        self.rows = []
+        self.has_older = False
+        self.backgrounds = {
+            'in': QBrush(QColor(255, 150, 150)),
+            'out': QBrush(QColor(130, 245, 130))
+        }
+        self.alignments = {
+            'in': Qt.AlignLeft,
+            'out': Qt.AlignRight
+        }
+
+    @staticmethod
+    def make_row(message: tuple) -> tuple:
+        """
+        Converts the message from the DB to the row of the model.
+
+        :param message: (contact, direction, text, datetime, id)
+        """
+        _, direction, text, sent, message_id = message
+        return direction, f'{sent.replace(microsecond=0)}:\n{text}', \
+            sent, message_id
+
+    def set_contact(self, contact: str = None):
+        """
+        Shows the last page of the conversation with the contact,
+        or nothing if the contact is None.
+
+        :param contact: contact's login
+        """
+        self.beginResetModel()
+        self.contact = contact
+        if contact is None:
+            messages = []
+        else:
+            messages = self.database.get_message_history(
+                contact, self.page_size)
+        self.rows = [self.make_row(message) for message in messages]
+        self.has_older = len(messages) == self.page_size
+        self.endResetModel()
+
+    def clear(self):
+        """
+        Removes the conversation from the model.
+        """
+        self.set_contact(None)
+
+    def append_message(self, message: tuple):
+        """
+        Appends the new message to the end of the conversation
+        if it belongs to it.
+
+        :param message: (contact, direction, text, datetime, id)
+        """
+        if message[0] != self.contact:
+            return
+        row = len(self.rows)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows.append(self.make_row(message))
+        self.endInsertRows()
+
+    def can_fetch_older(self) -> bool:
+        """
+        Returns True if the DB may have older messages than the ones shown.
+        """
+        return self.contact is not None and self.has_older
+
+    def fetch_older(self) -> int:
+        """
+        Prepends the previous page of the conversation, the one before
+        the datetime and id of the oldest message shown.
+        Returns the number of the messages added.
+        """
+        if not self.can_fetch_older():
+            return 0
+        before = self.rows[0][2:] if self.rows else None
+        messages = self.database.get_message_history(
+            self.contact, self.page_size, before)
+        self.has_older = len(messages) == self.page_size
+        if messages:
+            self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+            self.rows[0:0] = [self.make_row(message) for message in messages]
+            self.endInsertRows()
+        return len(messages)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        """
+        Returns the number of the messages loaded.
+
+        :param parent: parent index, the list has no children
+        """
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole):
+        """
+        Returns the text, the background or the alignment of the message.
+
+        :param index: index of the message
+        :param role: requested role
+        """
+        if not index.isValid() or not 0 <= index.row() < len(self.rows):
+            return None
+        direction, text = self.rows[index.row()][:2]
+        if role == Qt.DisplayRole:
+            return text
+        elif role == Qt.BackgroundRole:
+            return self.backgrounds.get(direction)
+        elif role == Qt.TextAlignmentRole:
+            return self.alignments.get(direction)
+        return None
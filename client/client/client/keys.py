@@ -0,0 +1,163 @@
+"""
+Loading and generation of the client's RSA key.
+The key is kept in the PEM file, next to it there is a cache with the
+numbers of the key: importing the PEM checks the key (which takes tens
+of milliseconds), the key built from the cache of our own PEM doesn't
+have to be checked again.
+"""
+import os
+from concurrent.futures import Future
+from hashlib import sha256
+from json import dump, load
+from logging import getLogger
+from threading import Thread
+
+from Crypto.PublicKey import RSA
+from Crypto.PublicKey.RSA import RsaKey
+
+KEYS_LOGGER = getLogger('client')
+
+# длина ключа RSA в битах
+KEY_LENGTH = 2048
+# числа ключа, сохраняемые в кэше
+KEY_COMPONENTS = ('n', 'e', 'd', 'p', 'q')
+
+
+def cache_file_path(key_file: str) -> str:
+    """
+    Returns the path to the cache of the key file.
+
+    :param key_file: path to the PEM file of the key
+    """
+    return key_file + '.cache'
+
+
+def open_private(path: str, mode: str = 'w'):
+    """
+    Opens the file for writing, creating it readable only by the owner:
+    the PEM and the cache contain the private numbers of the key.
+    A file left by an earlier version with wider permissions is
+    restricted as well.
+
+    :param path: path to the file
+    :param mode: mode of the file object, 'w' or 'wb'
+    """
+    descriptor = os.open(
+        path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+        0o600
+    )
+    os.chmod(path, 0o600)
+    return os.fdopen(descriptor, mode)
+
+
+def save_key(key: RsaKey, key_file: str):
+    """
+    Saves the key to the PEM file and its cache, both readable
+    only by the owner.
+
+    :param key: client's RSA key
+    :param key_file: path to the PEM file of the key
+    """
+    pem = key.export_key()
+    with open_private(key_file, 'wb') as file:
+        file.write(pem)
+    save_key_cache(key, key_file, pem)
+
+
+def save_key_cache(key: RsaKey, key_file: str, pem: bytes):
+    """
+    Saves the numbers of the key along with the hash of the PEM
+    they were taken from, so a replaced PEM file isn't shadowed
+    by the old cache.
+
+    :param key: client's RSA key
+    :param key_file: path to the PEM file of the key
+    :param pem: contents of the PEM file
+    """
+    cache = {name: hex(getattr(key, name)) for name in KEY_COMPONENTS}
+    cache['pem_hash'] = sha256(pem).hexdigest()
+    try:
+        with open_private(cache_file_path(key_file)) as file:
+            dump(cache, file)
+    except OSError:
+        KEYS_LOGGER.warning('Не удалось сохранить кэш ключа %s' % key_file)
+
+
+def read_cached_key(key_file: str, pem: bytes):
+    """
+    Returns the key built from the cache, or None if there's no cache
+    or it doesn't match the PEM file.
+
+    :param key_file: path to the PEM file of the key
+    :param pem: contents of the PEM file
+    """
+    try:
+        with open(cache_file_path(key_file)) as file:
+            cache = load(file)
+        if cache['pem_hash'] != sha256(pem).hexdigest():
+            return None
+        return RSA.construct(
+            [int(cache[name], 16) for name in KEY_COMPONENTS],
+            consistency_check=False
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def load_key(key_file: str) -> RsaKey:
+    """
+    Loads the key from the cache or, if it can't be used,
+    from the PEM file, caching it for the next time.
+
+    :param key_file: path to the PEM file of the key
+    """
+    with open(key_file, 'rb') as file:
+        pem = file.read()
+    key = read_cached_key(key_file, pem)
+    if key is None:
+        key = RSA.import_key(pem)
+        save_key_cache(key, key_file, pem)
+    return key
+
+
+def generate_key(key_file: str) -> RsaKey:
+    """
+    Generates a new key and saves it.
+
+    :param key_file: path to the PEM file of the key
+    """
+    KEYS_LOGGER.info('Генерация нового ключа RSA: %s' % key_file)
+    key = RSA.generate(KEY_LENGTH, os.urandom)
+    save_key(key, key_file)
+    return key
+
+
+def load_key_async(key_file: str) -> Future:
+    """
+    Returns the future of the client's key.
+    If the key is cached, the future is done right away, otherwise the key
+    is imported or generated (on the first launch) in a separate thread,
+    so the caller can connect to the server meanwhile.
+
+    :param key_file: path to the PEM file of the key
+    """
+    future = Future()
+    if os.path.exists(key_file):
+        with open(key_file, 'rb') as file:
+            key = read_cached_key(key_file, file.read())
+        if key is not None:
+            future.set_result(key)
+            return future
+        target = load_key
+    else:
+        target = generate_key
+
+    def worker():
+        try:
+            future.set_result(target(key_file))
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=worker, daemon=True).start()
+    return future
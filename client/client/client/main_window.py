@@ -1,25 +1,28 @@
 """
 GUI of main window of client's app.
 """
-from base64 import b64encode, b64decode
+from collections import OrderedDict
 from json import JSONDecodeError
 from logging import getLogger
 
-from Crypto.Cipher import PKCS1_OAEP
 from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 from PyQt5.QtCore import Qt, pyqtSlot
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, \
-    QColor
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QDialog
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QDialog, \
+    QAbstractItemView
 
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.encryption import MessageEncryptor, MessageDecryptor
 from client.gui import Ui_MainWindow
+from client.history_model import MessageHistoryModel
 from utils.constants import MESSAGE_TEXT, SENDER
 from utils.errors import ServerError
 
 LOGGER = getLogger('client')
+# сколько готовых шифраторов собеседников держать в памяти
+ENCRYPTORS_CACHE_SIZE = 64
 
 
 class MainWindowClient(QMainWindow):
@@ -44,7 +47,8 @@ class MainWindowClient(QMainWindow):
         self.client_db = client_db
         self.client_socket = client_socket
 
-        self.decrypter = PKCS1_OAEP.new(encryption_keys)
+        self.decrypter = MessageDecryptor(encryption_keys)
+        self.encryptors = OrderedDict()
 
         self.gui = Ui_MainWindow()
         self.gui.setupUi(self)
@@ -61,7 +65,7 @@ class MainWindowClient(QMainWindow):
             self.del_contact_dialog)
 
         self.contacts_model = None
-        self.msg_history_model = None
+        self.msg_history_model = MessageHistoryModel(self.client_db)
         self.messages = QMessageBox()
         self.current_conv = None
         self.current_conv_key = None
@@ -69,6 +73,9 @@ class MainWindowClient(QMainWindow):
         self.gui.messageHistory.setHorizontalScrollBarPolicy(
             Qt.ScrollBarAlwaysOff)
         self.gui.messageHistory.setWordWrap(True)
+        self.gui.messageHistory.setModel(self.msg_history_model)
+        self.gui.messageHistory.verticalScrollBar().valueChanged.connect(
+            self.msg_history_scrolled)
         self.gui.contactsList.doubleClicked.connect(
             self.active_user_select)
 
@@ -82,8 +89,7 @@ class MainWindowClient(QMainWindow):
         """
         self.gui.inputBoxLbl.setText('Дважды кликните по имени получателя.')
         self.gui.msgInput.clear()
-        if self.msg_history_model:
-            self.msg_history_model.clear()
+        self.msg_history_model.clear()
 
         self.gui.cleanBtn.setDisabled(True)
         self.gui.sendBtn.setDisabled(True)
@@ -96,43 +102,42 @@ class MainWindowClient(QMainWindow):
     def msg_history_update(self):
         """
         Update the message history of two users.
-        Shows only 20 last messages.
-        If there are no messages between users, creates an empty model.
+        Shows only the last page of messages, the older ones are loaded
+        when the history is scrolled to the top.
         """
-        msg_list = sorted(
-            self.client_db.get_message_history(self.current_conv),
-            key=lambda itm: itm[3]
-        )
-        if not self.msg_history_model:
-            self.msg_history_model = QStandardItemModel()
-            self.gui.messageHistory.setModel(self.msg_history_model)
-        self.msg_history_model.clear()
-        all_msgs = len(msg_list)
-        start_idx = 0
-        if all_msgs > 20:
-            start_idx = all_msgs - 20
-        for i in range(start_idx, all_msgs):
-            lst_itm = msg_list[i]
-            if lst_itm[1] == 'in':
-                msg = QStandardItem(
-                    f'{lst_itm[3].replace(microsecond=0)}:\n'
-                    f'{lst_itm[2]}'
-                )
-                msg.setEditable(False)
-                msg.setBackground(QBrush(QColor(255, 150, 150)))
-                msg.setTextAlignment(Qt.AlignLeft)
-                self.msg_history_model.appendRow(msg)
-            else:
-                msg = QStandardItem(
-                    f'{lst_itm[3].replace(microsecond=0)}:\n'
-                    f'{lst_itm[2]}'
-                )
-                msg.setEditable(False)
-                msg.setBackground(QBrush(QColor(130, 245, 130)))
-                msg.setTextAlignment(Qt.AlignRight)
-                self.msg_history_model.appendRow(msg)
+        self.msg_history_model.set_contact(self.current_conv)
+        self.gui.messageHistory.scrollToBottom()
+
+    def msg_history_append(self, message: tuple):
+        """
+        Adds the new message to the message history
+        without reloading the conversation.
+
+        :param message: message saved to the DB
+        """
+        self.msg_history_model.append_message(message)
         self.gui.messageHistory.scrollToBottom()
 
+    def msg_history_scrolled(self, value: int):
+        """
+        Loads the previous page of the message history when the history
+        is scrolled to the top, keeping the same messages in sight.
+
+        :param value: position of the vertical scroll bar
+        """
+        scroll_bar = self.gui.messageHistory.verticalScrollBar()
+        if value != scroll_bar.minimum() \
+                or not self.msg_history_model.can_fetch_older():
+            return
+        top = self.gui.messageHistory.indexAt(
+            self.gui.messageHistory.viewport().rect().topLeft())
+        added = self.msg_history_model.fetch_older()
+        if added and top.isValid():
+            self.gui.messageHistory.scrollTo(
+                self.msg_history_model.index(top.row() + added),
+                QAbstractItemView.PositionAtTop
+            )
+
     def active_user_select(self):
         """
         Changes the current conversation attribute and triggers the active_user_set method
@@ -154,8 +159,8 @@ class MainWindowClient(QMainWindow):
             LOGGER.debug(
                 'Получен открытый ключ для %s' % self.current_conv)
             if self.current_conv_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_conv_key))
+                self.encryptor = self.get_encryptor(
+                    self.current_conv, self.current_conv_key)
         except (OSError, JSONDecodeError):
             self.current_conv_key = None
             self.encryptor = None
@@ -180,6 +185,27 @@ class MainWindowClient(QMainWindow):
 
         self.msg_history_update()
 
+    def get_encryptor(self, contact: str, public_key: str) -> MessageEncryptor:
+        """
+        Returns the encryptor of the conversation with the contact.
+        The encryptor (and its session key) is created once and reused
+        until the contact's public key changes, the encryptors of the
+        least recently selected contacts are dropped.
+
+        :param contact: contact's login
+        :param public_key: contact's public key in PEM format
+        """
+        cached = self.encryptors.get(contact)
+        if cached and cached[0] == public_key:
+            self.encryptors.move_to_end(contact)
+            return cached[1]
+        encryptor = MessageEncryptor(RSA.import_key(public_key))
+        self.encryptors[contact] = (public_key, encryptor)
+        self.encryptors.move_to_end(contact)
+        if len(self.encryptors) > ENCRYPTORS_CACHE_SIZE:
+            self.encryptors.popitem(last=False)
+        return encryptor
+
     def contact_list_update(self):
         """
         Updates the contact list.
@@ -228,17 +254,7 @@ class MainWindowClient(QMainWindow):
         try:
             self.client_socket.add_new_contact(contact)
         except OSError as e:
-            if e.errno:
-                self.messages.critical(
-                    self,
-                    'Ошибка!',
-                    'Потеряно соединение с сервером!'
-                )
-                self.close()
-            self.messages.critical(self,
-                                   'Ошибка!',
-                                   'Таймаут соединения с сервером'
-                                   )
+            self.connection_error(e)
         else:
             self.client_db.add_user_to_contacts(contact)
             new_cntct = QStandardItem(contact)
@@ -274,18 +290,7 @@ class MainWindowClient(QMainWindow):
         try:
             self.client_socket.remove_contact(cntct_name)
         except OSError as e:
-            if e.errno:
-                self.messages.critical(
-                    self,
-                    'Ошибка!',
-                    'Потеряно соединение с сервером!'
-                )
-                self.close()
-            self.messages.critical(
-                self,
-                'Ошибка!',
-                'Таймаут соединения с сервером'
-            )
+            self.connection_error(e)
         else:
             self.client_db.delete_user_from_contacts(cntct_name)
             self.contact_list_update()
@@ -310,52 +315,32 @@ class MainWindowClient(QMainWindow):
         self.gui.msgInput.clear()
         if not msg_text:
             return
-        msg_text_encrypted = self.encryptor.encrypt(
-            msg_text.encode('utf-8')
-        )
-        msg_text_encrypted_base64 = b64encode(msg_text_encrypted)
+        msg_text_encrypted = self.encryptor.encrypt(msg_text)
         try:
             self.client_socket.create_message(
                 self.current_conv,
-                msg_text_encrypted_base64.decode('ascii')
+                msg_text_encrypted
             )
-        except (ConnectionError,
-                ConnectionAbortedError,
-                ConnectionResetError):
-            self.messages.critical(self,
-                                   'Ошибка!',
-                                   'Потеряно соединение с сервером!'
-                                   )
-            self.close()
         except OSError as e:
-            if e.errno:
-                self.messages.critical(
-                    self,
-                    'Ошибка!',
-                    'Потеряно соединение с сервером!'
-                )
-                self.close()
-            self.messages.critical(self,
-                                   'Ошибка!',
-                                   'Таймаут соединения с сервером'
-                                   )
+            self.connection_error(e)
         except ServerError as e:
             self.messages.critical(self,
                                    'Ошибка!',
                                    e.error_message
                                    )
         else:
-            self.client_db.save_message_to_history(self.current_conv,
-                                                   'out',
-                                                   msg_text
-                                                   )
+            saved_msg = self.client_db.save_message_to_history(
+                self.current_conv,
+                'out',
+                msg_text
+            )
             LOGGER.debug(
                 'Отправлено сообщение для %s: %s.' % (
                     self.current_conv,
                     msg_text
                 )
             )
-            self.msg_history_update()
+            self.msg_history_append(saved_msg)
 
     @pyqtSlot(dict)
     def new_msg(self, message: dict):
@@ -366,13 +351,12 @@ class MainWindowClient(QMainWindow):
         currently conversing with the sender of the message, updates the
         message history, otherwise checks if the sender is added to the
         user's contacts and triggers a relevant message. If the sender is
-        not in user's contacts, adds him there, and saves the message to the DB.
+        not in user's contacts, adds him there.
 
         :param message: message dictionary
         """
-        encrypted_msg = b64decode(message[MESSAGE_TEXT])
         try:
-            decrypted_msg = self.decrypter.decrypt(encrypted_msg)
+            decrypted_msg = self.decrypter.decrypt(message[MESSAGE_TEXT])
         except (ValueError, TypeError):
             self.messages.warning(
                 self,
@@ -380,15 +364,14 @@ class MainWindowClient(QMainWindow):
                 'Не удалось декодировать сообщение!'
             )
             return
-        else:
-            self.client_db.save_message_to_history(
-                self.current_conv,
-                'in',
-                decrypted_msg.decode('utf-8')
-            )
         sender = message[SENDER]
+        saved_msg = self.client_db.save_message_to_history(
+            sender,
+            'in',
+            decrypted_msg
+        )
         if sender == self.current_conv:
-            self.msg_history_update()
+            self.msg_history_append(saved_msg)
         else:
             if self.client_db.check_for_contact(sender):
                 user_resp = self.messages.question(
@@ -415,13 +398,30 @@ class MainWindowClient(QMainWindow):
                 if user_resp == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_conv = sender
-                    self.client_db.save_message_to_history(
-                        self.current_conv,
-                        'in',
-                        decrypted_msg.decode('utf-8')
-                    )
                     self.active_user_set()
 
+    def connection_error(self, error: OSError):
+        """
+        Tells the user that the request failed because of the connection.
+        The window isn't closed: the client's socket reconnects by itself
+        and sends the connection_lost signal only if it can't.
+
+        :param error: exception raised by the request
+        """
+        if error.errno:
+            self.messages.warning(
+                self,
+                'Ошибка!',
+                'Нет соединения с сервером, идет переподключение. '
+                'Повторите попытку позже.'
+            )
+        else:
+            self.messages.critical(
+                self,
+                'Ошибка!',
+                'Таймаут соединения с сервером'
+            )
+
     @pyqtSlot()
     def connection_lost(self):
         """
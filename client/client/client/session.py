@@ -0,0 +1,882 @@
+"""
+Client's session: the connection to the server without any GUI.
+It doesn't depend on PyQt, so it can be used by bots and tests,
+the GUI wraps it into the Qt adapter from client.core.
+"""
+from binascii import hexlify, b2a_base64
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from hashlib import pbkdf2_hmac
+from hmac import new
+from errno import ECONNRESET
+from itertools import count
+from json import JSONDecodeError
+from logging import getLogger
+from random import uniform
+from select import select
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread, Lock
+from time import sleep, time, monotonic
+
+from utils.constants import ACTION, PRESENCE, TIME, USER, \
+    ACCOUNT_NAME, RESPONSE, ERROR, MESSAGE, SENDER, DESTINATION, \
+    MESSAGE_TEXT, GET_CONTACTS, LIST_INFO, USER_REQUEST, \
+    ADD_CONTACT, REMOVE_CONTACT, EXIT, PUBLIC_KEY, DATA, \
+    PUBLIC_KEY_REQUEST, RESPONSE_TIMEOUT, REQUEST_ID, VERSION, \
+    PROTOCOL_VERSION, EVENT, ROSTER_UPDATE, USER_ADDED, USER_REMOVED, \
+    USER_ONLINE, FINGERPRINT, KEY_NOT_MODIFIED, HANDSHAKE_TIMEOUT, \
+    RESUME_TOKEN, SEQUENCE, ROSTER_SYNC, TOKEN_REFRESH, TOKEN_TTL, \
+    SERVER_BUSY, RETRY_AFTER
+from utils.decorators import function_log
+from utils.errors import ServerError, ServerBusyError, \
+    IncorrectDataReceivedError
+from utils.utils import send_message, receive_message, \
+    receive_messages, take_buffered_messages, key_fingerprint
+
+SOCKET_LOGGER = getLogger('client')
+
+# число попыток соединения при запуске клиента
+CONNECTION_ATTEMPTS = 5
+# переподключение после обрыва: пауза перед n-й попыткой выбирается
+# случайно от 0 до min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** n),
+# чтобы клиенты, потерявшие сервер одновременно, не вернулись все разом
+RECONNECT_ATTEMPTS = 10
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+
+class ClientSession(Thread):
+    """
+    Connection of one user to the server.
+    Events are reported through the callbacks given to the constructor
+    (or by overriding the on_* methods); they are called from the
+    reader thread, so e.g. queue.Queue.put can be used as a callback.
+    """
+
+    def __init__(self,
+                 server_address: str,
+                 server_port: int,
+                 client_nickname: str,
+                 database,
+                 password: str,
+                 keys,
+                 message_callback=None,
+                 contacts_callback=None,
+                 connection_lost_callback=None):
+        """
+        Initialization of client's session.
+        Connects to the server, requests the contacts and existing
+        users' lists and sets the running flag to True.
+
+        :param server_address: server's IP address
+        :param server_port: listening port on the server
+        :param client_nickname: client's login
+        :param database: client's DB, None if the lists aren't stored
+        :param password: client's password, duh
+        :param keys: client's RSA key or a future of it
+        :param message_callback: called with a message from another user
+        :param contacts_callback: called when the users' lists have changed
+        :param connection_lost_callback: called when the connection is lost
+        """
+        Thread.__init__(self)
+        self.server_address = server_address
+        self.server_port = server_port
+        self.client_nickname = client_nickname
+        self.database = database
+        self.message_callback = message_callback
+        self.contacts_callback = contacts_callback
+        self.connection_lost_callback = connection_lost_callback
+        self.client_socket = None
+        self.socket_lock = Lock()
+        self.password = password
+        self.password_hash = None
+        self.keys = keys
+        self.pubkey = None
+        # выданный сервером токен возобновления сеанса и номера событий
+        # списка пользователей: на момент входа и последнего полученного
+        self.resume_token = None
+        self.token_refresh_at = None
+        self.login_sequence = None
+        self.roster_seq = None
+        self.request_ids = count(1)
+        self.pending_requests = OrderedDict()
+        self.requests_lock = Lock()
+        self.deferred_messages = []
+        self.reader_active = False
+        # контакты, чьи закэшированные ключи уже сверены с сервером;
+        # ключ меняется только при входе пользователя, после этого
+        # (или после 205) ключ сверяется заново
+        self.validated_keys = set()
+        self.establish_connection(server_address, server_port)
+        try:
+            self.request_contacts()
+            self.request_user_list()
+            self.roster_seq = self.login_sequence
+        except OSError as e:
+            if e.errno:
+                SOCKET_LOGGER.critical(
+                    'Потеряно соединение с сервером.'
+                )
+                raise ServerError('Потеряно соединение с сервером.')
+            SOCKET_LOGGER.error(
+                'Таймаут соединения с сервером '
+                'при запросе списков пользователей.')
+        except JSONDecodeError:
+            SOCKET_LOGGER.critical('Потеряно соединение с сервером.')
+            raise ServerError('Потеряно соединение с сервером.')
+        self.running = True
+
+    def connect_to_server(self,
+                          ip_address: str,
+                          port: int,
+                          attempts: int = CONNECTION_ATTEMPTS):
+        """
+        Opens the TCP connection to the server.
+        Makes several attempts to do so, if unsuccessful, raises ServerError.
+
+        :param ip_address: server's IP address
+        :param port: server's listening port
+        :param attempts: number of the attempts
+        """
+        self.client_socket = socket(AF_INET, SOCK_STREAM)
+        self.client_socket.settimeout(5)
+        connected = False
+
+        for i in range(attempts):
+            SOCKET_LOGGER.info('Попытка соединения №%d' % (i + 1,))
+            try:
+                self.client_socket.connect((ip_address, port))
+            except (OSError, ConnectionRefusedError):
+                pass
+            else:
+                connected = True
+                break
+            if i + 1 < attempts:
+                sleep(1)
+
+        if not connected:
+            SOCKET_LOGGER.critical(
+                'Не удалось установить соединение с сервером.'
+            )
+            raise ServerError(
+                'Не удалось установить соединение с сервером.'
+            )
+
+    def wait_for_keys(self):
+        """
+        Waits for the client's key if it was given as a future
+        (e.g. it's still being generated) and replaces the future with it.
+        """
+        if isinstance(self.keys, Future):
+            self.keys = self.keys.result()
+
+    def get_password_hash(self) -> bytes:
+        """
+        Returns the hash of the password, it's derived only once
+        and then reused on reconnects.
+        """
+        if self.password_hash is None:
+            password_bytes = self.password.encode('utf-8')
+            salt = self.client_nickname.lower().encode('utf-8')
+            password_hash = pbkdf2_hmac(
+                'sha512',
+                password_bytes,
+                salt,
+                10000
+            )
+            self.password_hash = hexlify(password_hash)
+            SOCKET_LOGGER.debug(
+                'Подготовлен хэш пароля: %s' % self.password_hash
+            )
+        return self.password_hash
+
+    def establish_connection(self,
+                             ip_address: str,
+                             port: int,
+                             attempts: int = CONNECTION_ATTEMPTS):
+        """
+        Establishes connection to the server.
+        If the client's key isn't ready yet, it's awaited after connecting,
+        so the connection is set up meanwhile; if that took longer than
+        the server waits for the presence message, connects again.
+        Then sends the presence message to the server (with the resume
+        token, if the server has issued one), and then, unless the session
+        is resumed by the token, sends the encrypted password to the server
+        to compare to the one stored in the server's DB.
+
+        :param ip_address: server's IP address
+        :param port: server's listening port
+        :param attempts: number of the attempts to connect
+        """
+        self.connect_to_server(ip_address, port, attempts)
+        connected_at = monotonic()
+
+        SOCKET_LOGGER.debug(
+            'Установлено соединение с сервером. '
+            'Начинаю процесс авторизации.'
+        )
+
+        if self.resume_token is None:
+            self.get_password_hash()
+
+        self.wait_for_keys()
+        if monotonic() - connected_at > HANDSHAKE_TIMEOUT - 1:
+            SOCKET_LOGGER.debug(
+                'Ключ готов после таймаута авторизации, '
+                'переподключение к серверу.'
+            )
+            self.client_socket.close()
+            self.connect_to_server(ip_address, port)
+
+        self.pubkey = self.keys.publickey().export_key().decode(
+            'ascii')
+        with self.socket_lock:
+            msg = self.establish_presence()
+            try:
+                send_message(
+                    self.client_socket,
+                    msg
+                )
+                server_response = receive_message(self.client_socket)
+                SOCKET_LOGGER.debug(
+                    'Ответ сервера - %s' % server_response
+                )
+                if RESPONSE in server_response:
+                    if server_response[RESPONSE] == 400:
+                        raise ServerError(server_response[ERROR])
+                    elif server_response[RESPONSE] == SERVER_BUSY:
+                        raise ServerBusyError(
+                            server_response[ERROR],
+                            server_response.get(RETRY_AFTER, 1)
+                        )
+                    elif server_response[RESPONSE] == 511:
+                        resp_data = server_response[DATA]
+                        resp_hash = new(
+                            self.get_password_hash(),
+                            resp_data.encode('utf-8'),
+                            'MD5'
+                        )
+                        digest = resp_hash.digest()
+                        client_response = {
+                            RESPONSE: 511,
+                            DATA: b2a_base64(digest).decode('ascii')
+                        }
+                        send_message(
+                            self.client_socket,
+                            client_response
+                        )
+                        server_response = receive_message(
+                            self.client_socket)
+                        self.process_answer(server_response)
+                    elif server_response[RESPONSE] == 200:
+                        SOCKET_LOGGER.info('Сеанс возобновлен по токену.')
+                    self.resume_token = server_response.get(RESUME_TOKEN)
+                    self.schedule_token_refresh(
+                        server_response.get(TOKEN_TTL))
+                    self.login_sequence = server_response.get(SEQUENCE)
+            except (OSError, JSONDecodeError, IncorrectDataReceivedError):
+                SOCKET_LOGGER.critical(
+                    'В процессе авторизации потеряно '
+                    'соединение с сервером'
+                )
+                raise ServerError(
+                    'В процессе авторизации потеряно '
+                    'соединение с сервером'
+                )
+            else:
+                SOCKET_LOGGER.info('Соединение успешно установлено.')
+
+    def schedule_token_refresh(self, ttl):
+        """
+        Schedules the exchange of the resume token for a new one
+        at the half of its lifetime, so the token is still valid
+        whenever the connection is lost.
+
+        :param ttl: lifetime of the token in seconds, None if the server
+            doesn't say it (the token isn't refreshed then)
+        """
+        self.token_refresh_at = monotonic() + ttl / 2 \
+            if self.resume_token and ttl else None
+
+    def refresh_resume_token(self):
+        """
+        Requests a new resume token if it's time to. The response is
+        handled by the reader thread, so it doesn't wait for it.
+        """
+        if self.token_refresh_at is None \
+                or monotonic() < self.token_refresh_at:
+            return
+        self.token_refresh_at = None
+        future = self.send_request({
+            ACTION: TOKEN_REFRESH,
+            TIME: time(),
+            ACCOUNT_NAME: self.client_nickname
+        })
+        future.add_done_callback(self.token_refreshed)
+
+    def token_refreshed(self, future: Future):
+        """
+        Stores the new resume token from the server's response.
+        If the connection is lost meanwhile, the old token is kept.
+
+        :param future: future of the TOKEN_REFRESH response
+        """
+        if future.exception():
+            return
+        response = future.result()
+        if response.get(RESPONSE) == 200 and RESUME_TOKEN in response:
+            self.resume_token = response[RESUME_TOKEN]
+            self.schedule_token_refresh(response.get(TOKEN_TTL))
+            SOCKET_LOGGER.debug('Получен новый токен возобновления сеанса.')
+
+    @function_log
+    def establish_presence(self) -> dict:
+        """
+        Generates the presence message for the server.
+        """
+        message = {
+            ACTION: PRESENCE,
+            TIME: time(),
+            USER: {
+                ACCOUNT_NAME: self.client_nickname,
+                PUBLIC_KEY: self.pubkey
+            },
+            VERSION: PROTOCOL_VERSION
+        }
+        if self.resume_token:
+            message[RESUME_TOKEN] = self.resume_token
+        SOCKET_LOGGER.debug(
+            "Сформировано %s сообщение для аккаунта %s."
+            % (PRESENCE, self.client_nickname,)
+        )
+        return message
+
+    @function_log
+    def process_answer(self, message: dict):
+        """
+        Processes the server's response.
+        Depending on the response code either: finishes working (200);
+        raises ServerError (400); updates the lists and calls on_contacts_changed (205);
+        applies the users' list event; or processes the message from another user,
+        and passes it to on_message.
+
+        :param message: message to process
+        """
+        SOCKET_LOGGER.debug(
+            "Обработка сообщения от сервера: %s." % message
+        )
+        if RESPONSE in message:
+            if message[RESPONSE] == 200:
+                return
+            elif message[RESPONSE] == 400:
+                raise ServerError(f'400: {message[ERROR]}')
+            elif message[RESPONSE] == 205:
+                self.validated_keys.clear()
+                self.request_user_list()
+                self.request_contacts()
+                self.on_contacts_changed()
+            else:
+                SOCKET_LOGGER.debug(
+                    "Принят неизвестный ответ сервера: %s"
+                    % message[RESPONSE]
+                )
+        elif ACTION in message and message[ACTION] == MESSAGE \
+                and SENDER in message and DESTINATION in message \
+                and MESSAGE_TEXT in message \
+                and message[DESTINATION] == self.client_nickname:
+            SOCKET_LOGGER.info(
+                'Получено сообщение от пользователя %s'
+                % message[SENDER]
+            )
+            self.on_message(message)
+        elif ACTION in message and message[ACTION] == ROSTER_UPDATE \
+                and EVENT in message and ACCOUNT_NAME in message:
+            if self.apply_roster_event(
+                    message[EVENT],
+                    message[ACCOUNT_NAME],
+                    message.get(SEQUENCE)):
+                self.on_contacts_changed()
+
+    def apply_roster_event(self,
+                           event: str,
+                           login: str,
+                           sequence: int = None) -> bool:
+        """
+        Applies the change of the users' list pushed by the server
+        to the client's DB, instead of requesting the whole lists again.
+        The client doesn't track who is online, but a user going online
+        may have a new key, so the cached one has to be checked again.
+        Events numbered not after the last applied one are skipped
+        (they come again after a reconnect). Returns True if the lists
+        have changed.
+
+        :param event: USER_ADDED, USER_REMOVED, USER_ONLINE or USER_OFFLINE
+        :param login: user the event is about
+        :param sequence: number of the event, if the server numbers them
+        """
+        SOCKET_LOGGER.debug(
+            'Событие списка пользователей: %s %s' % (event, login)
+        )
+        if sequence is not None and self.roster_seq is not None:
+            if sequence <= self.roster_seq:
+                return False
+            self.roster_seq = sequence
+        if event == USER_ADDED:
+            if self.database is not None:
+                self.database.add_existing_user(login)
+            return True
+        elif event == USER_REMOVED:
+            self.validated_keys.discard(login)
+            if self.database is not None:
+                self.database.remove_existing_user(login)
+            return True
+        elif event == USER_ONLINE:
+            self.validated_keys.discard(login)
+        return False
+
+    def on_message(self, message: dict):
+        """
+        Called when a message from another user is received.
+
+        :param message: message from another user
+        """
+        if self.message_callback is not None:
+            self.message_callback(message)
+
+    def on_contacts_changed(self):
+        """
+        Called when the contacts or existing users' lists have changed.
+        """
+        if self.contacts_callback is not None:
+            self.contacts_callback()
+
+    def on_connection_lost(self):
+        """
+        Called when the connection to the server is lost.
+        """
+        if self.connection_lost_callback is not None:
+            self.connection_lost_callback()
+
+    def request_contacts(self):
+        """
+        Requests a contact list from the server.
+        If the status code of the server's response is 202, updates
+        the contact list in the client's DB.
+        """
+        SOCKET_LOGGER.debug(
+            'Запрос списка контактов пользователя: %s'
+            % self.client_nickname
+        )
+        if self.database is not None:
+            self.database.cleat_contact_list()
+        request = {
+            ACTION: GET_CONTACTS,
+            TIME: time(),
+            USER: self.client_nickname
+        }
+        SOCKET_LOGGER.debug(
+            'Сформирован запрос к серверу: %s' % request
+        )
+        response = self.exchange(request)
+        SOCKET_LOGGER.debug(
+            'Получен ответ от сервера: %s' % response
+        )
+        if RESPONSE in response and response[RESPONSE] == 202:
+            if self.database is not None:
+                for contact in response[LIST_INFO]:
+                    self.database.add_user_to_contacts(contact)
+        else:
+            SOCKET_LOGGER.error(
+                'Не удалось обновить список контактов.'
+            )
+
+    def request_user_list(self):
+        """
+        Requests a list of existing users from the server.
+        If the status code of the server's response is 202, updates
+        the list in the client's DB.
+        """
+        SOCKET_LOGGER.info(
+            'Пользователь %s запрашивает список всех пользователей.'
+            % self.client_nickname
+        )
+        request = {
+            ACTION: USER_REQUEST,
+            TIME: time(),
+            ACCOUNT_NAME: self.client_nickname
+        }
+        response = self.exchange(request)
+        if RESPONSE in response and response[RESPONSE] == 202:
+            if self.database is not None:
+                self.database.add_existing_users(response[LIST_INFO])
+        else:
+            SOCKET_LOGGER.error(
+                'Не удалось обновить список известных пользователей.'
+            )
+
+    def request_pub_key(self, user: str) -> str:
+        """
+        Returns the public RSA key of a client in user's contact list.
+        The key cached in the DB is returned right away if it has been
+        checked during this session, otherwise its fingerprint is sent
+        to the server: the server answers KEY_NOT_MODIFIED if the key is
+        the same, or 511 with the new key, which is then cached.
+
+        :param user: contact
+        """
+        cached = None
+        if self.database is not None:
+            cached = self.database.get_public_key(user)
+        if cached and user in self.validated_keys:
+            return cached[0]
+        SOCKET_LOGGER.debug(
+            'Запрос публичного ключа для пользователя %s' % user
+        )
+        request = {
+            ACTION: PUBLIC_KEY_REQUEST,
+            TIME: time(),
+            ACCOUNT_NAME: user
+        }
+        if cached:
+            request[FINGERPRINT] = cached[1]
+        response = self.exchange(request)
+        if RESPONSE in response and response[RESPONSE] == KEY_NOT_MODIFIED \
+                and cached:
+            self.validated_keys.add(user)
+            return cached[0]
+        elif RESPONSE in response and response[RESPONSE] == 511:
+            if self.database is not None:
+                self.database.save_public_key(
+                    user, response[DATA], key_fingerprint(response[DATA]))
+            self.validated_keys.add(user)
+            return response[DATA]
+        else:
+            SOCKET_LOGGER.error(
+                'Не удалось получить публичный ключ '
+                'пользователя %s' % user
+            )
+
+    def add_new_contact(self, contact: str):
+        """
+        Handles the adding of a new contact on the socket's side.
+        Generates the relevant message and sends it to the server.
+
+        :param contact: new contact
+        """
+        SOCKET_LOGGER.debug(
+            'Создание нового контакта %s для пользователя %s' %
+            (contact, self.client_nickname,)
+        )
+        request = {
+            ACTION: ADD_CONTACT,
+            TIME: time(),
+            USER: self.client_nickname,
+            ACCOUNT_NAME: contact
+        }
+        self.process_answer(self.exchange(request))
+
+    def remove_contact(self, contact: str):
+        """
+        Handles the adding of a new contact on the socket's side.
+        Generates the relevant message and sends it to the server.
+
+        :param contact: contact to be deleted
+        """
+        SOCKET_LOGGER.debug(
+            'Удаление контакта %s для пользователя %s' %
+            (contact, self.client_nickname,)
+        )
+        request = {
+            ACTION: REMOVE_CONTACT,
+            TIME: time(),
+            USER: self.client_nickname,
+            ACCOUNT_NAME: contact
+        }
+        self.process_answer(self.exchange(request))
+
+    @function_log
+    def shutdown_socket(self):
+        """
+        Handles the socket shutdown. Sets the running flag to False,
+        generates the exit message to the server and sends it.
+        """
+        self.running = False
+        message = {
+            ACTION: EXIT,
+            TIME: time(),
+            ACCOUNT_NAME: self.client_nickname
+        }
+        with self.socket_lock:
+            try:
+                send_message(self.client_socket, message)
+            except OSError:
+                pass
+        SOCKET_LOGGER.debug('Клиентский сокет завершает работу.')
+        sleep(1)
+
+    def create_message(self, recipient: str, message: str):
+        """
+        Creates and sends the dictionary with the message from one client to another.
+
+        :param recipient: message's recipient
+        :param message: message text
+        """
+        message_to_send_dict = {
+            ACTION: MESSAGE,
+            SENDER: self.client_nickname,
+            DESTINATION: recipient,
+            TIME: time(),
+            MESSAGE_TEXT: message
+        }
+        SOCKET_LOGGER.debug(
+            'Сформирован словарь сообщения: %s' %
+            message_to_send_dict
+        )
+        self.process_answer(self.exchange(message_to_send_dict))
+        SOCKET_LOGGER.info(
+            'Отправлено сообщение пользователю %s' % recipient
+        )
+
+    def send_request(self, request: dict) -> Future:
+        """
+        Tags the request with a new id, registers it in the table of
+        pending requests and sends it to the server. Returns the future
+        the response will be set to, so several requests can be in flight
+        at the same time. The lock only keeps the frames from interleaving.
+
+        :param request: request to be sent
+        """
+        future = Future()
+        with self.requests_lock:
+            request_id = next(self.request_ids)
+            self.pending_requests[request_id] = future
+        request[REQUEST_ID] = request_id
+        try:
+            with self.socket_lock:
+                send_message(self.client_socket, request)
+        except OSError:
+            self.forget_request(request_id)
+            raise
+        return future
+
+    def forget_request(self, request_id: int):
+        """
+        Removes the request from the table of pending requests.
+
+        :param request_id: id of the request
+        """
+        with self.requests_lock:
+            self.pending_requests.pop(request_id, None)
+
+    def exchange(self, request: dict) -> dict:
+        """
+        Sends the request to the server and returns the server's response.
+        Once the reader thread is running, the response is set by the reader,
+        otherwise it's read from the socket directly and any other messages
+        received meanwhile are put aside for the reader.
+
+        :param request: request to be sent
+        """
+        future = self.send_request(request)
+        if not self.reader_active:
+            with self.socket_lock:
+                while not self.reader_active and not future.done():
+                    message = receive_message(self.client_socket)
+                    if not self.resolve_request(message):
+                        self.deferred_messages.append(message)
+        try:
+            return future.result(timeout=RESPONSE_TIMEOUT)
+        except FutureTimeoutError:
+            self.forget_request(request[REQUEST_ID])
+            raise TimeoutError('Сервер не ответил на запрос.')
+
+    def resolve_request(self, message: dict) -> bool:
+        """
+        Sets the response to the future of the pending request it belongs to.
+        Responses are matched by the request id; responses without one
+        (from a server that doesn't support the ids) are matched
+        to the oldest pending request. Returns False if the message
+        isn't a response to any request.
+
+        :param message: message from the server
+        """
+        if ACTION in message or RESPONSE not in message \
+                or message[RESPONSE] == 205:
+            return False
+        with self.requests_lock:
+            if REQUEST_ID in message:
+                future = self.pending_requests.pop(message[REQUEST_ID], None)
+            elif self.pending_requests:
+                _, future = self.pending_requests.popitem(last=False)
+            else:
+                future = None
+        if future is None:
+            return False
+        future.set_result(message)
+        return True
+
+    def fail_pending_requests(self):
+        """
+        Fails all the pending requests when the connection is lost.
+        """
+        with self.requests_lock:
+            futures = list(self.pending_requests.values())
+            self.pending_requests.clear()
+        for future in futures:
+            future.set_exception(ConnectionResetError(
+                ECONNRESET, 'Потеряно соединение с сервером.'))
+
+    def dispatch(self, message: dict):
+        """
+        Routes the message received by the reader thread.
+        Responses go to the pending requests, messages from other users
+        are processed right away and the 205 notification is processed
+        in a separate thread (it makes requests of its own).
+
+        :param message: message from the server
+        """
+        if self.resolve_request(message):
+            return
+        if ACTION in message:
+            self.process_answer(message)
+        elif RESPONSE in message and message[RESPONSE] == 205:
+            Thread(
+                target=self.process_answer,
+                args=(message,),
+                daemon=True
+            ).start()
+        else:
+            SOCKET_LOGGER.debug(
+                'Получен ответ на неизвестный запрос: %s' % message
+            )
+
+    def run(self):
+        """
+        The reader thread of the client's app.
+        Reads the messages until the connection is lost, then reconnects
+        and goes on reading. If reconnecting fails, calls on_connection_lost.
+        """
+        SOCKET_LOGGER.debug(
+            'Запущен процесс приема сообщений с сервера.'
+        )
+        while self.running:
+            try:
+                self.read_messages()
+            except (OSError,
+                    ValueError,
+                    JSONDecodeError,
+                    IncorrectDataReceivedError,
+                    TypeError):
+                if not self.running:
+                    break
+                SOCKET_LOGGER.error('Потеряно соединение с сервером.')
+                with self.socket_lock:
+                    self.reader_active = False
+                self.fail_pending_requests()
+                if not self.reconnect() and self.running:
+                    SOCKET_LOGGER.critical(
+                        'Не удалось восстановить соединение с сервером.'
+                    )
+                    self.running = False
+                    self.on_connection_lost()
+
+    def read_messages(self):
+        """
+        While the running flag is True, waits for the socket to become
+        readable and dispatches every message received, starting with
+        the ones received before the reader took over. The socket lock isn't
+        held while waiting, so sending never waits for the reader.
+        The resume token is refreshed from here when it's due.
+        """
+        with self.socket_lock:
+            self.reader_active = True
+            pending = self.deferred_messages + \
+                take_buffered_messages(self.client_socket)
+            self.deferred_messages = []
+        for message in pending:
+            self.dispatch(message)
+        while self.running:
+            readable, _, _ = select([self.client_socket], [], [], 1)
+            self.refresh_resume_token()
+            if not readable or not self.running:
+                continue
+            for message in receive_messages(self.client_socket):
+                SOCKET_LOGGER.debug(
+                    'Принято сообщение с сервера: %s' % message
+                )
+                self.dispatch(message)
+
+    def reconnect(self) -> bool:
+        """
+        Reconnects to the server after the connection is lost, pausing
+        before every attempt for a random time that grows exponentially.
+        If the server is busy, the pause is at least as long as it says.
+        The session is resumed by the token if possible, and the lists
+        are synchronized. Returns True if the connection is restored.
+        """
+        retry_after = 0
+        for attempt in range(RECONNECT_ATTEMPTS):
+            delay = retry_after + uniform(0, min(
+                RECONNECT_MAX_DELAY,
+                RECONNECT_BASE_DELAY * 2 ** attempt
+            ))
+            retry_after = 0
+            SOCKET_LOGGER.info(
+                'Попытка переподключения №%d через %.1f с.' %
+                (attempt + 1, delay)
+            )
+            sleep(delay)
+            if not self.running:
+                return False
+            self.client_socket.close()
+            try:
+                self.establish_connection(
+                    self.server_address, self.server_port, 1)
+                self.synchronize_lists()
+            except ServerBusyError as e:
+                SOCKET_LOGGER.info(
+                    'Сервер перегружен, повтор через %s с.' % e.retry_after)
+                retry_after = e.retry_after
+                continue
+            except (OSError,
+                    ServerError,
+                    JSONDecodeError,
+                    IncorrectDataReceivedError):
+                continue
+            SOCKET_LOGGER.info('Соединение с сервером восстановлено.')
+            return True
+        return False
+
+    def synchronize_lists(self):
+        """
+        Brings the users' lists up to date after a reconnect.
+        Only the events missed while the client was away are requested;
+        if the server doesn't have them anymore (or doesn't support that),
+        the whole lists are requested again.
+        """
+        if self.roster_seq is not None:
+            response = self.exchange({
+                ACTION: ROSTER_SYNC,
+                TIME: time(),
+                ACCOUNT_NAME: self.client_nickname,
+                SEQUENCE: self.roster_seq
+            })
+            if RESPONSE in response and response[RESPONSE] == 202:
+                changed = False
+                for sequence, event, login in response[LIST_INFO]:
+                    if self.apply_roster_event(event, login, sequence):
+                        changed = True
+                self.roster_seq = max(
+                    self.roster_seq, response.get(SEQUENCE, 0))
+                SOCKET_LOGGER.debug(
+                    'Получено пропущенных событий списка пользователей: '
+                    '%d' % len(response[LIST_INFO])
+                )
+                if changed:
+                    self.on_contacts_changed()
+                return
+        self.validated_keys.clear()
+        self.request_contacts()
+        self.request_user_list()
+        self.roster_seq = self.login_sequence
+        self.on_contacts_changed()
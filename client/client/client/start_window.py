@@ -2,7 +2,7 @@
 GUI window to log into client's account.
 """
 from PyQt5.QtWidgets import QDialog, QLabel, QLineEdit, \
-    QPushButton, qApp
+    QPushButton, QProgressBar, qApp
 
 
 class ClientLoginDialog(QDialog):
@@ -54,8 +54,35 @@ class ClientLoginDialog(QDialog):
         self.cancel_btn.move(130, 120)
         self.cancel_btn.clicked.connect(qApp.exit)
 
+        self.status_label = QLabel(self)
+        self.status_label.setFixedSize(200, 15)
+        self.status_label.move(10, 115)
+        self.status_label.hide()
+
+        self.progress = QProgressBar(self)
+        self.progress.setFixedSize(200, 15)
+        self.progress.move(10, 135)
+        self.progress.setRange(0, 0)
+        self.progress.setTextVisible(False)
+        self.progress.hide()
+
         self.show()
 
+    def show_progress(self, text: str):
+        """
+        Replaces the buttons with the busy indicator and the status text
+        while the client is preparing to log in.
+
+        :param text: what the client is doing
+        """
+        self.nickname.setDisabled(True)
+        self.password.setDisabled(True)
+        self.ok_btn.hide()
+        self.cancel_btn.hide()
+        self.status_label.setText(text)
+        self.status_label.show()
+        self.progress.show()
+
     def btn_click(self):
         """
         Handles the click on the OK button, changes the flag to True.
@@ -1,9 +1,10 @@
 """
 Logging decorators used in the project.
 """
-from inspect import stack
-from logging import getLogger
-from sys import argv, path
+from functools import wraps
+from itertools import count
+from logging import getLogger, DEBUG
+from sys import argv, path, _getframe
 
 import logs.client_log_config
 import logs.server_log_config
@@ -14,27 +15,40 @@ else:
     LOGGER = getLogger('client')
 
 
-def function_log(func):
+def function_log(func=None, *, sample_rate: int = 1):
     """
-    The decorator function
+    The decorator function.
+    Can be used both as @function_log and as @function_log(sample_rate=N),
+    in the latter case only every N-th call gets logged.
+    When the logger isn't enabled for DEBUG, the wrapper only checks
+    the level and calls the function: the arguments aren't formatted
+    and the caller isn't looked up.
+
+    :param func: decorated function
+    :param sample_rate: log only one call out of this many
     """
+    if func is None:
+        return lambda decorated: function_log(
+            decorated, sample_rate=sample_rate)
+
+    calls = count()
 
+    @wraps(func)
     def wrapper(*args, **kwargs):
         """
         Main function that does all the logging.
         """
-        LOGGER.debug(
-            'Функция %s была вызвана в модуле %s с '
-            'параметрами (%s, %s). Вызов произошел из функции %s.' %
-            (
+        if LOGGER.isEnabledFor(DEBUG) and \
+                (sample_rate == 1 or next(calls) % sample_rate == 0):
+            LOGGER.debug(
+                'Функция %s была вызвана в модуле %s с '
+                'параметрами (%s, %s). Вызов произошел из функции %s.',
                 func.__name__,
                 func.__module__,
                 args,
                 kwargs,
-                stack()[1][3]
-            ),
-        )
-        result = func(*args, **kwargs)
-        return result
+                _getframe(1).f_code.co_name
+            )
+        return func(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,87 @@
+"""
+SQLite tuning shared by the server's and the client's databases.
+The settings are read from the STORAGE section of the app's config file
+and applied as PRAGMAs to every new connection of the engine.
+"""
+from configparser import ConfigParser
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# секция файла настроек с параметрами хранилища
+STORAGE_SECTION = 'STORAGE'
+
+# значения по умолчанию: WAL-журнал (читатели не блокируют писателя),
+# fsync только при контрольных точках, кэш 16 МБ, mmap 64 МБ
+# и ожидание блокировки до 5 секунд вместо немедленной ошибки
+DEFAULT_STORAGE_SETTINGS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': '-16000',
+    'mmap_size': '67108864',
+    'busy_timeout': '5000',
+}
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+
+def read_storage_settings(config: ConfigParser) -> dict:
+    """
+    Returns the storage settings from the config's STORAGE section,
+    the missing ones are taken from DEFAULT_STORAGE_SETTINGS.
+
+    :param config: parsed config file of the app
+    """
+    settings = dict(DEFAULT_STORAGE_SETTINGS)
+    if config.has_section(STORAGE_SECTION):
+        for name in settings:
+            settings[name] = config[STORAGE_SECTION].get(
+                name, settings[name]).strip()
+    return settings
+
+
+def storage_pragmas(settings: dict) -> list:
+    """
+    Validates the storage settings and returns the list of PRAGMA
+    statements to be run on a new connection.
+    Raises ValueError if a setting has an unsupported value.
+
+    :param settings: storage settings, see DEFAULT_STORAGE_SETTINGS
+    """
+    settings = dict(DEFAULT_STORAGE_SETTINGS, **settings)
+    journal_mode = settings['journal_mode'].lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(
+            'Недопустимый режим журнала: %s' % settings['journal_mode'])
+    synchronous = settings['synchronous'].lower()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(
+            'Недопустимый уровень synchronous: %s' %
+            settings['synchronous'])
+    return [
+        'PRAGMA journal_mode=%s' % journal_mode,
+        'PRAGMA synchronous=%s' % synchronous,
+        'PRAGMA cache_size=%d' % int(settings['cache_size']),
+        'PRAGMA mmap_size=%d' % int(settings['mmap_size']),
+        'PRAGMA busy_timeout=%d' % int(settings['busy_timeout']),
+    ]
+
+
+def apply_storage_settings(engine: Engine, settings: dict = None):
+    """
+    Makes the engine run the storage PRAGMAs on every new connection.
+
+    :param engine: SQLAlchemy engine of the SQLite database
+    :param settings: storage settings, the defaults are used if None
+    """
+    pragmas = storage_pragmas(settings or {})
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the per-call overhead of the function_log decorator.
+Compares the current implementation with the previous one, which called
+inspect.stack() and formatted the arguments on every call.
+
+Run it from the server's directory:
+    python -m benchmarks.function_log_overhead
+"""
+from inspect import stack
+from logging import INFO, DEBUG, NullHandler
+from timeit import Timer
+
+from utils.decorators import LOGGER, function_log
+
+
+def legacy_function_log(func):
+    """
+    The previous version of the decorator, kept here for comparison.
+    """
+
+    def wrapper(*args, **kwargs):
+        LOGGER.debug(
+            'Функция %s была вызвана в модуле %s с '
+            'параметрами (%s, %s). Вызов произошел из функции %s.' %
+            (
+                func.__name__,
+                func.__module__,
+                args,
+                kwargs,
+                stack()[1][3]
+            ),
+        )
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def target(message: dict) -> dict:
+    """
+    Function to be decorated, does nothing.
+    """
+    return message
+
+
+def measure(func) -> float:
+    """
+    Returns the best time of a single call in microseconds.
+
+    :param func: function to be called
+    """
+    message = {'action': 'presence', 'time': 1.0}
+    timer = Timer(lambda: func(message))
+    number, _ = timer.autorange()
+    return min(timer.repeat(3, number)) / number * 1e6
+
+
+def main():
+    """
+    Runs the measurements with DEBUG disabled and enabled and prints the table.
+    The records are sent to a NullHandler, so only the cost of the
+    decorator and of the logging module itself is measured.
+    """
+    variants = (
+        ('без декоратора', target),
+        ('старый function_log', legacy_function_log(target)),
+        ('новый function_log', function_log(target)),
+        ('новый, sample_rate=100',
+         function_log(sample_rate=100)(target)),
+    )
+    handlers, level = LOGGER.handlers[:], LOGGER.level
+    LOGGER.handlers = [NullHandler()]
+    try:
+        for title, logging_level in (('DEBUG выключен', INFO),
+                                     ('DEBUG включен', DEBUG)):
+            LOGGER.setLevel(logging_level)
+            print(f'{title}:')
+            for name, func in variants:
+                print(f'    {name:<25} {measure(func):10.2f} мкс/вызов')
+    finally:
+        LOGGER.handlers, LOGGER.level = handlers, level
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,506 @@
+"""
+Load generator for the server.
+Registers the simulated users in a fresh DB, starts server.py (headless)
+on the loopback interface and runs thousands of JIM clients on a single
+asyncio loop against it. Every client logs in with the real pbkdf2/HMAC
+challenge and then sends a configurable mix of requests, one at a time.
+The clients turned away by the server (SERVER_BUSY) log in again after
+the pause the server asks for. Reports the throughput, p50/p99/p999
+latency per request type and the number of errors and of the logins
+turned away.
+
+Run it from the server's directory (the generator itself logs to logs/):
+    python -m benchmarks.load_generator --clients 1000 --duration 30
+    python -m benchmarks.load_generator --engine asyncio \
+        --mix message=50,contacts=20,users=10,pubkey=20 --json result.json
+"""
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser
+from base64 import b64encode
+from binascii import hexlify, b2a_base64
+from collections import defaultdict
+from configparser import ConfigParser
+from hashlib import pbkdf2_hmac
+from hmac import new
+from math import ceil
+from tempfile import TemporaryDirectory
+from time import perf_counter, time, sleep
+
+from server.database import ServerDatabase
+from utils.constants import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, \
+    PUBLIC_KEY, VERSION, PROTOCOL_VERSION, RESPONSE, DATA, ERROR, MESSAGE, \
+    SENDER, DESTINATION, MESSAGE_TEXT, GET_CONTACTS, USER_REQUEST, \
+    PUBLIC_KEY_REQUEST, REQUEST_ID, SERVER_BUSY, RETRY_AFTER
+from utils.utils import encode_message, receive_message_async
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'load-test'
+REQUEST_TIMEOUT = 10
+DEFAULT_MIX = 'message=70,contacts=10,users=10,pubkey=10'
+REQUEST_TYPES = ('message', 'contacts', 'users', 'pubkey')
+
+
+def get_args():
+    """
+    Parses the command line arguments of the load generator.
+    """
+    arg_parser = ArgumentParser(
+        description='Нагрузочный тест сервера на петлевом интерфейсе.')
+    arg_parser.add_argument(
+        '-c', '--clients', type=int, default=200,
+        help='число одновременных клиентов')
+    arg_parser.add_argument(
+        '-d', '--duration', type=float, default=10,
+        help='длительность нагрузки в секундах (без учета входа)')
+    arg_parser.add_argument(
+        '-e', '--engine', default='selectors',
+        choices=['selectors', 'asyncio'],
+        help='реализация сервера')
+    arg_parser.add_argument(
+        '-m', '--mix', default=DEFAULT_MIX,
+        help='доли запросов: message, contacts, users, pubkey')
+    arg_parser.add_argument(
+        '-r', '--rate', type=float, default=0,
+        help='запросов в секунду на клиента (0 - без пауз)')
+    arg_parser.add_argument(
+        '-s', '--message-size', type=int, default=256,
+        help='размер текста сообщения в байтах')
+    arg_parser.add_argument(
+        '--connect-concurrency', type=int, default=50,
+        help='сколько клиентов входят одновременно')
+    arg_parser.add_argument(
+        '--json', dest='json_path',
+        help='сохранить результаты в JSON-файл')
+    return arg_parser.parse_args()
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parses the request mix like 'message=70,contacts=10,...'
+    into a dictionary of weights.
+
+    :param mix: request mix from the command line
+    """
+    weights = dict.fromkeys(REQUEST_TYPES, 0)
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in weights:
+            raise ValueError('Неизвестный тип запроса: %s' % name)
+        weights[name.strip()] = float(weight)
+    if not any(weights.values()):
+        raise ValueError('Все доли запросов нулевые.')
+    return weights
+
+
+def password_hash(login: str) -> bytes:
+    """
+    Returns the password hash of the user, the same way the client does.
+
+    :param login: user's nickname
+    """
+    return hexlify(pbkdf2_hmac(
+        'sha512',
+        PASSWORD.encode('utf-8'),
+        login.lower().encode('utf-8'),
+        10000
+    ))
+
+
+def register_users(db_file: str, logins: list) -> dict:
+    """
+    Registers the users in the server's DB and returns
+    the dictionary of their password hashes.
+
+    :param db_file: path to the server's DB
+    :param logins: users' nicknames
+    """
+    database = ServerDatabase(db_file)
+    hashes = dict()
+    for login in logins:
+        hashes[login] = password_hash(login)
+        database.register_user(login, hashes[login])
+    database.engine.dispose()
+    return hashes
+
+
+def free_port() -> int:
+    """
+    Returns a free TCP port on the loopback interface.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory: str, db_file: str, port: int, engine: str):
+    """
+    Starts headless server.py in the directory and waits
+    until it accepts connections.
+
+    :param directory: working directory of the server
+    :param db_file: path to the server's DB
+    :param port: server's port
+    :param engine: server's engine
+    """
+    config = ConfigParser()
+    config['SETTINGS'] = {
+        'db_path': '',
+        'db_file': db_file,
+        'default_port': str(port),
+        'listen_address': '127.0.0.1',
+    }
+    with open(os.path.join(directory, 'server_config.ini'), 'w') as file:
+        config.write(file)
+    os.mkdir(os.path.join(directory, 'logs'))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SERVER_DIR, 'server.py'),
+         '--no_gui', '-e', engine],
+        cwd=directory,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError('Сервер завершился при запуске.')
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return process
+        except OSError:
+            sleep(0.05)
+    process.kill()
+    raise RuntimeError('Сервер не запустился.')
+
+
+def percentile(values: list, share: float) -> float:
+    """
+    Returns the percentile of the sorted values (nearest rank).
+
+    :param values: sorted list of values
+    :param share: percentile as a share, e.g. 0.99
+    """
+    if not values:
+        return 0
+    return values[max(ceil(share * len(values)) - 1, 0)]
+
+
+class Stats:
+    """
+    Latencies and error counters collected by the simulated clients.
+    """
+
+    def __init__(self):
+        """
+        Creates empty counters.
+        """
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.delivered = 0
+        self.turned_away = 0
+
+    def report(self, duration: float) -> dict:
+        """
+        Returns the summary of the collected results.
+
+        :param duration: duration of the load phase in seconds
+        """
+        summary = dict()
+        for name, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            summary[name] = {
+                'count': len(latencies),
+                'throughput': len(latencies) / duration
+                if name != 'login' else None,
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'p999_ms': percentile(latencies, 0.999) * 1000,
+            }
+        return {
+            'requests': summary,
+            'errors': dict(self.errors),
+            'delivered_messages': self.delivered,
+            'turned_away_logins': self.turned_away,
+        }
+
+
+class SimulatedClient:
+    """
+    A single JIM client driven by the load generator.
+    """
+
+    def __init__(self, login: str, pwd_hash: bytes, stats: Stats, args):
+        """
+        Initialization of the client.
+
+        :param login: user's nickname
+        :param pwd_hash: user's password hash
+        :param stats: shared results
+        :param args: parsed command line arguments
+        """
+        self.login = login
+        self.pwd_hash = pwd_hash
+        self.peers = [login]
+        self.stats = stats
+        self.args = args
+        self.reader = None
+        self.writer = None
+        self.request_ids = 0
+        self.pending = dict()
+
+    async def connect(self, port: int):
+        """
+        Connects to the server and logs in with the challenge-response.
+        If the server is busy, connects again after the pause it asks for
+        (the login latency includes the pauses).
+
+        :param port: server's port
+        """
+        started = perf_counter()
+        while True:
+            self.reader, self.writer = await asyncio.open_connection(
+                '127.0.0.1', port)
+            self.writer.write(encode_message({
+                ACTION: PRESENCE,
+                TIME: time(),
+                USER: {
+                    ACCOUNT_NAME: self.login,
+                    PUBLIC_KEY: 'public key of %s' % self.login
+                },
+                VERSION: PROTOCOL_VERSION
+            }))
+            challenge = await receive_message_async(self.reader)
+            if challenge.get(RESPONSE) != SERVER_BUSY:
+                break
+            self.writer.close()
+            self.stats.turned_away += 1
+            await asyncio.sleep(
+                challenge.get(RETRY_AFTER, 1) * random.uniform(1, 2))
+        if challenge.get(RESPONSE) != 511:
+            raise ConnectionError(challenge.get(ERROR))
+        digest = new(
+            self.pwd_hash, challenge[DATA].encode('utf-8'), 'MD5').digest()
+        self.writer.write(encode_message({
+            RESPONSE: 511,
+            DATA: b2a_base64(digest).decode('ascii')
+        }))
+        response = await receive_message_async(self.reader)
+        if response.get(RESPONSE) != 200:
+            raise ConnectionError(response.get(ERROR))
+        self.stats.latencies['login'].append(perf_counter() - started)
+
+    def make_request(self, kind: str) -> dict:
+        """
+        Builds the request of the given type.
+
+        :param kind: one of REQUEST_TYPES
+        """
+        if kind == 'message':
+            text = b64encode(os.urandom(self.args.message_size * 3 // 4))
+            return {
+                ACTION: MESSAGE,
+                SENDER: self.login,
+                DESTINATION: random.choice(self.peers),
+                TIME: time(),
+                MESSAGE_TEXT: text.decode('ascii')
+            }
+        if kind == 'contacts':
+            return {ACTION: GET_CONTACTS, TIME: time(), USER: self.login}
+        if kind == 'users':
+            return {
+                ACTION: USER_REQUEST, TIME: time(), ACCOUNT_NAME: self.login}
+        return {
+            ACTION: PUBLIC_KEY_REQUEST,
+            TIME: time(),
+            ACCOUNT_NAME: random.choice(self.peers)
+        }
+
+    async def read_responses(self):
+        """
+        Reads everything the server sends, resolving the pending requests
+        by their ids and counting the messages from other clients.
+        When the connection breaks, the pending requests fail.
+        """
+        try:
+            while True:
+                message = await receive_message_async(self.reader)
+                if ACTION in message:
+                    if message[ACTION] == MESSAGE:
+                        self.stats.delivered += 1
+                    continue
+                future = self.pending.pop(message.get(REQUEST_ID), None)
+                if future and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as error:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(str(error)))
+            self.pending.clear()
+
+    async def drive(self, weights: dict, deadline: float):
+        """
+        Sends the requests one by one until the deadline.
+
+        :param weights: request mix
+        :param deadline: loop time to stop at
+        """
+        loop = asyncio.get_running_loop()
+        kinds, shares = zip(*weights.items())
+        reader_task = asyncio.ensure_future(self.read_responses())
+        try:
+            while loop.time() < deadline:
+                kind = random.choices(kinds, shares)[0]
+                request = self.make_request(kind)
+                self.request_ids += 1
+                request[REQUEST_ID] = self.request_ids
+                future = loop.create_future()
+                self.pending[self.request_ids] = future
+                started = perf_counter()
+                self.writer.write(encode_message(request))
+                if reader_task.done():
+                    raise ConnectionError('соединение закрыто')
+                try:
+                    response = await asyncio.wait_for(
+                        future, REQUEST_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.stats.errors['timeout'] += 1
+                    self.pending.pop(request[REQUEST_ID], None)
+                    continue
+                self.stats.latencies[kind].append(perf_counter() - started)
+                if response.get(RESPONSE) not in (200, 202, 511):
+                    self.stats.errors['%s: %s' % (
+                        kind, response.get(ERROR))] += 1
+                if self.args.rate:
+                    await asyncio.sleep(1 / self.args.rate)
+        finally:
+            reader_task.cancel()
+            self.writer.close()
+
+
+async def run_clients(port: int, hashes: dict, args) -> tuple:
+    """
+    Logs all the clients in and then runs the traffic for the
+    configured duration. Returns the results and the duration of
+    the load phase.
+
+    :param port: server's port
+    :param hashes: users' password hashes
+    :param args: parsed command line arguments
+    """
+    stats = Stats()
+    logins = list(hashes)
+    clients = [
+        SimulatedClient(login, hashes[login], stats, args)
+        for login in logins
+    ]
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with semaphore:
+            try:
+                await client.connect(port)
+                return client
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                stats.errors['login'] += 1
+
+    connected = [
+        client for client in await asyncio.gather(
+            *(connect(client) for client in clients))
+        if client
+    ]
+    online = [client.login for client in connected]
+    for client in connected:
+        # каждый клиент пишет небольшому кругу собеседников в сети
+        peers = random.sample(online, min(51, len(online)))
+        client.peers = [peer for peer in peers if peer != client.login] \
+            or [client.login]
+
+    weights = {kind: weight for kind, weight in
+               parse_mix(args.mix).items() if weight}
+    started = asyncio.get_running_loop().time()
+    deadline = started + args.duration
+    results = await asyncio.gather(
+        *(client.drive(weights, deadline) for client in connected),
+        return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            stats.errors['connection'] += 1
+    duration = asyncio.get_running_loop().time() - started
+    return stats, duration
+
+
+def print_report(report: dict, args):
+    """
+    Prints the results table.
+
+    :param report: summary of the results
+    :param args: parsed command line arguments
+    """
+    print(f'Клиентов: {args.clients}, сервер: {args.engine}, '
+          f'смесь: {args.mix}')
+    print(f'{"запрос":<10}{"всего":>9}{"в сек":>10}'
+          f'{"p50, мс":>10}{"p99, мс":>10}{"p999, мс":>10}')
+    total = 0
+    for name, row in report['requests'].items():
+        throughput = '' if row['throughput'] is None \
+            else f'{row["throughput"]:.0f}'
+        if name != 'login':
+            total += row['throughput']
+        print(f'{name:<10}{row["count"]:>9}{throughput:>10}'
+              f'{row["p50_ms"]:>10.2f}{row["p99_ms"]:>10.2f}'
+              f'{row["p999_ms"]:>10.2f}')
+    print(f'Всего запросов в секунду: {total:.0f}')
+    print(f'Доставлено сообщений: {report["delivered_messages"]}')
+    print(f'Отказов при входе (сервер перегружен): '
+          f'{report["turned_away_logins"]}')
+    print(f'Ошибки: {report["errors"] or "нет"}')
+
+
+def main():
+    """
+    Prepares the DB, starts the server, runs the load and prints
+    (and optionally saves) the results.
+    """
+    args = get_args()
+    parse_mix(args.mix)
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    logins = ['load_user_%d' % number for number in range(args.clients)]
+    with TemporaryDirectory() as directory:
+        db_file = os.path.join(directory, 'load.sqlite3')
+        print('Регистрация пользователей...')
+        hashes = register_users(db_file, logins)
+        port = free_port()
+        server = start_server(directory, db_file, port, args.engine)
+        try:
+            stats, duration = asyncio.run(run_clients(port, hashes, args))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            try:
+                server.wait(30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    report = stats.report(duration)
+    report['duration'] = duration
+    report['clients'] = args.clients
+    report['engine'] = args.engine
+    report['mix'] = args.mix
+    print_report(report, args)
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(report, file, indent=4, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the server's startup time and memory, with and without the GUI.
+Every run is a fresh interpreter in a temporary directory that goes through
+the same steps as server.main_cycle: imports server.py, opens the DB,
+starts the server thread and, in the GUI mode, creates the main window.
+It reports the time it took and the peak resident memory of the process.
+The GUI mode uses the offscreen Qt platform unless QT_QPA_PLATFORM is set.
+
+Run it from the server's directory:
+    python -m benchmarks.server_startup
+"""
+import os
+import socket
+import subprocess
+import sys
+from statistics import median
+from tempfile import TemporaryDirectory
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+STARTUP_SCRIPT = '''
+import sys
+from time import perf_counter
+started = perf_counter()
+
+from importlib.util import spec_from_file_location, module_from_spec
+from resource import getrusage, RUSAGE_SELF
+
+sys.path.insert(0, {server_dir!r})
+spec = spec_from_file_location('server_main', {server_script!r})
+server_main = module_from_spec(spec)
+spec.loader.exec_module(server_main)
+
+config = server_main.get_config_params()
+database = server_main.ServerDatabase('serverdb.sqlite3')
+server = server_main.MessagingServer('127.0.0.1', {port}, database)
+server.start()
+if {gui}:
+    from PyQt5.QtWidgets import QApplication
+    from server.gui import MainWindow
+    app = QApplication(sys.argv)
+    window = MainWindow(server, database, config)
+    app.processEvents()
+elapsed = perf_counter() - started
+print(elapsed, getrusage(RUSAGE_SELF).ru_maxrss)
+server.stop()
+server.join()
+'''
+
+
+def free_port() -> int:
+    """
+    Returns a free TCP port on the loopback interface.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure(gui: bool) -> tuple:
+    """
+    Starts the server once and returns the startup time in seconds
+    and the peak resident memory in kilobytes.
+
+    :param gui: start the server with the GUI
+    """
+    script = STARTUP_SCRIPT.format(
+        server_dir=SERVER_DIR,
+        server_script=os.path.join(SERVER_DIR, 'server.py'),
+        port=free_port(),
+        gui=gui
+    )
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    with TemporaryDirectory() as directory:
+        os.mkdir(os.path.join(directory, 'logs'))
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=directory,
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout.split()
+    return float(output[-2]), int(output[-1])
+
+
+def main():
+    """
+    Runs the measurements for both modes and prints the medians.
+    """
+    for title, gui in (('без GUI (--no_gui)', False), ('с GUI', True)):
+        results = [measure(gui) for _ in range(RUNS)]
+        startup_time = median(result[0] for result in results)
+        memory = median(result[1] for result in results)
+        print(f'{title}:')
+        print(f'    время запуска {startup_time * 1000:8.1f} мс')
+        print(f'    память (RSS)  {memory / 1024:8.1f} МБ')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,21 +4,27 @@ command line arguments, configuration file and the main loop.
 The main server loop works the following way:
 first it acquires the launch and configuration parameters, then
 launches the server thread and initializes the GUI.
+PyQt5 is imported only when the GUI is started, so the headless mode
+(--no_gui) doesn't need Qt at all.
 """
 import os
+import signal
 from argparse import ArgumentParser
 from configparser import ConfigParser
 from logging import getLogger
-from sys import argv
-
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QApplication
+from sys import argv, exit as sys_exit
+from threading import Event
 
+from server.admission import AdmissionController, \
+    DEFAULT_MAX_HANDSHAKES, DEFAULT_ACCEPT_RATE, DEFAULT_ACCEPT_BURST, \
+    DEFAULT_MAX_TURNED_AWAY
+from server.async_core import AsyncMessagingServer
 from server.core import MessagingServer
-from server.gui import MainWindow
 from server.database import ServerDatabase
-from utils.constants import DEFAULT_CONNECTION_PORT
+from server.tokens import TokenIssuer, DEFAULT_TOKEN_TTL
+from utils.constants import DEFAULT_CONNECTION_PORT, HANDSHAKE_TIMEOUT
 from utils.decorators import function_log
+from utils.storage import read_storage_settings
 
 SERVER_LOGGER = getLogger('server')
 
@@ -55,12 +61,20 @@ def get_launch_params(def_address: str, def_port: str) -> tuple:
         '--no_gui',
         action='store_true'
     )
+    arg_parser.add_argument(
+        '-e',
+        '--engine',
+        default='selectors',
+        choices=['selectors', 'asyncio'],
+        help='реализация сервера: selectors (по умолчанию) или asyncio.'
+    )
     namespace = arg_parser.parse_args(argv[1:])
     server_address = namespace.addr
     server_port = namespace.port
     gui_flag = namespace.no_gui
+    engine = namespace.engine
     SERVER_LOGGER.info('Аргументы загружены')
-    return server_address, server_port, gui_flag
+    return server_address, server_port, gui_flag, engine
 
 
 @function_log
@@ -80,9 +94,68 @@ def get_config_params() -> ConfigParser:
         config.set(
             'SETTINGS', 'default_port', str(DEFAULT_CONNECTION_PORT))
         config.set('SETTINGS', 'listen_address', '')
+        config.set('SETTINGS', 'history_flush_interval', '5')
+        config.set('SETTINGS', 'history_flush_count', '100')
+        config.set('SETTINGS', 'user_cache_size', '1024')
+        config.set('SETTINGS', 'offline_queue_limit', '100')
+        config.set('SETTINGS', 'offline_message_ttl', '604800')
+        config.set('SETTINGS', 'token_secret_file', 'server_token.key')
+        config.set('SETTINGS', 'resume_token_ttl', str(DEFAULT_TOKEN_TTL))
+        config.set(
+            'SETTINGS', 'max_handshakes', str(DEFAULT_MAX_HANDSHAKES))
+        config.set('SETTINGS', 'accept_rate', str(DEFAULT_ACCEPT_RATE))
+        config.set('SETTINGS', 'accept_burst', str(DEFAULT_ACCEPT_BURST))
+        config.set(
+            'SETTINGS', 'max_turned_away', str(DEFAULT_MAX_TURNED_AWAY))
         return config
 
 
+def run_headless(server):
+    """
+    Waits until the server is asked to stop with SIGTERM or SIGINT
+    (or until the server thread dies), then stops the server.
+
+    :param server: running server thread
+    """
+    stop_requested = Event()
+
+    def request_stop(signum, frame):
+        SERVER_LOGGER.info(
+            'Получен сигнал %s, сервер завершает работу.' % signum)
+        stop_requested.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    SERVER_LOGGER.info('Сервер запущен без графического интерфейса.')
+    while server.is_alive() and not stop_requested.wait(1):
+        pass
+    server.stop()
+    server.join()
+
+
+def run_gui(server, database, server_config: ConfigParser):
+    """
+    Starts the server's GUI and stops the server when it's closed,
+    waiting for it to flush the message counters to the DB.
+
+    :param server: running server thread
+    :param database: server's database
+    :param server_config: server's configuration
+    """
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtWidgets import QApplication
+    from server.gui import MainWindow
+
+    server_app = QApplication(argv)
+    server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
+    main_window = MainWindow(server, database, server_config)
+
+    server_app.exec_()
+
+    server.stop()
+    server.join()
+
+
 @function_log
 def main_cycle():
     """
@@ -94,7 +167,7 @@ def main_cycle():
     directory = os.getcwd()
     server_config.read(f"{directory}/{'server_config.ini'}")
 
-    address, port, no_gui = get_launch_params(
+    address, port, no_gui, engine = get_launch_params(
         server_config['SETTINGS']['listen_address'],
         server_config['SETTINGS']['default_port']
     )
@@ -102,28 +175,54 @@ def main_cycle():
         os.path.join(
             server_config['SETTINGS']['db_path'],
             server_config['SETTINGS']['db_file']
-        )
+        ),
+        server_config['SETTINGS'].getfloat('history_flush_interval', 5),
+        server_config['SETTINGS'].getint('history_flush_count', 100),
+        server_config['SETTINGS'].getint('user_cache_size', 1024),
+        read_storage_settings(server_config),
+        server_config['SETTINGS'].getint('offline_queue_limit', 100),
+        server_config['SETTINGS'].getfloat('offline_message_ttl', 604800)
+    )
+    tokens = TokenIssuer(
+        os.path.join(
+            server_config['SETTINGS']['db_path'],
+            server_config['SETTINGS'].get(
+                'token_secret_file', 'server_token.key')
+        ),
+        server_config['SETTINGS'].getint(
+            'resume_token_ttl', DEFAULT_TOKEN_TTL)
     )
+    try:
+        admission = AdmissionController(
+            server_config['SETTINGS'].getint(
+                'max_handshakes', DEFAULT_MAX_HANDSHAKES),
+            server_config['SETTINGS'].getfloat(
+                'accept_rate', DEFAULT_ACCEPT_RATE),
+            server_config['SETTINGS'].getint(
+                'accept_burst', DEFAULT_ACCEPT_BURST),
+            HANDSHAKE_TIMEOUT,
+            server_config['SETTINGS'].getint(
+                'max_turned_away', DEFAULT_MAX_TURNED_AWAY)
+        )
+    except ValueError as e:
+        SERVER_LOGGER.critical(
+            'Неверные параметры приема соединений: %s. '
+            'Работа приложения-сервера завершена.' % e
+        )
+        sys_exit(1)
 
-    server = MessagingServer(address, port, database)
+    if engine == 'asyncio':
+        server = AsyncMessagingServer(
+            address, port, database, tokens, admission)
+    else:
+        server = MessagingServer(address, port, database, tokens, admission)
     server.setDaemon(True)
     server.start()
 
     if no_gui:
-        while True:
-            prompt = input('Для выхода введите exit: ')
-            if prompt == 'exit':
-                server.working = False
-                server.join()
-                break
+        run_headless(server)
     else:
-        server_app = QApplication(argv)
-        server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
-        main_window = MainWindow(server, database, server_config)
-
-        server_app.exec_()
-
-        server.working = False
+        run_gui(server, database, server_config)
 
 
 if __name__ == '__main__':
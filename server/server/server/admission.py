@@ -0,0 +1,202 @@
+"""
+Admission control of the new connections.
+When all the clients connect at once (e.g. after a restart of the
+server), authorizing them all at the same time only makes every one
+of them wait longer. So the handshakes are started at a limited rate
+(token bucket), the connections over the rate wait in the queue, and
+when the number of handshakes in progress and waiting reaches the cap,
+the new clients are told to come back later (SERVER_BUSY) right away.
+A rejected client gets that in response to its presence message, but
+only as many of them wait for it as max_turned_away allows; the rest
+get the response as soon as they connect and are disconnected, so in
+a big storm the rejected connections don't pile up.
+The controller doesn't know anything about the sockets, the engines
+put into the queue whatever they identify the connections with.
+"""
+from collections import deque
+from math import ceil
+from time import monotonic
+
+from utils.constants import HANDSHAKE_TIMEOUT
+
+# решения о новом соединении
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+REJECTED = 'rejected'
+# сколько авторизаций (идущих и ожидающих) допускается одновременно
+DEFAULT_MAX_HANDSHAKES = 100
+# сколько авторизаций в секунду начинается в среднем и сколько подряд
+DEFAULT_ACCEPT_RATE = 500
+DEFAULT_ACCEPT_BURST = 100
+# сколько отклоненных соединений может ждать presence, чтобы получить отказ
+DEFAULT_MAX_TURNED_AWAY = 100
+
+
+class AdmissionController:
+    """
+    Decides which of the new connections start the authorization now,
+    which wait for their turn and which are rejected.
+    Counts the connections admitted right away or from the queue,
+    queued and rejected.
+    """
+
+    def __init__(self,
+                 max_handshakes: int = DEFAULT_MAX_HANDSHAKES,
+                 accept_rate: float = DEFAULT_ACCEPT_RATE,
+                 accept_burst: int = DEFAULT_ACCEPT_BURST,
+                 queue_timeout: float = HANDSHAKE_TIMEOUT,
+                 max_turned_away: int = DEFAULT_MAX_TURNED_AWAY):
+        """
+        Initialization of the controller.
+
+        :param max_handshakes: max number of the handshakes in progress
+            and connections waiting for one
+        :param accept_rate: number of the handshakes started per second
+        :param accept_burst: number of the handshakes that can be started
+            at once (size of the bucket)
+        :param queue_timeout: how long a connection may wait in the queue
+            before it's rejected
+        :param max_turned_away: max number of the rejected connections
+            waiting for the presence message to answer it with SERVER_BUSY
+        :raises ValueError: if the rate isn't positive or the cap
+            is less than one handshake (the queue would never move)
+            or the number of the rejected connections is negative
+        """
+        if accept_rate <= 0:
+            raise ValueError(
+                'Частота приема соединений должна быть больше нуля: %s' %
+                accept_rate)
+        if max_handshakes < 1:
+            raise ValueError(
+                'Допустимое число авторизаций должно быть не меньше '
+                'единицы: %s' % max_handshakes)
+        if max_turned_away < 0:
+            raise ValueError(
+                'Число отклоненных соединений не может быть '
+                'отрицательным: %s' % max_turned_away)
+        self.max_handshakes = max_handshakes
+        self.accept_rate = accept_rate
+        self.accept_burst = max(accept_burst, 1)
+        self.queue_timeout = queue_timeout
+        self.max_turned_away = max_turned_away
+        self.tokens = float(self.accept_burst)
+        self.updated = monotonic()
+        # соединения в очереди и время, до которого они могут ждать
+        self.queue = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def refill(self):
+        """
+        Adds the tokens accumulated since the last call to the bucket.
+        """
+        now = monotonic()
+        self.tokens = min(
+            self.accept_burst,
+            self.tokens + (now - self.updated) * self.accept_rate
+        )
+        self.updated = now
+
+    def take_token(self) -> bool:
+        """
+        Takes a token from the bucket, returns False if it's empty.
+        """
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def admit(self, connection, handshakes: int) -> str:
+        """
+        Returns the decision on the new connection: ADMITTED (the
+        handshake may start), QUEUED (the connection is put into the
+        queue and will be returned by admit_queued) or REJECTED.
+
+        :param connection: whatever the engine identifies the connection with
+        :param handshakes: number of the handshakes in progress
+        """
+        if handshakes + len(self.queue) >= self.max_handshakes:
+            self.rejected += 1
+            return REJECTED
+        if not self.queue and self.take_token():
+            self.admitted += 1
+            return ADMITTED
+        self.queue.append((connection, monotonic() + self.queue_timeout))
+        self.queued += 1
+        return QUEUED
+
+    def admit_queued(self) -> list:
+        """
+        Removes the connections whose turn has come from the queue
+        and returns them.
+        """
+        admitted = []
+        while self.queue and self.take_token():
+            admitted.append(self.queue.popleft()[0])
+        self.admitted += len(admitted)
+        return admitted
+
+    def expire_queued(self) -> list:
+        """
+        Removes the connections that have waited too long from the queue
+        and returns them, they are rejected.
+        """
+        expired = []
+        now = monotonic()
+        while self.queue and self.queue[0][1] <= now:
+            expired.append(self.queue.popleft()[0])
+        self.rejected += len(expired)
+        return expired
+
+    def discard(self, connection):
+        """
+        Removes the closed connection from the queue.
+
+        :param connection: whatever the engine identifies the connection with
+        """
+        for item in self.queue:
+            if item[0] is connection:
+                self.queue.remove(item)
+                return
+
+    def clear(self) -> list:
+        """
+        Empties the queue when the server stops and returns
+        the connections that were waiting.
+        """
+        waiting = [connection for connection, _ in self.queue]
+        self.queue.clear()
+        return waiting
+
+    def next_timeout(self):
+        """
+        Returns the number of seconds till the next connection in the queue
+        can be admitted or has to be rejected, or None if the queue is empty.
+        """
+        if not self.queue:
+            return None
+        self.refill()
+        token_delay = max(1 - self.tokens, 0) / self.accept_rate
+        return max(min(token_delay, self.queue[0][1] - monotonic()), 0)
+
+    def retry_after(self) -> int:
+        """
+        Returns the number of seconds the rejected client is advised
+        to wait before connecting again: about the time it takes
+        to admit everyone who is already in the queue.
+        """
+        return max(ceil(len(self.queue) / self.accept_rate), 1)
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the connections admitted, queued and
+        rejected since the start, and the number of the ones waiting now.
+        """
+        return {
+            ADMITTED: self.admitted,
+            QUEUED: self.queued,
+            REJECTED: self.rejected,
+            'waiting': len(self.queue)
+        }
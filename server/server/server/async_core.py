@@ -0,0 +1,754 @@
+"""
+Asyncio implementation of the server.
+Speaks the same JIM protocol as MessagingServer, but serves every
+connection with its own coroutine on a single event loop.
+"""
+import asyncio
+from asyncio import IncompleteReadError, StreamReader, StreamWriter
+from binascii import hexlify, a2b_base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hmac import new, compare_digest
+from json import JSONDecodeError
+from logging import getLogger
+from os import urandom
+from threading import Thread
+
+from utils.constants import MAX_NUMBER_OF_CONNECTIONS, SEND_TIMEOUT, \
+    MAX_OUTBOUND_BUFFER, HANDSHAKE_TIMEOUT, ACTION, PRESENCE, USER, \
+    MESSAGE, SENDER, DESTINATION, RESPONSE, ERROR, EXIT, ACCOUNT_NAME, \
+    GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USER_REQUEST, \
+    PUBLIC_KEY_REQUEST, DATA, PUBLIC_KEY, VERSION, ROSTER_EVENTS_VERSION, \
+    USER_ONLINE, USER_OFFLINE, RESUME_TOKEN, SEQUENCE, ROSTER_SYNC, \
+    TOKEN_REFRESH
+from utils.descriptors import Port
+from utils.errors import IncorrectDataReceivedError
+from utils.utils import encode_message, receive_message_async, \
+    reply_to, without_request_id
+from server.admission import AdmissionController, ADMITTED, QUEUED
+from server.protocol import request_action, error_response, \
+    list_response, busy_response, login_response, token_response, \
+    public_key_response, roster_sync_response, roster_notification, \
+    FULL_REFRESH_EVENTS, BAD_REQUEST, AUTHORIZATION_REQUIRED, \
+    UNKNOWN_DESTINATION, QUEUE_FULL
+from server.resume import RosterLog
+from server.tokens import TokenIssuer
+
+SERVER_LOGGER = getLogger('server')
+
+
+class AsyncMessagingServer(Thread):
+    """
+    The main class of the asyncio server.
+    Runs its own event loop in a separate thread, so it can be used
+    by the GUI exactly like MessagingServer.
+    """
+    port = Port()
+
+    def __init__(self,
+                 listening_address: str,
+                 listening_port: int,
+                 db,
+                 tokens: TokenIssuer = None,
+                 admission: AdmissionController = None):
+        """
+        Server initialization.
+        Creates the attributes needed for the server to work,
+        sets the working flag as True.
+        All the calls to the database are made from a single worker
+        thread, so the event loop never waits for SQLite.
+
+        :param listening_address: server's IP address
+        :param listening_port: server's port
+        :param db: server's database
+        :param tokens: issuer of the resume tokens (by default the tokens
+            are valid only till the server is stopped)
+        :param admission: admission control of the new connections
+        """
+        self.listening_address = listening_address
+        self.listening_port = listening_port
+        self.server_db = db
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='server_db')
+        self.loop = None
+        self.stopped = None
+        self.clients = dict()
+        self.connection_tasks = set()
+        self.drain_tasks = dict()
+        self.admission = admission or AdmissionController()
+        self.admission_task = None
+        self.handshakes_in_progress = 0
+        self.turning_away = 0
+        self.nicknames = dict()
+        self.protocol_versions = dict()
+        self.roster_log = RosterLog()
+        self.resume_tokens = tokens or TokenIssuer()
+        self.working = True
+        super().__init__()
+
+    def run(self):
+        """
+        Creates the event loop of the server thread and runs the server on it
+        until it's stopped.
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+            self.db_executor.shutdown()
+
+    async def serve(self):
+        """
+        Starts listening and waits for the stop signal.
+        Then closes the listening socket and all the client connections.
+        """
+        self.stopped = asyncio.Event()
+        if not self.working:
+            return
+        server = await asyncio.start_server(
+            self.handle_connection,
+            self.listening_address or None,
+            self.listening_port,
+            backlog=MAX_NUMBER_OF_CONNECTIONS
+        )
+        SERVER_LOGGER.info(
+            'Асинхронный сервер запущен на порту %s.' %
+            self.listening_port
+        )
+        flusher = asyncio.ensure_future(self.flush_history_periodically())
+        async with server:
+            await self.stopped.wait()
+        flusher.cancel()
+        for future in self.admission.clear():
+            future.cancel()
+        for writer in list(self.clients):
+            await self.logout(writer)
+            writer.transport.abort()
+            self.delete_client(writer)
+        await asyncio.gather(
+            flusher,
+            *self.connection_tasks,
+            *self.drain_tasks.values(),
+            return_exceptions=True
+        )
+        await self.db_call(self.server_db.flush_message_history)
+        self.resume_tokens.save_revocations()
+        SERVER_LOGGER.info(
+            'Статистика приема соединений: %s' % self.admission.stats())
+
+    async def flush_history_periodically(self):
+        """
+        Writes the accumulated message counters to the DB
+        when their flush interval runs out.
+        """
+        while True:
+            timeout = self.server_db.history_flush_timeout()
+            if timeout == 0:
+                await self.db_call(self.server_db.flush_message_history)
+            else:
+                await asyncio.sleep(
+                    self.server_db.history_flush_interval
+                    if timeout is None else timeout)
+
+    def stop(self):
+        """
+        Stops the server. Safe to call from any thread.
+        """
+        self.working = False
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules the callback to be executed by the event loop.
+        That is the way other threads (e.g. the GUI) should
+        interact with the client connections.
+
+        :param callback: function to be called
+        :param args: its arguments
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def db_call(self, method, *args):
+        """
+        Runs the database method in the DB worker thread and awaits the result.
+
+        :param method: method of the server's database
+        :param args: its arguments
+        """
+        return await self.loop.run_in_executor(
+            self.db_executor, partial(method, *args))
+
+    async def handle_connection(self,
+                                reader: StreamReader,
+                                writer: StreamWriter):
+        """
+        Coroutine serving a single client connection.
+        Waits for the admission control to let the client authorize
+        (or turns him away), then reads the messages one by one
+        and processes them until the client leaves or the connection breaks.
+
+        :param reader: stream reader of the connection
+        :param writer: stream writer of the connection
+        """
+        addr, port = writer.get_extra_info('peername')[:2]
+        SERVER_LOGGER.info(
+            'Установлено соединение с пользователем: '
+            'адрес: %s, порт: %s.' % (addr, port,)
+        )
+        self.clients[writer] = None
+        task = asyncio.current_task()
+        self.connection_tasks.add(task)
+        handshaking = False
+        try:
+            if not await self.wait_for_admission():
+                await self.turn_away(reader, writer)
+                return
+            handshaking = True
+            self.handshakes_in_progress += 1
+            deadline = self.loop.time() + HANDSHAKE_TIMEOUT
+            while self.working and writer in self.clients:
+                if self.clients[writer]:
+                    if handshaking:
+                        handshaking = False
+                        self.handshakes_in_progress -= 1
+                    message = await receive_message_async(reader)
+                else:
+                    message = await self.receive_before(reader, deadline)
+                await self.process_client_message(
+                    message, reader, writer, deadline)
+        except asyncio.TimeoutError:
+            SERVER_LOGGER.info(
+                'Истекло время авторизации клиента %s' % (addr,))
+            await self.send(writer, {
+                RESPONSE: 400,
+                ERROR: 'Истекло время авторизации'
+            })
+        except IncompleteReadError as e:
+            if e.partial:
+                SERVER_LOGGER.error(
+                    'Соединение с клиентом оборвалось '
+                    'посреди сообщения.'
+                )
+        except (OSError,
+                JSONDecodeError,
+                IncorrectDataReceivedError,
+                KeyError,
+                TypeError,
+                ValueError) as e:
+            SERVER_LOGGER.error(
+                'Ошибка при запросе '
+                'информации от клиента.',
+                exc_info=e
+            )
+        finally:
+            self.connection_tasks.discard(task)
+            if handshaking:
+                self.handshakes_in_progress -= 1
+            if writer in self.clients:
+                await self.logout(writer)
+                self.delete_client(writer)
+
+    async def wait_for_admission(self) -> bool:
+        """
+        Asks the admission control to let the new connection authorize,
+        waiting in the queue if needed. Returns False if the connection
+        is rejected.
+        """
+        future = self.loop.create_future()
+        decision = self.admission.admit(future, self.handshakes_in_progress)
+        if decision != QUEUED:
+            return decision == ADMITTED
+        if self.admission_task is None or self.admission_task.done():
+            self.admission_task = asyncio.ensure_future(
+                self.admit_queued_clients())
+        try:
+            return await future
+        finally:
+            self.admission.discard(future)
+
+    async def admit_queued_clients(self):
+        """
+        Lets the queued connections in as their turn comes and rejects
+        the ones that have waited for too long, until the queue is empty.
+        """
+        timeout = self.admission.next_timeout()
+        while timeout is not None:
+            await asyncio.sleep(timeout)
+            for future in self.admission.admit_queued():
+                if not future.done():
+                    future.set_result(True)
+            for future in self.admission.expire_queued():
+                if not future.done():
+                    future.set_result(False)
+            timeout = self.admission.next_timeout()
+
+    async def turn_away(self, reader: StreamReader, writer: StreamWriter):
+        """
+        Answers the presence message of the rejected client
+        with SERVER_BUSY. When too many rejected clients are waiting
+        already, sends the response right away, and the connection
+        is closed without waiting for the presence message.
+
+        :param reader: stream reader of the connection
+        :param writer: stream writer of the connection
+        """
+        if self.turning_away >= self.admission.max_turned_away:
+            SERVER_LOGGER.info(
+                'Сервер перегружен, клиенту %s отказано сразу.' %
+                (writer.get_extra_info('peername'),))
+            await self.send(writer, busy_response(self.admission))
+            return
+        SERVER_LOGGER.info(
+            'Сервер перегружен, клиенту %s будет отказано.' %
+            (writer.get_extra_info('peername'),))
+        self.turning_away += 1
+        try:
+            message = await self.receive_before(
+                reader, self.loop.time() + HANDSHAKE_TIMEOUT)
+        finally:
+            self.turning_away -= 1
+        await self.respond(writer, message, busy_response(self.admission))
+
+    async def receive_before(self, reader: StreamReader, deadline: float):
+        """
+        Receives the next message, but gives up (raises asyncio.TimeoutError)
+        when the loop time reaches the deadline.
+
+        :param reader: stream reader of the connection
+        :param deadline: loop time to give up at
+        """
+        return await asyncio.wait_for(
+            receive_message_async(reader),
+            max(deadline - self.loop.time(), 0)
+        )
+
+    async def send(self, writer: StreamWriter, message: dict):
+        """
+        Sends the message to the client and waits until the
+        transport's buffer drains. If the connection is broken
+        or the client doesn't accept the data in time, drops the client.
+
+        :param writer: stream writer of the connection
+        :param message: message to be sent
+        """
+        if writer.is_closing():
+            return
+        writer.write(encode_message(message))
+        await self.drain(writer)
+
+    async def drain(self, writer: StreamWriter) -> bool:
+        """
+        Waits until the transport's buffer drains, at most SEND_TIMEOUT
+        seconds. Returns False if the client has been dropped.
+
+        :param writer: stream writer of the connection
+        """
+        try:
+            await asyncio.wait_for(writer.drain(), SEND_TIMEOUT)
+            return True
+        except (OSError, asyncio.TimeoutError):
+            await self.drop_client(writer)
+            return False
+
+    async def flush(self, writer: StreamWriter) -> bool:
+        """
+        Waits until the transport has handed all the buffered data
+        to the OS (drain only waits till it's below the high-water mark),
+        at most SEND_TIMEOUT seconds. Returns False if the client
+        has been dropped.
+
+        :param writer: stream writer of the connection
+        """
+        transport = writer.transport
+        transport.set_write_buffer_limits(0)
+        try:
+            return await self.drain(writer)
+        finally:
+            if not transport.is_closing():
+                transport.set_write_buffer_limits()
+
+    def write_later(self, writer: StreamWriter, data: bytes) -> bool:
+        """
+        Puts the data into the client's buffer without waiting for it
+        to be sent, so the sender of a message never waits for its
+        recipient. The buffer is drained in the background; the client
+        whose buffer outgrows MAX_OUTBOUND_BUFFER is dropped.
+        Returns False if the connection is already closed
+        or the client has been dropped.
+
+        :param writer: stream writer of the connection
+        :param data: encoded message(s)
+        """
+        if writer.is_closing():
+            return False
+        writer.write(data)
+        if writer.transport.get_write_buffer_size() > MAX_OUTBOUND_BUFFER:
+            asyncio.ensure_future(self.drop_client(writer))
+            return False
+        if writer not in self.drain_tasks:
+            task = asyncio.ensure_future(self.drain(writer))
+            self.drain_tasks[writer] = task
+            task.add_done_callback(
+                lambda _: self.drain_tasks.pop(writer, None))
+        return True
+
+    async def drop_client(self, writer: StreamWriter):
+        """
+        Aborts the connection that is broken or whose client doesn't read
+        the data sent to him (the unsent data is discarded),
+        and logs the client out.
+
+        :param writer: stream writer of the connection
+        """
+        if writer not in self.clients:
+            return
+        SERVER_LOGGER.info(
+            'Клиент %s не принимает данные, соединение разорвано.' %
+            (writer.get_extra_info('peername'),))
+        writer.transport.abort()
+        await self.logout(writer)
+        self.delete_client(writer)
+
+    async def respond(self,
+                      writer: StreamWriter,
+                      request: dict,
+                      response: dict):
+        """
+        Sends the response to the client's request, echoing the request's id.
+
+        :param writer: stream writer of the connection
+        :param request: request being responded to
+        :param response: response to be sent
+        """
+        await self.send(writer, reply_to(request, response))
+
+    async def process_client_message(self,
+                                     message: dict,
+                                     reader: StreamReader,
+                                     writer: StreamWriter,
+                                     deadline: float):
+        """
+        Handles the messages from clients according to their service codes,
+        the same way MessagingServer.process_client_message does.
+        Until the client is authorized, only the presence message and exit
+        are accepted, anything else is answered with 400.
+
+        :param message: dictionary with a message
+        :param reader: stream reader of the connection
+        :param writer: stream writer of the connection
+        :param deadline: loop time the authorization has to be finished by
+        """
+        SERVER_LOGGER.debug(
+            'Обработка входящего сообщения: %s.' % message
+        )
+        login = self.clients.get(writer)
+        action = request_action(message, login)
+        # авторизация клиента
+        if action == PRESENCE:
+            await self.authorize_client(message, reader, writer, deadline)
+        # клиент выходит
+        elif action == EXIT or not login and \
+                ACTION in message and message[ACTION] == EXIT:
+            await self.logout(writer)
+            self.delete_client(writer)
+        # клиент еще не прошел авторизацию
+        elif not login:
+            await self.send(writer, error_response(AUTHORIZATION_REQUIRED))
+        # сообщение от клиента
+        elif action == MESSAGE:
+            if message[DESTINATION] not in self.nicknames and \
+                    not await self.db_call(
+                        self.server_db.check_existing_user,
+                        message[DESTINATION]):
+                await self.respond(writer, message,
+                                   error_response(UNKNOWN_DESTINATION))
+            elif await self.send_client_message(message):
+                await self.db_call(
+                    self.server_db.record_message_to_history,
+                    message[SENDER],
+                    message[DESTINATION]
+                )
+                await self.respond(writer, message, {RESPONSE: 200})
+            else:
+                await self.respond(writer, message,
+                                   error_response(QUEUE_FULL))
+        # запрос списка контактов
+        elif action == GET_CONTACTS:
+            await self.respond(writer, message, list_response(
+                await self.db_call(
+                    self.server_db.get_user_contact_list, login)))
+        # запрос на добавление контакта
+        elif action == ADD_CONTACT:
+            await self.db_call(
+                self.server_db.add_contact_to_list,
+                login,
+                message[ACCOUNT_NAME]
+            )
+            await self.respond(writer, message, {RESPONSE: 200})
+        # запрос на удаление контакта
+        elif action == REMOVE_CONTACT:
+            await self.db_call(
+                self.server_db.remove_contact_from_list,
+                login,
+                message[ACCOUNT_NAME]
+            )
+            await self.respond(writer, message, {RESPONSE: 200})
+        # запрос списка пользователей
+        elif action == USER_REQUEST:
+            users = await self.db_call(self.server_db.all_users_list)
+            await self.respond(writer, message, list_response(
+                [user[0] for user in users]))
+        # запрос событий списка пользователей, пропущенных клиентом
+        elif action == ROSTER_SYNC:
+            await self.respond(writer, message, roster_sync_response(
+                login, message[SEQUENCE], self.roster_log))
+        # обмен токена возобновления сеанса на новый
+        elif action == TOKEN_REFRESH:
+            await self.respond(writer, message,
+                               token_response(login, self.resume_tokens))
+        # запрос публичного ключа клиента
+        elif action == PUBLIC_KEY_REQUEST:
+            key = await self.db_call(
+                self.server_db.get_user_public_key,
+                message[ACCOUNT_NAME]
+            )
+            await self.respond(writer, message,
+                               public_key_response(message, key))
+        else:
+            await self.respond(writer, message, error_response(BAD_REQUEST))
+
+    async def authorize_client(self,
+                               message: dict,
+                               reader: StreamReader,
+                               writer: StreamWriter,
+                               deadline: float):
+        """
+        Handles the client's authorization, the same way
+        MessagingServer.authorize_client does. Waiting for the client's
+        digest only suspends this connection's coroutine.
+
+        :param message: presence message
+        :param reader: stream reader of the connection
+        :param writer: stream writer of the connection
+        :param deadline: loop time the authorization has to be finished by
+        """
+        login = message[USER][ACCOUNT_NAME]
+        SERVER_LOGGER.debug(
+            'Старт процесса авторизации пользователя %s' %
+            message[USER]
+        )
+        if RESUME_TOKEN in message and \
+                self.resume_tokens.redeem(message[RESUME_TOKEN], login):
+            SERVER_LOGGER.info(
+                'Пользователь %s возобновил сеанс по токену' % login)
+            previous = self.nicknames.get(login)
+            if previous:
+                await self.logout(previous)
+                self.delete_client(previous)
+            await self.login_client(message, writer)
+            return
+        if login in self.nicknames:
+            await self.send(writer, {
+                RESPONSE: 400,
+                ERROR: 'Имя пользователя уже занято'
+            })
+            self.delete_client(writer)
+            return
+        if not await self.db_call(
+                self.server_db.check_existing_user, login):
+            SERVER_LOGGER.debug(
+                'Пользователь %s не зарегистрирован' % login)
+            await self.send(writer, {
+                RESPONSE: 400,
+                ERROR: 'Пользователь не зарегистрирован'
+            })
+            return
+
+        SERVER_LOGGER.debug('Начало проверки пароля')
+        random_string = hexlify(urandom(64))
+        pwd_hash = await self.db_call(
+            self.server_db.get_user_pwd_hash, login)
+        pwd_digest = new(pwd_hash, random_string, 'MD5').digest()
+        await self.send(writer, {
+            RESPONSE: 511,
+            DATA: random_string.decode('ascii')
+        })
+        client_response = await self.receive_before(reader, deadline)
+        if RESPONSE in client_response and \
+                client_response[RESPONSE] == 511 and \
+                DATA in client_response and \
+                compare_digest(pwd_digest,
+                               a2b_base64(client_response[DATA])) and \
+                login not in self.nicknames:
+            await self.login_client(message, writer)
+        else:
+            await self.send(writer, {
+                RESPONSE: 400,
+                ERROR: 'Неверный пароль'
+            })
+            self.delete_client(writer)
+
+    async def login_client(self, message: dict, writer: StreamWriter):
+        """
+        Logs the authorized client onto the server, the same way
+        MessagingServer.login_client does.
+
+        :param message: client's presence message
+        :param writer: stream writer of the connection
+        """
+        login = message[USER][ACCOUNT_NAME]
+        version = message.get(VERSION, 1)
+        self.nicknames[login] = writer
+        self.clients[writer] = login
+        self.protocol_versions[writer] = version
+        client_addr, client_port = \
+            writer.get_extra_info('peername')[:2]
+        await self.send(writer, login_response(
+            login, version, self.resume_tokens, self.roster_log))
+        await self.db_call(
+            self.server_db.login_user,
+            login,
+            client_addr,
+            client_port,
+            message[USER].get(PUBLIC_KEY)
+        )
+        self.notify_roster(USER_ONLINE, login)
+        await self.deliver_offline_messages(login, writer)
+
+    async def deliver_offline_messages(self,
+                                       login: str,
+                                       writer: StreamWriter):
+        """
+        Sends all the messages that were waiting for the user in one batch.
+        They are removed from the queue only when the transport has handed
+        the whole batch to the OS (see flush). If the client is dropped
+        before that, the messages stay in the queue till the next login.
+
+        :param login: client's nickname
+        :param writer: stream writer of the connection
+        """
+        messages = await self.db_call(
+            self.server_db.get_offline_messages, login)
+        if not messages:
+            return
+        writer.write(b''.join(
+            encode_message(message) for _, message in messages))
+        if not await self.flush(writer):
+            return
+        await self.db_call(
+            self.server_db.delete_offline_messages,
+            login,
+            messages[-1][0]
+        )
+        SERVER_LOGGER.info(
+            'Пользователю %s доставлено сообщений из очереди: %d.' %
+            (login, len(messages))
+        )
+
+    async def send_client_message(self, message: dict) -> bool:
+        """
+        Handles the exchange of messages between clients.
+        Puts the message into the recipient's buffer, the sender
+        doesn't wait for the recipient to receive it. If the recipient
+        is offline (or his connection is closing), puts the message into
+        his offline queue. Returns False if the queue is full.
+
+        :param message: dictionary with the message
+        """
+        message = without_request_id(message)
+        recipient = self.nicknames.get(message[DESTINATION])
+        if recipient:
+            if self.write_later(recipient, encode_message(message)):
+                SERVER_LOGGER.info(
+                    'Было отправлено сообщение пользователю '
+                    '%s от пользователя %s.' %
+                    (message[DESTINATION], message[SENDER])
+                )
+                return True
+            SERVER_LOGGER.error(
+                'Потеряна связь с клиентом %s, '
+                'сообщение помещено в очередь.' % message[DESTINATION]
+            )
+        return await self.db_call(
+            self.server_db.store_offline_message,
+            message[DESTINATION],
+            message
+        )
+
+    async def logout(self, writer: StreamWriter):
+        """
+        Logs the client of this connection out in the DB,
+        if he was logged in.
+
+        :param writer: stream writer of the connection
+        """
+        login = self.clients.get(writer)
+        if login and self.nicknames.get(login) is writer:
+            del self.nicknames[login]
+            self.clients[writer] = None
+            await self.db_call(self.server_db.logout_user, login)
+            self.notify_roster(USER_OFFLINE, login)
+
+    def delete_client(self, writer: StreamWriter):
+        """
+        Closes the connection with the client and forgets about it.
+        The client has to be logged out beforehand (see logout).
+
+        :param writer: stream writer of the connection
+        """
+        SERVER_LOGGER.info(
+            'Клиент %s отключился от сервера' %
+            (writer.get_extra_info('peername'),))
+        login = self.clients.pop(writer, None)
+        if login and self.nicknames.get(login) is writer:
+            del self.nicknames[login]
+        self.protocol_versions.pop(writer, None)
+        writer.close()
+
+    def disconnect_user(self, login: str):
+        """
+        Drops the connection of the user without logging him out in the DB
+        and revokes his resume tokens.
+        Used when the user gets removed from the server.
+
+        :param login: client's nickname
+        """
+        self.resume_tokens.revoke(login)
+        writer = self.nicknames.pop(login, None)
+        if writer:
+            self.delete_client(writer)
+
+    def update_list(self):
+        """
+        Generates the message with 205 code that triggers the update of contact
+        and active users' lists for all active clients.
+        """
+        for writer in list(self.nicknames.values()):
+            self.write_later(writer, encode_message({RESPONSE: 205}))
+
+    def notify_roster(self, event: str, login: str):
+        """
+        Notifies the active clients about the change of the users' list,
+        the same way MessagingServer.notify_roster does.
+
+        :param event: USER_ADDED, USER_REMOVED, USER_ONLINE or USER_OFFLINE
+        :param login: user the event is about
+        """
+        # при остановке сервера отключаются все клиенты разом,
+        # рассылать каждому об уходе остальных незачем
+        if not self.working:
+            return
+        notification = encode_message(
+            roster_notification(event, login, self.roster_log))
+        full_refresh = event in FULL_REFRESH_EVENTS
+        for name, writer in list(self.nicknames.items()):
+            if name == login or writer.is_closing():
+                continue
+            if self.protocol_versions.get(writer, 1) >= \
+                    ROSTER_EVENTS_VERSION:
+                self.write_later(writer, notification)
+            elif full_refresh:
+                self.write_later(writer, encode_message({RESPONSE: 205}))
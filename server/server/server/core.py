@@ -2,24 +2,69 @@
 All the main functions for the server app
 """
 from binascii import hexlify, a2b_base64
+from collections import deque
 from hmac import new, compare_digest
 from json import JSONDecodeError
 from logging import getLogger
 from os import urandom
-from select import select
-from socket import socket, AF_INET, SOCK_STREAM
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, \
+    SOL_SOCKET, SO_REUSEADDR
 from threading import Thread
+from time import monotonic
 
-from utils.constants import MAX_NUMBER_OF_CONNECTIONS, ACTION, \
-    PRESENCE, TIME, USER, MESSAGE, SENDER, DESTINATION, \
-    MESSAGE_TEXT, RESPONSE, ERROR, EXIT, ACCOUNT_NAME, GET_CONTACTS, \
-    LIST_INFO, ADD_CONTACT, REMOVE_CONTACT, USER_REQUEST, \
-    PUBLIC_KEY_REQUEST, DATA, PUBLIC_KEY
+from utils.constants import MAX_NUMBER_OF_CONNECTIONS, MAX_OUTBOUND_BUFFER, \
+    MAX_PACK_LENGTH, HANDSHAKE_TIMEOUT, ACTION, PRESENCE, USER, MESSAGE, \
+    SENDER, DESTINATION, RESPONSE, ERROR, EXIT, ACCOUNT_NAME, \
+    GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USER_REQUEST, \
+    PUBLIC_KEY_REQUEST, DATA, PUBLIC_KEY, VERSION, ROSTER_EVENTS_VERSION, \
+    USER_ONLINE, USER_OFFLINE, RESUME_TOKEN, SEQUENCE, ROSTER_SYNC, \
+    TOKEN_REFRESH
 from utils.descriptors import Port
-from utils.utils import receive_message, send_message
+from utils.errors import IncorrectDataReceivedError
+from utils.utils import receive_messages, take_buffered_messages, \
+    reply_to, encode_message, without_request_id
+from server.admission import AdmissionController, ADMITTED, REJECTED
+from server.protocol import request_action, error_response, \
+    list_response, busy_response, login_response, token_response, \
+    public_key_response, roster_sync_response, roster_notification, \
+    FULL_REFRESH_EVENTS, BAD_REQUEST, AUTHORIZATION_REQUIRED, \
+    UNKNOWN_DESTINATION, QUEUE_FULL
+from server.resume import RosterLog
+from server.tokens import TokenIssuer
 
 SERVER_LOGGER = getLogger('server')
 
+# состояния авторизации клиента
+AWAITING_PRESENCE = 'awaiting_presence'
+CHALLENGE_SENT = 'challenge_sent'
+AUTHENTICATED = 'authenticated'
+# клиент не допущен к авторизации, на presence он получит SERVER_BUSY
+TURNED_AWAY = 'turned_away'
+
+
+class ClientHandshake:
+    """
+    State of the authorization of a single connection.
+    The client goes from AWAITING_PRESENCE to CHALLENGE_SENT and then to
+    AUTHENTICATED, and has to get there before the deadline.
+    The client turned away by the admission control stays in the
+    TURNED_AWAY state until it sends the presence message.
+    """
+
+    def __init__(self, deadline: float):
+        """
+        Creates the handshake in the AWAITING_PRESENCE state.
+
+        :param deadline: monotonic time the handshake expires at
+        """
+        self.state = AWAITING_PRESENCE
+        self.deadline = deadline
+        self.login = None
+        self.public_key = None
+        self.version = 1
+        self.digest = None
+
 
 class MessagingServer(Thread):
     """
@@ -30,7 +75,9 @@ class MessagingServer(Thread):
     def __init__(self,
                  listening_address: str,
                  listening_port: int,
-                 db):
+                 db,
+                 tokens: TokenIssuer = None,
+                 admission: AdmissionController = None):
         """
         Server initialization.
         Creates the attributes needed for the server to work,
@@ -39,85 +86,293 @@ class MessagingServer(Thread):
         :param listening_address: server's IP address
         :param listening_port: server's port
         :param db: server's database
+        :param tokens: issuer of the resume tokens (by default the tokens
+            are valid only till the server is stopped)
+        :param admission: admission control of the new connections
         """
         self.listening_address = listening_address
         self.listening_port = listening_port
         self.server_db = db
         self.server_socket = None
-        self.clients_list = []
-        self.sockets_list = None
-        self.exceptions_list = None
-        self.messages_queue = list()
+        self.selector = None
+        self.wakeup_receiver, self.wakeup_sender = socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.pending_calls = deque()
+        self.clients = set()
+        self.outbound = dict()
+        # клиент -> (логин, id последнего из отправленных ему сообщений
+        # очереди, их число); сообщения удаляются, когда буфер отправлен
+        self.offline_batches = dict()
+        self.handshakes = dict()
+        self.turned_away = set()
+        self.admission = admission or AdmissionController()
         self.nicknames = dict()
+        self.logins = dict()
+        self.protocol_versions = dict()
+        self.roster_log = RosterLog()
+        self.resume_tokens = tokens or TokenIssuer()
         self.working = True
         super().__init__()
 
     def run(self):
         """
-        The main loop of the server.
-        Creates a listening socket, and then accepts connections while the working flag is True.
-        If there are clients with messages, sends them.
+        The main loop of the server (reactor).
+        Creates a non-blocking listening socket and registers it in the selector
+        together with all the client sockets and the wakeup socket.
+        The loop sleeps until one of them becomes readable and then dispatches
+        the event to the handler stored in the selector key. Client sockets
+        with unsent data are also watched for becoming writable.
         """
         self.server_socket = socket(AF_INET, SOCK_STREAM)
+        # перезапущенный сервер должен сразу занять порт, даже если
+        # соединения прошлого запуска еще в состоянии TIME_WAIT
+        self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.server_socket.bind(
             (self.listening_address, self.listening_port)
         )
-        self.server_socket.settimeout(0.5)
         self.server_socket.listen(MAX_NUMBER_OF_CONNECTIONS)
+        self.server_socket.setblocking(False)
+
+        self.selector = DefaultSelector()
+        self.selector.register(
+            self.server_socket, EVENT_READ, self.accept_clients)
+        self.selector.register(
+            self.wakeup_receiver, EVENT_READ, self.run_pending_calls)
 
         try:
             while self.working:
-                try:
-                    client_socket, client = self.server_socket.accept()
-                    addr, port = client
-                except OSError:
-                    pass
-                else:
-                    SERVER_LOGGER.info(
-                        'Установлено соединение с пользователем: '
-                        'адрес: %s, порт: %s.' % (addr, port,)
-                    )
-                    client_socket.settimeout(5)
-                    self.clients_list.append(client_socket)
-                ready_to_receive = []
-                ready_to_send = []
-                exceptions_list = []
-                try:
-                    if self.clients_list:
-                        ready_to_send, self.sockets_list, self.exceptions_list = select(
-                            self.clients_list,
-                            self.clients_list,
-                            [],
-                            0
-                        )
-                except OSError as err:
-                    SERVER_LOGGER.error(
-                        'Ошибка работы с сокетами: %s.' % err
-                    )
-                if ready_to_send:
-                    for client in ready_to_send:
-                        try:
-                            self.process_client_message(
-                                receive_message(client),
-                                client
-                            )
-                        except (OSError,
-                                JSONDecodeError,
-                                TypeError) as e:
-                            SERVER_LOGGER.error(
-                                'Ошибка при запросе '
-                                'информации от клиента.',
-                                exc_info=e
-                            )
-                            self.delete_client(client)
+                for key, mask in self.selector.select(self.next_timeout()):
+                    if mask & EVENT_WRITE:
+                        self.flush_client(key.fileobj)
+                    if mask & EVENT_READ and key.fileobj.fileno() != -1:
+                        key.data(key.fileobj)
+                self.admit_queued_clients()
+                self.expire_handshakes()
+                if self.server_db.history_flush_timeout() == 0:
+                    self.server_db.flush_message_history()
         except KeyboardInterrupt:
             SERVER_LOGGER.info('Серер остановлен пользователем.')
+        finally:
+            for client in list(self.clients):
+                self.delete_client(client)
+            self.selector.close()
             self.server_socket.close()
+            self.server_db.flush_message_history()
+            self.resume_tokens.save_revocations()
+            SERVER_LOGGER.info(
+                'Статистика приема соединений: %s' % self.admission.stats())
+
+    def next_timeout(self):
+        """
+        Returns the number of seconds the loop may sleep for:
+        till the earliest handshake expires, the next queued connection
+        can be admitted or the message counters have to be flushed
+        to the DB, whichever comes first.
+        None means there are no timers and the loop may sleep until
+        some socket becomes readable.
+        """
+        timeouts = [
+            timeout for timeout in (
+                self.handshake_timeout(),
+                self.admission.next_timeout(),
+                self.server_db.history_flush_timeout()
+            ) if timeout is not None
+        ]
+        return min(timeouts) if timeouts else None
+
+    def handshake_timeout(self):
+        """
+        Returns the time left till the earliest handshake expires,
+        or None if nobody is being authorized at the moment.
+        Handshakes are stored in the order they were started, so the
+        first one is always the earliest to expire.
+        """
+        for handshake in self.handshakes.values():
+            return max(handshake.deadline - monotonic(), 0)
+        return None
+
+    def expire_handshakes(self):
+        """
+        Disconnects the clients that didn't manage to authorize in time.
+        """
+        now = monotonic()
+        for client, handshake in list(self.handshakes.items()):
+            if handshake.deadline > now:
+                break
+            SERVER_LOGGER.info(
+                'Истекло время авторизации клиента %s' % client)
+            self.send(client, {
+                RESPONSE: 400,
+                ERROR: 'Истекло время авторизации'
+            })
+            self.delete_client(client)
+
+    def stop(self):
+        """
+        Stops the main loop. Safe to call from any thread.
+        """
+        self.working = False
+        self.call_soon(lambda: None)
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules the callback to be executed by the server thread
+        on the next iteration of the loop and wakes the loop up.
+        That is the way other threads (e.g. the GUI) should
+        interact with the client sockets.
+
+        :param callback: function to be called
+        :param args: its arguments
+        """
+        self.pending_calls.append((callback, args))
+        try:
+            self.wakeup_sender.send(b'\0')
+        except OSError:
+            pass
+
+    def run_pending_calls(self, wakeup_socket: socket):
+        """
+        Handler of the wakeup socket. Drains it and executes
+        all the callbacks scheduled by other threads.
+
+        :param wakeup_socket: receiving end of the wakeup socket pair
+        """
+        try:
+            while wakeup_socket.recv(MAX_PACK_LENGTH):
+                pass
+        except BlockingIOError:
+            pass
+        while self.pending_calls:
+            callback, args = self.pending_calls.popleft()
+            callback(*args)
+
+    def accept_clients(self, server_socket: socket):
+        """
+        Handler of the listening socket.
+        Accepts all the pending connections and passes them to the admission
+        control: the admitted ones start the authorization, the queued ones
+        wait (unregistered) till admit_queued_clients lets them in, and the
+        rejected ones are turned away.
+
+        :param server_socket: listening socket
+        """
+        while True:
+            try:
+                client_socket, client = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                SERVER_LOGGER.error(
+                    'Ошибка работы с сокетами: %s.' % err
+                )
+                return
+            addr, port = client[:2]
+            SERVER_LOGGER.info(
+                'Установлено соединение с пользователем: '
+                'адрес: %s, порт: %s.' % (addr, port,)
+            )
+            client_socket.setblocking(False)
+            self.clients.add(client_socket)
+            decision = self.admission.admit(
+                client_socket, len(self.handshakes) - len(self.turned_away))
+            if decision == ADMITTED:
+                self.start_handshake(client_socket)
+            elif decision == REJECTED:
+                self.turn_away(client_socket)
+            else:
+                SERVER_LOGGER.debug(
+                    'Соединение %s ожидает очереди на авторизацию.' %
+                    (client,))
+
+    def admit_queued_clients(self):
+        """
+        Starts the authorization of the queued clients whose turn has come
+        and turns away the ones that have waited for too long.
+        """
+        for client in self.admission.admit_queued():
+            self.start_handshake(client)
+        for client in self.admission.expire_queued():
+            self.turn_away(client)
+
+    def turn_away(self, client: socket):
+        """
+        Turns away the client rejected by the admission control.
+        The client waits in the TURNED_AWAY state to get SERVER_BUSY in
+        response to its presence message, unless too many rejected
+        clients are waiting already: then it gets the response right away
+        and the connection is closed, so it doesn't hold a descriptor.
+
+        :param client: client's socket
+        """
+        if len(self.turned_away) < self.admission.max_turned_away:
+            self.start_handshake(client, TURNED_AWAY)
+            return
+        SERVER_LOGGER.info(
+            'Сервер перегружен, клиенту %s отказано сразу.' % client)
+        try:
+            client.send(encode_message(busy_response(self.admission)))
+            # если presence уже пришел, закрытие сокета с непрочитанными
+            # данными оборвало бы соединение вместе с ответом
+            client.recv(MAX_PACK_LENGTH)
+        except OSError:
+            pass
+        self.delete_client(client)
+
+    def start_handshake(self, client: socket, state: str = AWAITING_PRESENCE):
+        """
+        Creates the authorization state of the accepted client
+        and registers its socket in the selector.
+
+        :param client: client's socket
+        :param state: AWAITING_PRESENCE or TURNED_AWAY
+        """
+        handshake = ClientHandshake(monotonic() + HANDSHAKE_TIMEOUT)
+        handshake.state = state
+        if state == TURNED_AWAY:
+            SERVER_LOGGER.info(
+                'Сервер перегружен, клиенту %s будет отказано.' % client)
+            self.turned_away.add(client)
+        self.handshakes[client] = handshake
+        self.selector.register(client, EVENT_READ, self.read_client)
+
+    def read_client(self, client: socket):
+        """
+        Handler of a readable client socket.
+        Reads the data once and processes every complete message received,
+        including the ones that were left in the socket's buffer.
+
+        :param client: client's socket
+        """
+        try:
+            try:
+                messages = receive_messages(client)
+            except BlockingIOError:
+                return
+            while messages:
+                for message in messages:
+                    if client not in self.clients:
+                        return
+                    self.process_client_message(message, client)
+                messages = take_buffered_messages(client)
+        except (OSError,
+                JSONDecodeError,
+                IncorrectDataReceivedError,
+                KeyError,
+                TypeError,
+                ValueError) as e:
+            SERVER_LOGGER.error(
+                'Ошибка при запросе '
+                'информации от клиента.',
+                exc_info=e
+            )
+            if client in self.clients:
+                self.delete_client(client)
 
     def process_client_message(self, message: dict, client: socket):
         """
         Handles the messages from clients according to their service codes.
-        This method handles authorization, client's exit, contact list, existing users'
+        Messages from clients that haven't finished the authorization yet
+        go to the handshake state machine. Otherwise this method handles client's exit, contact list, existing users'
         and public key requests, requests to add or delete a contact and messages from
         client to client (this method also records these messages to server DB). This method
         triggers a relevant handler if needed, or tries to send a response with a relevant
@@ -130,165 +385,235 @@ class MessagingServer(Thread):
         SERVER_LOGGER.debug(
             'Обработка входящего сообщения: %s.' % message
         )
-        # авторизация клиента
-        if ACTION in message and message[ACTION] == PRESENCE \
-                and TIME in message and USER in message:
-            self.authorize_client(message, client)
+        handshake = self.handshakes.get(client)
+        # клиент еще не прошел авторизацию
+        if handshake:
+            self.process_handshake(message, client, handshake)
+            return
+        login = self.logins.get(client)
+        action = request_action(message, login)
         # сообщение от клиента
-        elif ACTION in message and message[ACTION] == MESSAGE and \
-                SENDER in message and DESTINATION in message and \
-                TIME in message and MESSAGE_TEXT in message \
-                and self.nicknames[message[SENDER]] == client:
-            if message[DESTINATION] in self.nicknames:
-                self.messages_queue.append(message)
+        if action == MESSAGE:
+            if message[DESTINATION] not in self.nicknames and \
+                    not self.server_db.check_existing_user(
+                        message[DESTINATION]):
+                self.respond(client, message,
+                             error_response(UNKNOWN_DESTINATION))
+            elif self.send_client_message(message):
                 self.server_db.record_message_to_history(
                     message[SENDER],
                     message[DESTINATION]
                 )
-                self.send_client_message(message)
-                try:
-                    send_message(client, {RESPONSE: 200})
-                except OSError:
-                    self.delete_client(client)
+                self.respond(client, message, {RESPONSE: 200})
             else:
-                response = {
-                    RESPONSE: 400,
-                    ERROR: 'Пользователь не зарегистрирован на сервере.'
-                }
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-            return
+                self.respond(client, message, error_response(QUEUE_FULL))
         # клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and \
-                ACCOUNT_NAME in message:
+        elif action == EXIT:
             self.delete_client(client)
         # запрос списка контактов
-        elif ACTION in message and message[ACTION] == GET_CONTACTS \
-                and USER in message \
-                and self.nicknames[message[USER]] == client:
-            response = {
-                RESPONSE: 202,
-                LIST_INFO: self.server_db.get_user_contact_list(
-                    message[USER])
-            }
-            try:
-                send_message(client, response)
-            except OSError:
-                self.delete_client(client)
+        elif action == GET_CONTACTS:
+            self.respond(client, message, list_response(
+                self.server_db.get_user_contact_list(login)))
         # запрос на добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT \
-                and ACCOUNT_NAME in message and USER in message \
-                and self.nicknames[message[USER]] == client:
+        elif action == ADD_CONTACT:
             self.server_db.add_contact_to_list(
-                message[USER],
+                login,
                 message[ACCOUNT_NAME]
             )
-            try:
-                send_message(client, {RESPONSE: 200})
-            except OSError:
-                self.delete_client(client)
+            self.respond(client, message, {RESPONSE: 200})
         # запрос на удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT \
-                and ACCOUNT_NAME in message and USER in message \
-                and self.nicknames[message[USER]] == client:
+        elif action == REMOVE_CONTACT:
             self.server_db.remove_contact_from_list(
-                message[USER],
+                login,
                 message[ACCOUNT_NAME]
             )
-            try:
-                send_message(client, {RESPONSE: 200})
-            except OSError:
-                self.delete_client(client)
+            self.respond(client, message, {RESPONSE: 200})
         # запрос списка пользователей
-        elif ACTION in message and message[ACTION] == USER_REQUEST \
-                and ACCOUNT_NAME in message \
-                and self.nicknames[message[ACCOUNT_NAME]] == client:
-            response = {
-                RESPONSE: 202,
-                LIST_INFO: [
-                    user[0] for user in self.server_db.all_users_list()
-                ]
-            }
-            try:
-                send_message(client, response)
-            except OSError:
-                self.delete_client(client)
+        elif action == USER_REQUEST:
+            self.respond(client, message, list_response([
+                user[0] for user in self.server_db.all_users_list()
+            ]))
+        # запрос событий списка пользователей, пропущенных клиентом
+        elif action == ROSTER_SYNC:
+            self.respond(client, message, roster_sync_response(
+                login, message[SEQUENCE], self.roster_log))
+        # обмен токена возобновления сеанса на новый
+        elif action == TOKEN_REFRESH:
+            self.respond(client, message,
+                         token_response(login, self.resume_tokens))
         # запрос публичного ключа клиента
-        elif ACTION in message and message[ACTION] == \
-                PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = {
-                RESPONSE: 511,
-                DATA: self.server_db.get_user_public_key(
-                    message[ACCOUNT_NAME])
-            }
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.delete_client(client)
-            else:
-                response = {
-                    RESPONSE: 400,
-                    ERROR: 'Отсутствует публичный ключ пользователя.'
-                }
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.delete_client(client)
+        elif action == PUBLIC_KEY_REQUEST:
+            self.respond(client, message, public_key_response(
+                message,
+                self.server_db.get_user_public_key(message[ACCOUNT_NAME])
+            ))
+        else:
+            self.respond(client, message, error_response(BAD_REQUEST))
+
+    def respond(self, client: socket, request: dict, response: dict):
+        """
+        Sends the response to the client's request, echoing the request's id.
+        If sending is not possible, deletes the client.
+
+        :param client: client's socket
+        :param request: request being responded to
+        :param response: response to be sent
+        """
+        self.send(client, reply_to(request, response))
+
+    def send(self, client: socket, message: dict) -> bool:
+        """
+        Sends the message to the client, see write.
+
+        :param client: client's socket
+        :param message: message to be sent
+        """
+        return self.write(client, encode_message(message))
+
+    def write(self, client: socket, data: bytes) -> bool:
+        """
+        Sends as much of the data as the socket takes right away
+        and puts the rest into the client's outbound buffer, which is
+        sent when the socket becomes writable, so the server never waits
+        for a single client. The client whose buffer outgrows
+        MAX_OUTBOUND_BUFFER (he doesn't read what is sent to him)
+        or whose connection is broken is deleted.
+        Returns False if the client has been deleted.
+
+        :param client: client's socket
+        :param data: encoded message(s)
+        """
+        if client not in self.clients:
+            return False
+        buffer = self.outbound.get(client)
+        if buffer is not None:
+            buffer.extend(data)
         else:
-            response = {
-                RESPONSE: 400,
-                ERROR: 'bad request'
-            }
             try:
-                send_message(client, response)
+                sent = client.send(data)
+            except BlockingIOError:
+                sent = 0
             except OSError:
                 self.delete_client(client)
+                return False
+            if sent == len(data):
+                return True
+            buffer = self.outbound[client] = bytearray(data[sent:])
+            self.selector.modify(
+                client, EVENT_READ | EVENT_WRITE, self.read_client)
+        if len(buffer) > MAX_OUTBOUND_BUFFER:
+            SERVER_LOGGER.info(
+                'Клиент %s не принимает данные, соединение разорвано.' %
+                client)
+            self.delete_client(client)
+            return False
+        return True
+
+    def flush_client(self, client: socket):
+        """
+        Handler of a writable client socket.
+        Sends as much of the client's outbound buffer as the socket takes.
+        Once the buffer is sent, the offline messages it held are removed
+        from the queue.
+
+        :param client: client's socket
+        """
+        buffer = self.outbound.get(client)
+        if buffer is None:
+            return
+        try:
+            sent = client.send(buffer)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.delete_client(client)
+            return
+        del buffer[:sent]
+        if not buffer:
+            del self.outbound[client]
+            self.selector.modify(client, EVENT_READ, self.read_client)
+            self.remove_delivered_messages(client)
+
+    def process_handshake(self,
+                          message: dict,
+                          client: socket,
+                          handshake: ClientHandshake):
+        """
+        Advances the authorization state machine of the client.
+        In the AWAITING_PRESENCE state only the presence message (or exit)
+        is accepted, in the CHALLENGE_SENT state - only the reply with the
+        digest, in the TURNED_AWAY state any message is answered with
+        SERVER_BUSY. The replies are handled whenever they arrive, so the
+        server never waits for a single client.
+
+        :param message: dictionary with a message
+        :param client: client's socket
+        :param handshake: client's authorization state
+        """
+        if ACTION in message and message[ACTION] == EXIT:
+            self.delete_client(client)
+        elif handshake.state == TURNED_AWAY:
+            self.respond(client, message, busy_response(self.admission))
+            self.delete_client(client)
+        elif handshake.state == AWAITING_PRESENCE and \
+                request_action(message) == PRESENCE:
+            self.authorize_client(message, client, handshake)
+        elif handshake.state == CHALLENGE_SENT and \
+                RESPONSE in message and message[RESPONSE] == 511:
+            self.complete_authorization(message, client, handshake)
+        else:
+            self.send(client, error_response(AUTHORIZATION_REQUIRED))
 
-    def authorize_client(self, message: dict, client: socket):
+    def authorize_client(self,
+                         message: dict,
+                         client: socket,
+                         handshake: ClientHandshake):
         """
-        Handles the client's authorization. Checks if the username isn't already taken,
+        Handles the client's presence message. Checks if the username isn't already taken,
         then checks if the user is registered on the server. If those two checks pass,
-        the method then initiates the exchange of encrypted passwords with the client.
-        If the password is correct, the client is logged onto the server, otherwise the
-        client is removed from the server and his socket gets closed.
+        the method sends the challenge to the client and moves the handshake to the
+        CHALLENGE_SENT state. The reply is handled by complete_authorization.
+        A client with a valid resume token is logged in right away, and his
+        previous connection (if the server hasn't noticed it's dead yet)
+        is closed.
 
         :param message: presence message
         :param client: client's socket
+        :param handshake: client's authorization state
         """
         SERVER_LOGGER.debug(
             'Старт процесса авторизации пользователя %s' %
             message[USER]
         )
-        if message[USER][ACCOUNT_NAME] in self.nicknames.keys():
+        login = message[USER][ACCOUNT_NAME]
+        if RESUME_TOKEN in message and \
+                self.resume_tokens.redeem(message[RESUME_TOKEN], login):
+            SERVER_LOGGER.info(
+                'Пользователь %s возобновил сеанс по токену' % login)
+            if login in self.nicknames:
+                self.delete_client(self.nicknames[login])
+            handshake.login = login
+            handshake.public_key = message[USER].get(PUBLIC_KEY)
+            handshake.version = message.get(VERSION, 1)
+            self.login_client(client, handshake)
+        elif message[USER][ACCOUNT_NAME] in self.nicknames.keys():
             response = {
                 RESPONSE: 400,
                 ERROR: 'Имя пользователя уже занято'
             }
-            try:
-                send_message(client, response)
-            except OSError as e:
-                SERVER_LOGGER.debug('Произошла ошибка: %s' % e)
-                pass
-            self.clients_list.remove(client)
-            client.close()
+            self.send(client, response)
+            self.delete_client(client)
         elif not self.server_db.check_existing_user(
                 message[USER][ACCOUNT_NAME]):
             response = {
                 RESPONSE: 400,
                 ERROR: 'Пользователь не зарегистрирован'
             }
-            try:
-                SERVER_LOGGER.debug(
-                    'Пользователь %s не зарегистрирован' %
-                    message[USER][ACCOUNT_NAME]
-                )
-                send_message(client, response)
-            except OSError as e:
-                SERVER_LOGGER.debug('Произошла ошибка: %s' % e)
-                pass
+            SERVER_LOGGER.debug(
+                'Пользователь %s не зарегистрирован' %
+                message[USER][ACCOUNT_NAME]
+            )
+            self.send(client, response)
         else:
             SERVER_LOGGER.debug('Начало проверки пароля')
             random_string = hexlify(urandom(64))
@@ -302,105 +627,220 @@ class MessagingServer(Thread):
                 random_string,
                 'MD5'
             )
-            pwd_digest = pwd_hash.digest()
+            handshake.login = message[USER][ACCOUNT_NAME]
+            handshake.public_key = message[USER].get(PUBLIC_KEY)
+            handshake.version = message.get(VERSION, 1)
+            handshake.digest = pwd_hash.digest()
+            handshake.state = CHALLENGE_SENT
             SERVER_LOGGER.debug(
                 'Подготовлено сообщение для авторизации: %s' %
                 auth_response
             )
-            try:
-                send_message(client, auth_response)
-                client_response = receive_message(client)
-            except OSError as e:
-                SERVER_LOGGER.debug(
-                    'Ошибка при авторизации: ', exc_info=e
-                )
-                client.close()
-                return
-            client_digest = a2b_base64(client_response[DATA])
-            if RESPONSE in client_response and \
-                    client_response[RESPONSE] == 511 and \
-                    compare_digest(pwd_digest, client_digest):
-                self.nicknames[message[USER][ACCOUNT_NAME]] = client
-                client_addr, client_port = client.getpeername()
-                try:
-                    send_message(client, {RESPONSE: 200})
-                except OSError:
-                    self.delete_client(client)
-                self.server_db.login_user(
-                    message[USER][ACCOUNT_NAME],
-                    client_addr,
-                    client_port,
-                    message[USER][PUBLIC_KEY]
-                )
-            else:
-                response = {
-                    RESPONSE: 400,
-                    ERROR: 'Неверный пароль'
-                }
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-                self.clients_list.remove(client)
-                client.close()
-
-    def send_client_message(self, message: dict):
+            self.send(client, auth_response)
+
+    def complete_authorization(self,
+                               message: dict,
+                               client: socket,
+                               handshake: ClientHandshake):
+        """
+        Handles the client's reply to the challenge.
+        If the password is correct, the client is logged onto the server, otherwise the
+        client is removed from the server and his socket gets closed.
+
+        :param message: client's reply with the digest
+        :param client: client's socket
+        :param handshake: client's authorization state
+        """
+        client_digest = a2b_base64(message.get(DATA) or '')
+        if compare_digest(handshake.digest, client_digest) and \
+                handshake.login not in self.nicknames:
+            self.login_client(client, handshake)
+        else:
+            response = {
+                RESPONSE: 400,
+                ERROR: 'Неверный пароль'
+            }
+            self.send(client, response)
+            self.delete_client(client)
+
+    def login_client(self, client: socket, handshake: ClientHandshake):
+        """
+        Logs the authorized client onto the server. The clients that can
+        resume their sessions get a new resume token and the number of
+        the last users' list event in the response.
+
+        :param client: client's socket
+        :param handshake: client's authorization state
+        """
+        handshake.state = AUTHENTICATED
+        del self.handshakes[client]
+        self.nicknames[handshake.login] = client
+        self.logins[client] = handshake.login
+        self.protocol_versions[client] = handshake.version
+        client_addr, client_port = client.getpeername()[:2]
+        response = login_response(
+            handshake.login,
+            handshake.version,
+            self.resume_tokens,
+            self.roster_log
+        )
+        if not self.send(client, response):
+            return
+        self.server_db.login_user(
+            handshake.login,
+            client_addr,
+            client_port,
+            handshake.public_key
+        )
+        self.notify_roster(USER_ONLINE, handshake.login)
+        self.deliver_offline_messages(handshake.login, client)
+
+    def deliver_offline_messages(self, login: str, client: socket):
+        """
+        Sends all the messages that were waiting for the user in one batch.
+        They are removed from the queue only when the whole batch has been
+        handed to the OS: right away or, if part of it went to the
+        outbound buffer, when flush_client sends the buffer. If the
+        connection breaks before that, the messages stay in the queue
+        till the next login.
+
+        :param login: client's nickname
+        :param client: client's socket
+        """
+        messages = self.server_db.get_offline_messages(login)
+        if not messages:
+            return
+        if not self.write(client, b''.join(
+                encode_message(message) for _, message in messages)):
+            return
+        self.offline_batches[client] = (login, messages[-1][0], len(messages))
+        if client not in self.outbound:
+            self.remove_delivered_messages(client)
+
+    def remove_delivered_messages(self, client: socket):
+        """
+        Removes the offline messages sent to the client from the queue.
+
+        :param client: client's socket
+        """
+        batch = self.offline_batches.pop(client, None)
+        if batch is None:
+            return
+        login, last_id, count = batch
+        self.server_db.delete_offline_messages(login, last_id)
+        SERVER_LOGGER.info(
+            'Пользователю %s доставлено сообщений из очереди: %d.' %
+            (login, count)
+        )
+
+    def send_client_message(self, message: dict) -> bool:
         """
         Handles the exchange of messages between clients.
-        Validates the message and sends it if correct
+        Sends the message to the recipient if he is online, otherwise
+        (or if his connection turns out to be broken) puts it into the
+        recipient's offline queue. Returns False if the queue is full.
 
         :param message: dictionary with the message
         """
-        if message[DESTINATION] in self.nicknames and \
-                self.nicknames[message[DESTINATION]] in \
-                self.sockets_list:
-            send_message(self.nicknames[message[DESTINATION]],
-                         message)
-            SERVER_LOGGER.info(
-                'Было отправлено сообщение пользователю '
-                '%s от пользователя %s.' %
-                (message[DESTINATION], message[SENDER])
-            )
-        elif message[DESTINATION] in self.nicknames and \
-                self.nicknames[message[DESTINATION]] \
-                not in self.sockets_list:
+        message = without_request_id(message)
+        recipient = self.nicknames.get(message[DESTINATION])
+        if recipient:
+            if self.send(recipient, message):
+                SERVER_LOGGER.info(
+                    'Было отправлено сообщение пользователю '
+                    '%s от пользователя %s.' %
+                    (message[DESTINATION], message[SENDER])
+                )
+                return True
             SERVER_LOGGER.error(
                 'Потеряна связь с клиентом %s, '
-                'отправка сообщения не возможна.' %
-                self.nicknames[message[DESTINATION]]
-            )
-            self.delete_client(self.nicknames[message[DESTINATION]])
-        else:
-            SERVER_LOGGER.error(
-                'Пользователь %s не зарегистрирован на сервере, '
-                'отправка сообщения не возможна.' %
-                message[DESTINATION]
+                'сообщение помещено в очередь.' % recipient
             )
+        return self.server_db.store_offline_message(
+            message[DESTINATION], message)
 
     def delete_client(self, client: socket):
         """
         Closes the connection with the client who decided to leave the server.
-        Logs him out in the DB, deletes from the list of active users and closes the socket.
+        Logs him out in the DB, deletes from the list of active users,
+        unregisters the socket from the selector and closes it.
 
         :param client: client's socket
         """
         SERVER_LOGGER.info(
             'Клиент %s отключился от сервера' % client)
+        login = None
         for name in self.nicknames:
             if self.nicknames[name] == client:
                 self.server_db.logout_user(name)
                 del self.nicknames[name]
+                login = name
                 break
-        self.clients_list.remove(client)
+        self.clients.discard(client)
+        self.outbound.pop(client, None)
+        self.offline_batches.pop(client, None)
+        self.handshakes.pop(client, None)
+        self.turned_away.discard(client)
+        self.admission.discard(client)
+        self.logins.pop(client, None)
+        self.protocol_versions.pop(client, None)
+        if self.selector and client.fileno() != -1:
+            try:
+                self.selector.unregister(client)
+            except (KeyError, ValueError):
+                pass
         client.close()
+        if login:
+            self.notify_roster(USER_OFFLINE, login)
+
+    def disconnect_user(self, login: str):
+        """
+        Drops the connection of the user without logging him out in the DB
+        and revokes his resume tokens.
+        Used when the user gets removed from the server.
+
+        :param login: client's nickname
+        """
+        self.resume_tokens.revoke(login)
+        client = self.nicknames.pop(login, None)
+        if client:
+            self.delete_client(client)
 
     def update_list(self):
         """
         Generates the message with 205 code that triggers the update of contact
         and active users' lists for all active clients.
         """
-        for name in self.nicknames:
-            try:
-                send_message(self.nicknames[name], {RESPONSE: 205})
-            except OSError:
-                self.delete_client(self.nicknames[name])
+        for name, client in list(self.nicknames.items()):
+            self.send(client, {RESPONSE: 205})
+
+    def notify_roster(self, event: str, login: str):
+        """
+        Notifies the active clients that the user was added, removed,
+        went online or offline, so they can update their lists incrementally.
+        Clients of the older protocol versions don't understand the events,
+        they get the 205 message instead (only when a user is added or
+        removed, they don't track who is online). The events are numbered
+        and logged, so a reconnected client can get the ones it missed.
+        Nothing is sent while the server is stopping.
+
+        :param event: USER_ADDED, USER_REMOVED, USER_ONLINE or USER_OFFLINE
+        :param login: user the event is about
+        """
+        # при остановке сервера отключаются все клиенты разом,
+        # рассылать каждому об уходе остальных незачем
+        if not self.working:
+            return
+        notification = roster_notification(event, login, self.roster_log)
+        full_refresh = event in FULL_REFRESH_EVENTS
+        for name, client in list(self.nicknames.items()):
+            if name == login or client.fileno() == -1:
+                continue
+            if self.protocol_versions.get(client, 1) >= \
+                    ROSTER_EVENTS_VERSION:
+                message = notification
+            elif full_refresh:
+                message = {RESPONSE: 205}
+            else:
+                continue
+            self.send(client, message)
@@ -2,15 +2,46 @@
 Server's database module.
 """
 import sys
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+from json import dumps, loads
+from functools import wraps
+from threading import Lock
+from time import monotonic
 
 from Crypto.PublicKey.RSA import RsaKey
 from sqlalchemy import create_engine, MetaData, Table, Column, \
-    Integer, String, DateTime, ForeignKey, Text
-from sqlalchemy.orm import mapper, sessionmaker
+    Integer, String, DateTime, ForeignKey, Text, Index, inspect
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import select, func
 from sqlalchemy.sql import default_comparator
 
 sys.path.append('../')
+from utils.storage import apply_storage_settings
+
+# запись кэша пользователей
+CachedUser = namedtuple(
+    'CachedUser', ('login', 'password_hash', 'public_key', 'last_login'))
+
+
+def read_only(method):
+    """
+    Decorator for the reading methods of ServerDatabase.
+    Closes the calling thread's session after the query, so the read
+    transaction doesn't stay open and the connection goes back to the pool.
+
+    :param method: decorated method
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.session.remove()
+
+    return wrapper
 
 
 class ServerDatabase:
@@ -158,20 +189,71 @@ class ServerDatabase:
                        self.received_messages
                    )
 
-    def __init__(self, filepath: str):
+    class OfflineMessage:
+        """
+        Representation class for table of messages waiting for
+        their recipients to come online.
+        """
+
+        def __init__(self,
+                     recipient: str,
+                     payload: str):
+            """
+            Initialization of the table.
+
+            :param recipient: recipient's nickname
+            :param payload: the message as JSON (the text stays encrypted)
+            """
+            self.id = None
+            self.recipient = recipient
+            self.payload = payload
+            self.created = datetime.now()
+
+        def __repr__(self):
+            """
+            Representation for print.
+            """
+            return "<OfflineMessage (recipient '%s') (created '%s')>" % (
+                self.recipient, self.created)
+
+    def __init__(self,
+                 filepath: str,
+                 history_flush_interval: float = 5,
+                 history_flush_count: int = 100,
+                 user_cache_size: int = 1024,
+                 storage_settings: dict = None,
+                 offline_queue_limit: int = 100,
+                 offline_message_ttl: float = 604800):
         """
         Initialization and creation of tables.
-        Creates all the tables, mappers and a session.
+        Creates all the tables, mappers and a session registry.
         Deletes all previous entries from the table of active users.
+        Every thread (the server, the GUI, the DB worker of the asyncio
+        server) gets its own session from the registry, the connections
+        are shared through a pool.
 
         :param filepath: path to DB
+        :param history_flush_interval: max number of seconds the message
+            counters are kept in memory before they are written to the DB
+        :param history_flush_count: number of messages that triggers
+            writing the counters to the DB right away
+        :param user_cache_size: max number of users kept in the
+            users cache (0 turns the cache off)
+        :param storage_settings: SQLite tuning (see utils.storage),
+            the defaults are used if None
+        :param offline_queue_limit: max number of messages waiting for
+            a single offline user
+        :param offline_message_ttl: number of seconds a message waits
+            for an offline user before it's dropped
         """
         self.engine = create_engine(
             f'sqlite:///{filepath}',
             echo=False,
             pool_recycle=7200,
+            poolclass=QueuePool,
             connect_args={'check_same_thread': False}
         )
+        apply_storage_settings(self.engine, storage_settings)
         self.metadata = MetaData()
         all_users_table = Table(
             'all_users',
@@ -186,7 +268,7 @@ class ServerDatabase:
             'user_login_history',
             self.metadata,
             Column('id', Integer, primary_key=True),
-            Column('user', ForeignKey('all_users.login')),
+            Column('user', ForeignKey('all_users.login'), index=True),
             Column('ip_address', String(16)),
             Column('port', String(5)),
             Column('last_active', DateTime)
@@ -205,28 +287,143 @@ class ServerDatabase:
             self.metadata,
             Column('id', Integer, primary_key=True),
             Column('contact_owner', ForeignKey('all_users.login')),
-            Column('contact', ForeignKey('all_users.login'))
+            Column('contact', ForeignKey('all_users.login'), index=True),
+            Index(
+                'ix_user_contacts_contact_owner_contact',
+                'contact_owner',
+                'contact',
+                unique=True
+            )
         )
         user_message_history_table = Table(
             'user_action_history',
             self.metadata,
             Column('id', Integer, primary_key=True),
-            Column('user', ForeignKey('all_users.login')),
+            Column('user', ForeignKey('all_users.login'), index=True),
             Column('sent_messages', Integer),
             Column('received_messages', Integer)
         )
+        offline_messages_table = Table(
+            'offline_messages',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('recipient', ForeignKey('all_users.login'), index=True),
+            Column('payload', Text),
+            Column('created', DateTime, index=True)
+        )
 
         self.metadata.create_all(self.engine)
+        self.contacts_table = user_contacts_table
+        self.create_missing_indexes()
         mapper(self.AllUsers, all_users_table)
         mapper(self.UserLoginHistory, user_login_history_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.ContactList, user_contacts_table)
         mapper(self.UserActionHistory, user_message_history_table)
+        mapper(self.OfflineMessage, offline_messages_table)
 
-        Sesh = sessionmaker(bind=self.engine)
-        self.session = Sesh()
+        self.offline_queue_limit = offline_queue_limit
+        self.offline_message_ttl = timedelta(seconds=offline_message_ttl)
+        self.session = scoped_session(sessionmaker(bind=self.engine))
         self.session.query(self.ActiveUsers).delete()
+        self.session.query(self.OfflineMessage).filter(
+            self.OfflineMessage.created <
+            datetime.now() - self.offline_message_ttl
+        ).delete()
         self.session.commit()
+        self.session.remove()
+
+        # накопленные, но еще не записанные в БД счетчики сообщений
+        self.history_flush_interval = history_flush_interval
+        self.history_flush_count = history_flush_count
+        self.history_lock = Lock()
+        self.pending_history = dict()
+        self.pending_messages = 0
+        self.pending_since = None
+
+        # кэш записей пользователей (логин -> CachedUser или None,
+        # если такого пользователя нет), вытесняются давно не запрошенные
+        self.user_cache_size = user_cache_size
+        self.users_lock = Lock()
+        self.users_cache = OrderedDict()
+
+    def create_missing_indexes(self):
+        """
+        Creates the indexes that are missing in a DB created by an older
+        version of the server (create_all doesn't add indexes to the
+        existing tables). Duplicate contacts are deleted before the
+        unique index on the contacts is created.
+        """
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in self.metadata.sorted_tables:
+                existing_indexes = {
+                    index['name'] for index in inspector.get_indexes(
+                        table.name)
+                }
+                for index in table.indexes:
+                    if index.name in existing_indexes:
+                        continue
+                    if table is self.contacts_table and index.unique:
+                        connection.execute(
+                            table.delete().where(
+                                table.c.id.notin_(
+                                    select([func.min(table.c.id)])
+                                    .group_by(
+                                        table.c.contact_owner,
+                                        table.c.contact)
+                                )
+                            )
+                        )
+                    index.create(connection)
+
+    def get_cached_user(self, login: str):
+        """
+        Returns the CachedUser record of the user, or None if there is
+        no such user. The record is read from the DB only if it isn't
+        in the cache; when the cache is full, the least recently used
+        record is evicted.
+
+        :param login: client's nickname
+        """
+        with self.users_lock:
+            if login in self.users_cache:
+                self.users_cache.move_to_end(login)
+                return self.users_cache[login]
+            row = self.session.query(
+                self.AllUsers.login,
+                self.AllUsers.password_hash,
+                self.AllUsers.public_key,
+                self.AllUsers.last_login
+            ).filter_by(login=login).first()
+            user = CachedUser(*row) if row else None
+            self.cache_user(login, user)
+            return user
+
+    def cache_user(self, login: str, user):
+        """
+        Puts the record of the user to the cache.
+        Has to be called with users_lock acquired.
+
+        :param login: client's nickname
+        :param user: CachedUser record or None if there is no such user
+        """
+        if self.user_cache_size <= 0:
+            return
+        self.users_cache[login] = user
+        self.users_cache.move_to_end(login)
+        while len(self.users_cache) > self.user_cache_size:
+            self.users_cache.popitem(last=False)
+
+    def invalidate_user(self, login: str):
+        """
+        Drops the record of the user from the cache, so it's read
+        from the DB next time.
+
+        :param login: client's nickname
+        """
+        with self.users_lock:
+            self.users_cache.pop(login, None)
 
     def login_user(self, login: str, ip: str, port: int, key: RsaKey):
         """
@@ -240,15 +437,13 @@ class ServerDatabase:
         :param port: client's port
         :param key: client's public RSA key
         """
-        qry = self.session.query(self.AllUsers).filter_by(
-            login=login)
-        if qry.count():
-            existing_user = qry.first()
-            existing_user.last_login = datetime.now()
-            if existing_user.public_key != key:
-                existing_user.public_key = key
-        else:
+        existing_user = self.session.query(self.AllUsers).filter_by(
+            login=login).first()
+        if not existing_user:
             raise ValueError('Пользователь не зарегистрирован')
+        existing_user.last_login = datetime.now()
+        if existing_user.public_key != key:
+            existing_user.public_key = key
         new_active_user = self.ActiveUsers(
             login,
             ip,
@@ -264,6 +459,13 @@ class ServerDatabase:
         )
         self.session.add(user_history_entry)
         self.session.commit()
+        with self.users_lock:
+            self.cache_user(login, CachedUser(
+                login,
+                existing_user.password_hash,
+                existing_user.public_key,
+                existing_user.last_login
+            ))
 
     def register_user(self, login: str, pwd_hash: bytes):
         """
@@ -279,6 +481,7 @@ class ServerDatabase:
         user_history_entry = self.UserActionHistory(new_user.login)
         self.session.add(user_history_entry)
         self.session.commit()
+        self.invalidate_user(login)
 
     def remove_user_from_db(self, login: str):
         """
@@ -287,6 +490,8 @@ class ServerDatabase:
 
         :param login: client's nickname
         """
+        with self.history_lock:
+            self.pending_history.pop(login, None)
         user = self.session.query(self.AllUsers).filter_by(
             login=login).first()
         self.session.query(self.ActiveUsers).filter_by(
@@ -299,9 +504,12 @@ class ServerDatabase:
             contact_owner=user.login).delete()
         self.session.query(self.ContactList).filter_by(
             contact=user.login).delete()
+        self.session.query(self.OfflineMessage).filter_by(
+            recipient=user.login).delete()
         self.session.query(self.AllUsers).filter_by(
             login=login).delete()
         self.session.commit()
+        self.invalidate_user(login)
 
     def logout_user(self, login: str):
         """
@@ -310,31 +518,29 @@ class ServerDatabase:
 
         :param login: client's nickname
         """
-        leaving_user = self.session.query(self.AllUsers).filter_by(
-            login=login).first()
         self.session.query(self.ActiveUsers).filter_by(
-            user=leaving_user.login).delete()
+            user=login).delete()
         self.session.commit()
 
     def get_user_pwd_hash(self, login: str) -> bytes:
         """
-        Returns the hashed password of the user.
+        Returns the hashed password of the user, or None if there is
+        no such user.
 
         :param login: client's nickname
         """
-        user = self.session.query(self.AllUsers).filter_by(
-            login=login).first()
-        return user.password_hash
+        user = self.get_cached_user(login)
+        return user.password_hash if user else None
 
     def get_user_public_key(self, login: str) -> RsaKey:
         """
-        Returns the public RSA key of the user.
+        Returns the public RSA key of the user, or None if there is
+        no such user.
 
         :param login: client's nickname
         """
-        user = self.session.query(self.AllUsers).filter_by(
-            login=login).first()
-        return user.public_key
+        user = self.get_cached_user(login)
+        return user.public_key if user else None
 
     def check_existing_user(self, login: str) -> bool:
         """
@@ -343,33 +549,26 @@ class ServerDatabase:
 
         :param login: client's nickname
         """
-        if self.session.query(self.AllUsers).filter_by(
-                login=login).count():
-            return True
-        else:
-            return False
+        return self.get_cached_user(login) is not None
 
     def add_contact_to_list(self, owner: str, contact: str):
         """
         Handles adding one user to the contacts of another.
-        Checks if the user is already in the contact list and finishes
-        working if they do, otherwise adds new entry to the Contacts table.
+        Adds new entry to the Contacts table with a single INSERT OR IGNORE,
+        the unique index on (contact_owner, contact) keeps the duplicates out.
 
         :param owner: the owner of the contact
         :param contact: user to be added to contact list
         """
-        existing_contact = self.session.query(
-            self.ContactList).filter_by(
-            contact_owner=owner,
-            contact=contact
+        result = self.session.execute(
+            self.contacts_table.insert().prefix_with('OR IGNORE').values(
+                contact_owner=owner,
+                contact=contact
+            )
         )
-        if existing_contact.count():
+        self.session.commit()
+        if not result.rowcount:
             print('Этот пользователь уже у вас в контактах.')
-            return
-        else:
-            new_contact = self.ContactList(owner, contact)
-            self.session.add(new_contact)
-            self.session.commit()
 
     def remove_contact_from_list(self, owner: str, contact: str):
         """
@@ -395,6 +594,7 @@ class ServerDatabase:
             ).delete()
             self.session.commit()
 
+    @read_only
     def all_users_list(self) -> list:
         """
         Returns the list of tuples with entries of all existing users.
@@ -405,6 +605,7 @@ class ServerDatabase:
         )
         return qry.all()
 
+    @read_only
     def all_active_users_list(self) -> list:
         """
         Returns the list of tuples with entries of all currently active users.
@@ -417,6 +618,7 @@ class ServerDatabase:
         ).join(self.AllUsers)
         return qry.all()
 
+    @read_only
     def show_user_login_history(self, user: str = None) -> list:
         """
         Returns the list of tuples with login history of either all users or one specific user.
@@ -433,6 +635,7 @@ class ServerDatabase:
             qry = qry.filter(self.AllUsers.login == user)
         return qry.all()
 
+    @read_only
     def get_user_contact_list(self, user: str) -> list:
         """
         Returns the list of strings with nicknames of all the contacts of a
@@ -451,28 +654,131 @@ class ServerDatabase:
         )
         return [contact[1] for contact in qry.all()]
 
+    def store_offline_message(self, recipient: str, message: dict) -> bool:
+        """
+        Puts the message to the queue of the offline recipient.
+        The expired messages of the recipient are dropped first.
+        Returns False if the recipient's queue is full.
+
+        :param recipient: recipient's nickname
+        :param message: message as received from the sender
+        """
+        self.session.query(self.OfflineMessage).filter(
+            self.OfflineMessage.recipient == recipient,
+            self.OfflineMessage.created <
+            datetime.now() - self.offline_message_ttl
+        ).delete()
+        queued = self.session.query(self.OfflineMessage).filter_by(
+            recipient=recipient).count()
+        if queued >= self.offline_queue_limit:
+            self.session.commit()
+            return False
+        self.session.add(self.OfflineMessage(recipient, dumps(message)))
+        self.session.commit()
+        return True
+
+    @read_only
+    def get_offline_messages(self, recipient: str) -> list:
+        """
+        Returns the list of tuples (id, message) with the messages
+        waiting for the user, oldest first. The messages stay in the queue
+        until delete_offline_messages is called after they are delivered.
+
+        :param recipient: recipient's nickname
+        """
+        qry = self.session.query(
+            self.OfflineMessage.id,
+            self.OfflineMessage.payload
+        ).filter(
+            self.OfflineMessage.recipient == recipient,
+            self.OfflineMessage.created >=
+            datetime.now() - self.offline_message_ttl
+        ).order_by(self.OfflineMessage.id)
+        return [(message_id, loads(payload))
+                for message_id, payload in qry.all()]
+
+    def delete_offline_messages(self, recipient: str, last_id: int):
+        """
+        Deletes the delivered messages (and the expired ones) of the user
+        from the queue.
+
+        :param recipient: recipient's nickname
+        :param last_id: id of the last delivered message
+        """
+        self.session.query(self.OfflineMessage).filter(
+            self.OfflineMessage.recipient == recipient,
+            self.OfflineMessage.id <= last_id
+        ).delete()
+        self.session.commit()
+
     def record_message_to_history(self, sender: str, recipient: str):
         """
         Records message to message history.
+        The counters are only accumulated in memory here, they get
+        written to the DB by flush_message_history in a single transaction
+        once enough messages are collected or enough time has passed.
 
         :param sender: self-explanatory
         :param recipient: self-explanatory as well
         """
-        sender = self.session.query(self.AllUsers).filter_by(
-            login=sender).first().login
-        recipient = self.session.query(self.AllUsers).filter_by(
-            login=recipient).first().login
-        sender_entry = self.session.query(
-            self.UserActionHistory).filter_by(user=sender).first()
-        sender_entry.sent_messages += 1
-        recipient_entry = self.session.query(
-            self.UserActionHistory).filter_by(user=recipient).first()
-        recipient_entry.received_messages += 1
+        with self.history_lock:
+            self.pending_history.setdefault(sender, [0, 0])[0] += 1
+            self.pending_history.setdefault(recipient, [0, 0])[1] += 1
+            self.pending_messages += 1
+            if self.pending_since is None:
+                self.pending_since = monotonic()
+            flush_needed = \
+                self.pending_messages >= self.history_flush_count or \
+                monotonic() - self.pending_since >= \
+                self.history_flush_interval
+        if flush_needed:
+            self.flush_message_history()
+
+    def history_flush_timeout(self):
+        """
+        Returns the number of seconds left till the accumulated message
+        counters have to be flushed, or None if there is nothing to flush.
+        """
+        with self.history_lock:
+            if self.pending_since is None:
+                return None
+            return max(
+                self.pending_since + self.history_flush_interval -
+                monotonic(),
+                0
+            )
+
+    def flush_message_history(self):
+        """
+        Writes the accumulated message counters to the DB
+        in a single transaction.
+        """
+        with self.history_lock:
+            pending = self.pending_history
+            self.pending_history = dict()
+            self.pending_messages = 0
+            self.pending_since = None
+        if not pending:
+            return
+        for login, (sent, received) in pending.items():
+            self.session.query(self.UserActionHistory).filter_by(
+                user=login).update(
+                {
+                    self.UserActionHistory.sent_messages:
+                        self.UserActionHistory.sent_messages + sent,
+                    self.UserActionHistory.received_messages:
+                        self.UserActionHistory.received_messages +
+                        received
+                },
+                synchronize_session=False
+            )
         self.session.commit()
 
+    @read_only
     def get_message_history(self) -> list:
         """
         Returns the list of tuples with entries of users' message history.
+        The counters that are not flushed to the DB yet are included.
         """
         qry = self.session.query(
             self.AllUsers.login,
@@ -480,4 +786,13 @@ class ServerDatabase:
             self.UserActionHistory.sent_messages,
             self.UserActionHistory.received_messages
         ).join(self.AllUsers)
-        return qry.all()
+        with self.history_lock:
+            pending = dict(self.pending_history)
+        history = []
+        for login, last_login, sent, received in qry.all():
+            pending_sent, pending_received = pending.get(login, (0, 0))
+            history.append((login,
+                            last_login,
+                            sent + pending_sent,
+                            received + pending_received))
+        return history
@@ -75,6 +75,7 @@ class MainWindow(QMainWindow):
 
         self.timer = QTimer()
         self.timer.timeout.connect(self.create_active_users_model)
+        self.timer.timeout.connect(self.show_admission_stats)
         self.timer.start(1000)
 
         self.refresh_users_list_button.triggered.connect(
@@ -118,6 +119,21 @@ class MainWindow(QMainWindow):
         self.active_users_table.resizeColumnsToContents()
         self.active_users_table.resizeRowsToContents()
 
+    def show_admission_stats(self):
+        """
+        Shows the counters of the admission control in the status bar.
+        """
+        stats = self.server_thread.admission.stats()
+        self.statusBar().showMessage(
+            'Соединения: принято %d, ожидали очереди %d, отклонено %d, '
+            'в очереди %d' % (
+                stats['admitted'],
+                stats['queued'],
+                stats['rejected'],
+                stats['waiting']
+            )
+        )
+
     def show_users_stats(self):
         """
         Modal window with users' action history.
@@ -0,0 +1,190 @@
+"""
+The part of the JIM protocol that doesn't depend on the server's engine.
+MessagingServer and AsyncMessagingServer both check the clients' requests
+and build the responses with these functions, so the engines can't answer
+the same request differently; the engines themselves only do the I/O
+and the DB calls, each in its own way.
+"""
+from time import time
+
+from utils.constants import ACTION, PRESENCE, TIME, USER, MESSAGE, SENDER, \
+    DESTINATION, MESSAGE_TEXT, RESPONSE, ERROR, EXIT, ACCOUNT_NAME, \
+    GET_CONTACTS, LIST_INFO, ADD_CONTACT, REMOVE_CONTACT, USER_REQUEST, \
+    PUBLIC_KEY_REQUEST, DATA, EVENT, ROSTER_UPDATE, USER_ADDED, \
+    USER_REMOVED, FINGERPRINT, KEY_NOT_MODIFIED, RESUME_TOKEN, \
+    RESUME_VERSION, SEQUENCE, ROSTER_SYNC, SYNC_EXPIRED, TOKEN_REFRESH, \
+    TOKEN_TTL, SERVER_BUSY, RETRY_AFTER
+from utils.utils import key_fingerprint
+
+# действие -> поля, обязательные в запросе, и поле с логином клиента,
+# от имени которого сделан запрос (None - логин в запросе не проверяется)
+REQUEST_FIELDS = {
+    PRESENCE: ((TIME, USER), None),
+    EXIT: ((ACCOUNT_NAME,), None),
+    MESSAGE: ((SENDER, DESTINATION, TIME, MESSAGE_TEXT), SENDER),
+    GET_CONTACTS: ((USER,), USER),
+    ADD_CONTACT: ((ACCOUNT_NAME, USER), USER),
+    REMOVE_CONTACT: ((ACCOUNT_NAME, USER), USER),
+    USER_REQUEST: ((ACCOUNT_NAME,), ACCOUNT_NAME),
+    ROSTER_SYNC: ((ACCOUNT_NAME, SEQUENCE), ACCOUNT_NAME),
+    TOKEN_REFRESH: ((ACCOUNT_NAME,), ACCOUNT_NAME),
+    PUBLIC_KEY_REQUEST: ((ACCOUNT_NAME,), None),
+}
+# действия, допустимые до прохождения авторизации
+HANDSHAKE_ACTIONS = (PRESENCE, EXIT)
+# события, о которых клиенты старых версий узнают по сообщению 205
+FULL_REFRESH_EVENTS = (USER_ADDED, USER_REMOVED)
+# тексты ошибок, общие для обоих серверов
+BAD_REQUEST = 'bad request'
+AUTHORIZATION_REQUIRED = 'Необходимо пройти авторизацию'
+UNKNOWN_DESTINATION = 'Пользователь не зарегистрирован на сервере.'
+QUEUE_FULL = 'Очередь сообщений пользователя переполнена.'
+NO_PUBLIC_KEY = 'Отсутствует публичный ключ пользователя.'
+SERVER_OVERLOADED = 'Сервер перегружен, повторите попытку позже'
+
+
+def request_action(message: dict, login: str = None):
+    """
+    Returns the action of the client's request if the request is valid:
+    it has all the fields the action needs and is made on behalf of
+    the client. Before the authorization only the presence message
+    and exit are valid, after it - everything but the presence message.
+    Returns None for an invalid request.
+
+    :param message: dictionary with a message
+    :param login: client's nickname, None if he isn't authorized yet
+    """
+    action = message.get(ACTION)
+    if action not in REQUEST_FIELDS or \
+            not login and action not in HANDSHAKE_ACTIONS or \
+            login and action == PRESENCE:
+        return None
+    fields, login_field = REQUEST_FIELDS[action]
+    if not all(field in message for field in fields):
+        return None
+    if login and login_field and message[login_field] != login:
+        return None
+    return action
+
+
+def error_response(error: str, code: int = 400) -> dict:
+    """
+    Returns the response reporting an error.
+
+    :param error: text of the error
+    :param code: service code of the response
+    """
+    return {RESPONSE: code, ERROR: error}
+
+
+def list_response(items: list) -> dict:
+    """
+    Returns the 202 response with the list requested by the client.
+
+    :param items: contents of the list
+    """
+    return {RESPONSE: 202, LIST_INFO: items}
+
+
+def busy_response(admission) -> dict:
+    """
+    Returns the SERVER_BUSY response to the client turned away
+    by the admission control.
+
+    :param admission: admission control of the server
+    """
+    response = error_response(SERVER_OVERLOADED, SERVER_BUSY)
+    response[RETRY_AFTER] = admission.retry_after()
+    return response
+
+
+def login_response(login: str, version: int, tokens, roster_log) -> dict:
+    """
+    Returns the response to the authorized client. The clients that can
+    resume their sessions get a new resume token and the number of
+    the last users' list event.
+
+    :param login: client's nickname
+    :param version: version of the protocol the client speaks
+    :param tokens: issuer of the resume tokens
+    :param roster_log: log of the users' list events
+    """
+    response = {RESPONSE: 200}
+    if version >= RESUME_VERSION:
+        response.update(token_response(login, tokens))
+        response[SEQUENCE] = roster_log.sequence
+    return response
+
+
+def token_response(login: str, tokens) -> dict:
+    """
+    Returns the response to the TOKEN_REFRESH request with a new token.
+
+    :param login: client's nickname
+    :param tokens: issuer of the resume tokens
+    """
+    return {
+        RESPONSE: 200,
+        RESUME_TOKEN: tokens.issue(login),
+        TOKEN_TTL: tokens.ttl
+    }
+
+
+def public_key_response(message: dict, key: str) -> dict:
+    """
+    Returns the response to the PUBLIC_KEY_REQUEST: the key,
+    KEY_NOT_MODIFIED if the client already has it (sent its fingerprint),
+    or an error if the user has no key.
+
+    :param message: client's request
+    :param key: user's public key from the DB, None if there is none
+    """
+    if not key:
+        return error_response(NO_PUBLIC_KEY)
+    if FINGERPRINT in message and \
+            message[FINGERPRINT] == key_fingerprint(key):
+        return {RESPONSE: KEY_NOT_MODIFIED}
+    return {RESPONSE: 511, DATA: key}
+
+
+def roster_sync_response(login: str, sequence: int, roster_log) -> dict:
+    """
+    Returns the response to the ROSTER_SYNC request: the events
+    the client has missed since the one with the given number, or
+    SYNC_EXPIRED if they are no longer in the log (the client then
+    requests the whole lists).
+
+    :param login: client's nickname
+    :param sequence: number of the last event the client has seen
+    :param roster_log: log of the users' list events
+    """
+    events = roster_log.since(sequence) \
+        if isinstance(sequence, int) else None
+    if events is None:
+        return error_response(
+            'События уже удалены из журнала', SYNC_EXPIRED)
+    return {
+        RESPONSE: 202,
+        LIST_INFO: [
+            [number, event, name] for number, event, name in events
+            if name != login
+        ],
+        SEQUENCE: roster_log.sequence
+    }
+
+
+def roster_notification(event: str, login: str, roster_log) -> dict:
+    """
+    Logs the users' list event and returns the notification about it.
+
+    :param event: USER_ADDED, USER_REMOVED, USER_ONLINE or USER_OFFLINE
+    :param login: user the event is about
+    :param roster_log: log of the users' list events
+    """
+    return {
+        ACTION: ROSTER_UPDATE,
+        EVENT: event,
+        ACCOUNT_NAME: login,
+        SEQUENCE: roster_log.append(event, login),
+        TIME: time()
+    }
@@ -8,6 +8,8 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QDialog, QLabel, QLineEdit, \
     QPushButton, QMessageBox
 
+from utils.constants import USER_ADDED
+
 
 class RegisterUser(QDialog):
     """
@@ -112,5 +114,9 @@ class RegisterUser(QDialog):
                 'Успех!',
                 'Пользователь успешно зарегистрирован!'
             )
-            self.server.update_list()
+            self.server.call_soon(
+                self.server.notify_roster,
+                USER_ADDED,
+                self.nickname_input.text()
+            )
             self.close()
@@ -4,6 +4,8 @@ Modal GUI window for client removal.
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QDialog, QLabel, QComboBox, QPushButton
 
+from utils.constants import USER_REMOVED
+
 
 class RemoveUser(QDialog):
     """
@@ -57,14 +59,10 @@ class RemoveUser(QDialog):
         Handles the deletion of the user. Checks if the user is registered
         on the server, deletes him and prompts the server to update the list of active users.
         """
-        self.db.remove_user_from_db(self.user_selector.currentText())
-        if self.user_selector.currentText() in self.server.nicknames:
-            client = self.server.nicknames[
-                self.user_selector.currentText()]
-            del self.server.nicknames[
-                self.user_selector.currentText()]
-            self.server.delete_client(client)
-        self.server.update_list()
+        login = self.user_selector.currentText()
+        self.db.remove_user_from_db(login)
+        self.server.call_soon(self.server.disconnect_user, login)
+        self.server.call_soon(self.server.notify_roster, USER_REMOVED, login)
         self.close()
 
     def update_selector(self):
@@ -0,0 +1,53 @@
+"""
+Log of the users' list events, so a client resuming after a lost
+connection gets only the events it has missed
+(the resume tokens are in server/tokens.py).
+"""
+from collections import deque
+from time import time
+
+# сколько последних событий списка пользователей хранится в журнале
+ROSTER_LOG_SIZE = 1000
+
+
+class RosterLog:
+    """
+    Numbered log of the users' list events.
+    The numbering starts from the current time in milliseconds, so the
+    numbers given out by a restarted server are always greater, and the
+    client with a number from the previous run gets a full update.
+    """
+
+    def __init__(self, size: int = ROSTER_LOG_SIZE):
+        """
+        Initialization of the log.
+
+        :param size: max number of the events kept
+        """
+        self.events = deque(maxlen=size)
+        self.sequence = int(time() * 1000)
+
+    def append(self, event: str, login: str) -> int:
+        """
+        Adds the event to the log and returns its number.
+
+        :param event: USER_ADDED, USER_REMOVED, USER_ONLINE or USER_OFFLINE
+        :param login: user the event is about
+        """
+        self.sequence += 1
+        self.events.append((self.sequence, event, login))
+        return self.sequence
+
+    def since(self, sequence: int):
+        """
+        Returns the list of the events after the one with the given number,
+        or None if some of them are no longer in the log
+        (or the number isn't from this log).
+
+        :param sequence: number of the last event the client has seen
+        """
+        oldest = self.events[0][0] if self.events else self.sequence + 1
+        if not oldest - 1 <= sequence <= self.sequence:
+            return None
+        return [event for event in self.events if event[0] > sequence]
+
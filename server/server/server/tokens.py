@@ -0,0 +1,224 @@
+"""
+Resume tokens of the clients' sessions.
+A token is the user's login and the time it was issued at, signed with
+HMAC-SHA256, so it's checked without the DB and without storing the
+tokens. The secret key is kept in a file, so the tokens issued before
+a restart of the server remain valid (the clients reconnecting after
+the restart don't have to go through the password challenge).
+A token is revoked by remembering the time before which the tokens
+of the user are no longer accepted. The revocations of the removed users
+are saved to the file right away, the redeemed tokens - when the server
+stops, so they can't be replayed after a restart either (only a crash
+of the server leaves the tokens redeemed since its start usable till
+they expire).
+"""
+import os
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from hashlib import sha256
+from hmac import new, compare_digest
+from json import dump, load
+from logging import getLogger
+from secrets import token_bytes
+from time import time_ns
+
+SERVER_LOGGER = getLogger('server')
+
+# сколько секунд действителен токен возобновления сеанса
+DEFAULT_TOKEN_TTL = 900
+# длина секретного ключа подписи в байтах
+TOKEN_SECRET_LENGTH = 32
+TOKEN_SEPARATOR = '.'
+
+
+def to_base64(data: bytes) -> str:
+    """
+    Encodes bytes to a URL-safe base64 string without the padding.
+
+    :param data: bytes to be encoded
+    """
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def from_base64(data: str) -> bytes:
+    """
+    Decodes a URL-safe base64 string without the padding.
+
+    :param data: string to be decoded
+    """
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def load_secret(secret_file: str) -> bytes:
+    """
+    Reads the secret key from the file, creating the file with
+    a new random key (readable only by the owner) if there is none.
+
+    :param secret_file: path to the file of the key
+    """
+    try:
+        with open(secret_file, 'rb') as file:
+            secret = file.read()
+        if len(secret) >= TOKEN_SECRET_LENGTH:
+            return secret
+    except FileNotFoundError:
+        pass
+    secret = token_bytes(TOKEN_SECRET_LENGTH)
+    descriptor = os.open(
+        secret_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(secret)
+    SERVER_LOGGER.info('Создан ключ подписи токенов: %s' % secret_file)
+    return secret
+
+
+class TokenIssuer:
+    """
+    Issues and checks the signed resume tokens.
+    """
+
+    def __init__(self, secret_file: str = None, ttl: int = DEFAULT_TOKEN_TTL):
+        """
+        Initialization of the issuer.
+        Without the secret file the key is generated for this run only.
+
+        :param secret_file: path to the file of the secret key
+        :param ttl: lifetime of a token in seconds
+        """
+        self.ttl = ttl
+        self.secret_file = secret_file
+        if secret_file:
+            self.secret = load_secret(secret_file)
+        else:
+            self.secret = token_bytes(TOKEN_SECRET_LENGTH)
+        # логин -> время (мкс), токены выданные не позже которого отозваны
+        self.revoked = dict()
+        self.saved_revocations = dict()
+        self.last_issued = 0
+        self.load_revocations()
+
+    @property
+    def revocations_file(self):
+        """
+        Path to the file of the saved revocations, None if there's no
+        secret file.
+        """
+        if self.secret_file:
+            return self.secret_file + '.revoked'
+        return None
+
+    def now(self) -> int:
+        """
+        Returns the current time in microseconds, always greater than
+        the time of the previous token.
+        """
+        self.last_issued = max(time_ns() // 1000, self.last_issued + 1)
+        return self.last_issued
+
+    def sign(self, payload: bytes) -> bytes:
+        """
+        Returns the signature of the token's payload.
+
+        :param payload: login and time of the token
+        """
+        return new(self.secret, payload, sha256).digest()
+
+    def issue(self, login: str) -> str:
+        """
+        Returns a new token of the user.
+
+        :param login: client's nickname
+        """
+        payload = f'{self.now()}:{login}'.encode('utf-8')
+        return to_base64(payload) + TOKEN_SEPARATOR + \
+            to_base64(self.sign(payload))
+
+    def verify(self, token: str, login: str):
+        """
+        Returns the time the token was issued at, or None if the token
+        is forged, issued to another user, expired or revoked.
+
+        :param token: token sent by the client
+        :param login: client's nickname
+        """
+        try:
+            payload, signature = (
+                from_base64(part) for part in token.split(TOKEN_SEPARATOR))
+            if not compare_digest(self.sign(payload), signature):
+                return None
+            issued, token_login = payload.decode('utf-8').split(':', 1)
+            issued = int(issued)
+        except (AttributeError, ValueError, Base64Error):
+            return None
+        if token_login != login or \
+                issued + self.ttl * 1000000 < time_ns() // 1000 or \
+                issued <= self.revoked.get(login, 0):
+            return None
+        return issued
+
+    def redeem(self, token: str, login: str) -> bool:
+        """
+        Checks the token and revokes it along with all the earlier tokens
+        of the user, so it can be used only once. The revocation is saved
+        with the rest by save_revocations when the server stops.
+        Returns True if the token is valid.
+
+        :param token: token sent by the client
+        :param login: client's nickname
+        """
+        issued = self.verify(token, login)
+        if issued is None:
+            return False
+        self.revoked[login] = issued
+        self.saved_revocations[login] = issued
+        return True
+
+    def revoke(self, login: str):
+        """
+        Revokes all the tokens issued to the user so far
+        and saves that, so they aren't accepted after a restart either.
+
+        :param login: client's nickname
+        """
+        self.revoked[login] = self.now()
+        self.saved_revocations[login] = self.revoked[login]
+        self.save_revocations()
+
+    def load_revocations(self):
+        """
+        Reads the saved revocations.
+        """
+        if not self.revocations_file:
+            return
+        try:
+            with open(self.revocations_file) as file:
+                self.saved_revocations = {
+                    login: int(revoked)
+                    for login, revoked in load(file).items()
+                }
+        except (OSError, ValueError, AttributeError):
+            return
+        self.revoked.update(self.saved_revocations)
+
+    def save_revocations(self):
+        """
+        Saves the revocations (of the removed users and of the redeemed
+        tokens), dropping the ones older than the lifetime of a token
+        (the tokens they revoke have expired anyway).
+        """
+        if not self.revocations_file:
+            return
+        oldest = time_ns() // 1000 - self.ttl * 1000000
+        self.saved_revocations = {
+            login: revoked
+            for login, revoked in self.saved_revocations.items()
+            if revoked > oldest
+        }
+        try:
+            with open(self.revocations_file, 'w') as file:
+                dump(self.saved_revocations, file)
+        except OSError:
+            SERVER_LOGGER.error(
+                'Не удалось сохранить отозванные токены: %s' %
+                self.revocations_file
+            )
@@ -10,10 +10,29 @@ DEFAULT_CONNECTION_PORT = 7777
 DEFAULT_IP_ADDR = 'localhost'
 # максимальное число соединений
 MAX_NUMBER_OF_CONNECTIONS = 100
-# максимальный размер пакета (сообщения)
-MAX_PACK_LENGTH = 1024
+# размер блока, читаемого из сокета за один вызов recv
+MAX_PACK_LENGTH = 65536
+# длина заголовка кадра (размер сообщения в байтах, big-endian)
+MESSAGE_HEADER_LENGTH = 4
+# максимальный размер одного сообщения (без заголовка)
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
 # кодировка по умолчанию
 DEFAULT_ENCODING = 'utf8'
+# время, отведенное клиенту на авторизацию, в секундах
+HANDSHAKE_TIMEOUT = 5
+# время ожидания ответа сервера на запрос клиента, в секундах
+RESPONSE_TIMEOUT = 5
+# сколько секунд сервер ждет, пока клиент примет отправленные ему данные
+SEND_TIMEOUT = 5
+# сколько байт может ждать отправки одному клиенту; клиент, который
+# не читает свои сообщения, отключается, чтобы не расходовать память сервера
+MAX_OUTBOUND_BUFFER = 2 * MAX_MESSAGE_LENGTH
+# текущая версия протокола; клиенты без версии (или с версией ниже
+# ROSTER_EVENTS_VERSION) получают 205 вместо событий списка пользователей,
+# клиентам с версией ниже RESUME_VERSION не выдаются токены возобновления
+PROTOCOL_VERSION = 3
+ROSTER_EVENTS_VERSION = 2
+RESUME_VERSION = 3
 # текущий уровень логирования
 CURRENT_LOGGING_LEVEL = logging.DEBUG
 
@@ -26,6 +45,30 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+# необязательный идентификатор запроса, сервер возвращает его в ответе
+REQUEST_ID = 'request_id'
+# версия протокола, которую клиент сообщает в presence-сообщении
+VERSION = 'version'
+EVENT = 'event'
+# отпечаток закэшированного клиентом публичного ключа в запросе ключа;
+# если ключ не изменился, сервер отвечает KEY_NOT_MODIFIED без самого ключа
+FINGERPRINT = 'fingerprint'
+KEY_NOT_MODIFIED = 304
+# токен возобновления сеанса: сервер выдает его при входе, а клиент
+# предъявляет его в presence-сообщении при переподключении вместо пароля
+RESUME_TOKEN = 'resume_token'
+# время жизни токена в секундах, сервер сообщает его вместе с токеном;
+# подключенный клиент заранее обменивает токен на новый (TOKEN_REFRESH)
+TOKEN_TTL = 'token_ttl'
+# номер события списка пользователей; после переподключения клиент
+# запрашивает (ROSTER_SYNC) только события после последнего полученного,
+# а если их уже нет в журнале сервера, получает SYNC_EXPIRED
+SEQUENCE = 'seq'
+SYNC_EXPIRED = 410
+# сервер перегружен входящими соединениями: клиенту предлагается
+# подключиться заново не раньше чем через RETRY_AFTER секунд
+SERVER_BUSY = 503
+RETRY_AFTER = 'retry_after'
 
 # прочие ключи
 PRESENCE = 'presence'
@@ -40,3 +83,12 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USER_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+ROSTER_UPDATE = 'roster'
+ROSTER_SYNC = 'roster_sync'
+TOKEN_REFRESH = 'token_refresh'
+
+# события списка пользователей (ROSTER_UPDATE)
+USER_ADDED = 'added'
+USER_REMOVED = 'removed'
+USER_ONLINE = 'online'
+USER_OFFLINE = 'offline'
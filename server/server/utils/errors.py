@@ -46,3 +46,19 @@ class ServerError(Exception):
         Representation for print.
         """
         return self.error_message
+
+
+class ServerBusyError(ServerError):
+    """
+    Exception raised when the server is too busy to accept the connection.
+    """
+
+    def __init__(self, error_message, retry_after):
+        """
+        Besides the error text the server tells when to connect again.
+
+        :param error_message: custom message
+        :param retry_after: number of seconds to wait before reconnecting
+        """
+        super().__init__(error_message)
+        self.retry_after = retry_after
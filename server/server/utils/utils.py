@@ -1,49 +1,213 @@
 """
 Common functions used in both server and client apps.
+
+Every message on the wire is a frame: a 4-byte big-endian header with the
+length of the payload, followed by the payload itself (JSON encoded in UTF-8).
 """
 
 import json
+from collections import deque
+from errno import ECONNRESET
+from hashlib import sha256
 from socket import socket
+from struct import Struct
 from sys import path
+from weakref import WeakKeyDictionary
 
 from utils.decorators import function_log
 from utils.errors import IncorrectDataReceivedError, NotADictionaryError
-from utils.constants import MAX_PACK_LENGTH, DEFAULT_ENCODING
+from utils.constants import MAX_PACK_LENGTH, DEFAULT_ENCODING, \
+    MESSAGE_HEADER_LENGTH, MAX_MESSAGE_LENGTH, REQUEST_ID
 
 path.append('../')
 
+FRAME_HEADER = Struct('!I')
+
+
+def encode_message(message: dict) -> bytes:
+    """
+    Converts the dictionary to JSON, encodes it to bytes
+    and prepends the length header.
+
+    :param message: message to be encoded
+    """
+    if not isinstance(message, dict):
+        raise NotADictionaryError
+    payload = json.dumps(message).encode(DEFAULT_ENCODING)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload: bytes) -> dict:
+    """
+    Decodes the payload of a single frame into a dictionary.
+
+    :param payload: frame payload without the header
+    """
+    response_dict = json.loads(payload.decode(DEFAULT_ENCODING))
+    if isinstance(response_dict, dict):
+        return response_dict
+    raise IncorrectDataReceivedError
+
+
+def key_fingerprint(key: str) -> str:
+    """
+    Returns the fingerprint of the public key (SHA-256 of its PEM text),
+    the client sends it to check whether its cached copy of the key
+    is still valid.
+
+    :param key: public RSA key in PEM format
+    """
+    return sha256(key.encode(DEFAULT_ENCODING)).hexdigest()
+
+
+def reply_to(request: dict, response: dict) -> dict:
+    """
+    Copies the request's id (if the client has set one) to the response,
+    so the client can match the response to the request.
+
+    :param request: request received from the client
+    :param response: response to the request
+    """
+    if REQUEST_ID in request:
+        response[REQUEST_ID] = request[REQUEST_ID]
+    return response
+
+
+def without_request_id(message: dict) -> dict:
+    """
+    Returns a copy of the message without the request's id, so a message
+    relayed to another client doesn't carry the id of the sender's request.
+
+    :param message: message received from the client
+    """
+    return {key: value for key, value in message.items()
+            if key != REQUEST_ID}
+
+
+class MessageBuffer:
+    """
+    Reassembly buffer for a single socket.
+    Accumulates raw bytes and splits them into complete messages,
+    a single read may yield zero, one or many of them.
+    """
+
+    def __init__(self):
+        """
+        Creates an empty buffer and an empty queue of decoded messages.
+        """
+        self.data = bytearray()
+        self.messages = deque()
+
+    def feed(self, chunk: bytes):
+        """
+        Appends the chunk to the buffer and moves every complete frame
+        to the queue of decoded messages.
+
+        :param chunk: bytes received from the socket
+        """
+        self.data += chunk
+        while len(self.data) >= MESSAGE_HEADER_LENGTH:
+            length, = FRAME_HEADER.unpack_from(self.data)
+            if length > MAX_MESSAGE_LENGTH:
+                raise IncorrectDataReceivedError
+            frame_end = MESSAGE_HEADER_LENGTH + length
+            if len(self.data) < frame_end:
+                break
+            payload = bytes(self.data[MESSAGE_HEADER_LENGTH:frame_end])
+            del self.data[:frame_end]
+            self.messages.append(decode_message(payload))
+
+
+# буферы сборки сообщений, по одному на каждый сокет
+_buffers = WeakKeyDictionary()
+
+
+def _read_into_buffer(sckt: socket) -> MessageBuffer:
+    """
+    Performs a single recv on the socket and feeds the data
+    into the socket's reassembly buffer.
+
+    :param sckt: receiving socket
+    """
+    buffer = _buffers.get(sckt)
+    if buffer is None:
+        buffer = _buffers[sckt] = MessageBuffer()
+    chunk = sckt.recv(MAX_PACK_LENGTH)
+    if not isinstance(chunk, bytes):
+        raise IncorrectDataReceivedError
+    if not chunk:
+        raise ConnectionResetError(
+            ECONNRESET, 'Соединение закрыто удаленной стороной.')
+    buffer.feed(chunk)
+    return buffer
+
 
 @function_log
 def receive_message(sckt: socket) -> dict:
     """
-    Receives messages sent to client's or server's socket,
-    checks if the data received has the correct format, decodes bytes into JSON,
-    then - to dictionary and returns the dictionary
+    Receives messages sent to client's or server's socket.
+    Returns the next complete message as a dictionary, reading from
+    the socket as many times as it takes to reassemble it.
+    Any extra messages received along the way stay in the socket's buffer.
 
     :param sckt: receiving socket
     """
-    original_response = sckt.recv(MAX_PACK_LENGTH)
-    if isinstance(original_response, bytes):
-        decoded_response = original_response.decode(DEFAULT_ENCODING)
-        response_dict = json.loads(decoded_response)
-        if isinstance(response_dict, dict):
-            return response_dict
+    buffer = _buffers.get(sckt)
+    while buffer is None or not buffer.messages:
+        buffer = _read_into_buffer(sckt)
+    return buffer.messages.popleft()
+
+
+@function_log
+def receive_messages(sckt: socket) -> list:
+    """
+    Reads from the socket once and returns the list of all complete
+    messages available by now (possibly empty). Meant to be called when
+    the socket is known to be readable.
+
+    :param sckt: receiving socket
+    """
+    _read_into_buffer(sckt)
+    return take_buffered_messages(sckt)
+
+
+def take_buffered_messages(sckt: socket) -> list:
+    """
+    Returns the list of complete messages that were already received
+    on the socket but not yet handed out, without reading from it.
+
+    :param sckt: receiving socket
+    """
+    buffer = _buffers.get(sckt)
+    if buffer is None or not buffer.messages:
+        return []
+    messages = list(buffer.messages)
+    buffer.messages.clear()
+    return messages
+
+
+async def receive_message_async(reader) -> dict:
+    """
+    Receives the next complete message from an asyncio stream.
+    Reads the length header first and then exactly that many bytes.
+
+    :param reader: asyncio.StreamReader of the connection
+    """
+    header = await reader.readexactly(MESSAGE_HEADER_LENGTH)
+    length, = FRAME_HEADER.unpack(header)
+    if length > MAX_MESSAGE_LENGTH:
         raise IncorrectDataReceivedError
-    raise IncorrectDataReceivedError
+    return decode_message(await reader.readexactly(length))
 
 
 @function_log
 def send_message(sckt: socket, message: dict):
     """
     Sends the messages from the client's or server's socket.
-    Checks if the message has the correct format, converts it to JSON, encodes to bytes
-    and then sends it.
+    Checks if the message has the correct format, converts it to JSON,
+    encodes to bytes, prepends the length header and then sends it.
 
     :param sckt: sending socket
     :param message: message to be sent
     """
-    if not isinstance(message, dict):
-        raise NotADictionaryError
-    json_message = json.dumps(message)
-    encoded_message = json_message.encode(DEFAULT_ENCODING)
-    sckt.send(encoded_message)
+    sckt.sendall(encode_message(message))